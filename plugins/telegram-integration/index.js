@@ -5,6 +5,7 @@
 
 const path = require('path');
 const fs = require('fs');
+const crypto = require('crypto');
 const pngChunksExtract = require('png-chunks-extract');
 
 const pluginInfo = {
@@ -1155,10 +1156,31 @@ function getSession(telegramUserId) {
 // 路由初始化
 // ============================================
 
+// 带请求追踪 ID 的日志（ID 来自 bot 的 X-Trace-Id 请求头）
+function tlog(req, ...args) {
+    console.log(`[TG] [${req.traceId || '-'}]`, ...args);
+}
+
+function terror(req, ...args) {
+    console.error(`[TG] [${req.traceId || '-'}]`, ...args);
+}
+
 async function init(router) {
     console.log('[TG] Telegram Integration Plugin v2.0 initializing...');
     loadConfig();
 
+    // 请求追踪：沿用 bot 传来的 X-Trace-Id（没有则生成），并在请求结束时记录耗时
+    router.use((req, res, next) => {
+        const incoming = String(req.get('x-trace-id') || '').trim();
+        req.traceId = /^[\w-]{1,64}$/.test(incoming) ? incoming : crypto.randomBytes(8).toString('hex');
+        res.setHeader('X-Trace-Id', req.traceId);
+        const startedAt = Date.now();
+        res.on('finish', () => {
+            tlog(req, `${req.method} ${req.path} ${res.statusCode} ${Date.now() - startedAt}ms`);
+        });
+        next();
+    });
+
     // 健康检查
     router.get('/health', (req, res) => {
         res.json({
@@ -1333,7 +1355,9 @@ async function init(router) {
                 character: { id: character.id, name: character.name },
                 greeting,
                 greetingsCount: allGreetings.length,
-                currentGreetingIndex: 0
+                currentGreetingIndex: 0,
+                // 全部开场白（已替换宏），供 bot 在后台预合成语音
+                greetings: allGreetings.map(g => replaceMacros(g, character, 'User'))
             });
         } catch (error) {
             res.status(500).json({ success: false, error: error.message });
@@ -1536,6 +1560,7 @@ async function init(router) {
 
     // 发送消息
     router.post('/send', async (req, res) => {
+        const receivedAt = Date.now();
         try {
             const { message, user, telegramUserId, llmModel } = req.body;
 
@@ -1573,12 +1598,16 @@ async function init(router) {
                 effectiveModel
             );
 
+            tlog(req, `prompt built in ${Date.now() - receivedAt}ms (${messages.length} messages)`);
+
             // 调用 LLM
             let aiContent;
+            const llmStartedAt = Date.now();
             try {
                 aiContent = await callLLMApi(messages, preset, effectiveModel);
+                tlog(req, `LLM reply in ${Date.now() - llmStartedAt}ms`);
             } catch (llmError) {
-                console.error('[TG] LLM error:', llmError.message);
+                terror(req, 'LLM error:', llmError.message);
                 return res.status(500).json({
                     success: false,
                     error: `LLM error: ${llmError.message}`
@@ -1606,13 +1635,14 @@ async function init(router) {
             });
 
         } catch (error) {
-            console.error('[TG] Send error:', error);
+            terror(req, 'Send error:', error);
             res.status(500).json({ success: false, error: error.message });
         }
     });
 
     // 发送消息（流式 SSE）
     router.post('/send/stream', async (req, res) => {
+        const receivedAt = Date.now();
         res.setHeader('Content-Type', 'text/event-stream; charset=utf-8');
         res.setHeader('Cache-Control', 'no-cache, no-transform');
         res.setHeader('Connection', 'keep-alive');
@@ -1667,14 +1697,23 @@ async function init(router) {
                 effectiveModel
             );
 
-            res.write(`data: ${JSON.stringify({ started: true })}\n\n`);
+            // promptMs 供 bot 记录 prompt 构建的 span
+            const promptMs = Date.now() - receivedAt;
+            tlog(req, `prompt built in ${promptMs}ms (${messages.length} messages)`);
+            res.write(`data: ${JSON.stringify({ started: true, promptMs })}\n\n`);
 
             let rawContent = '';
+            const llmStartedAt = Date.now();
+            let firstByteLogged = false;
             try {
                 rawContent = await callLLMApiStream(
                     messages,
                     preset,
                     (delta) => {
+                        if (!firstByteLogged) {
+                            firstByteLogged = true;
+                            tlog(req, `LLM first byte in ${Date.now() - llmStartedAt}ms`);
+                        }
                         res.write(`data: ${JSON.stringify({ delta })}\n\n`);
                         if (typeof res.flush === 'function') res.flush();
                     },
@@ -1682,7 +1721,7 @@ async function init(router) {
                     effectiveModel
                 );
             } catch (llmError) {
-                console.error('[TG] Stream LLM error:', llmError.message);
+                terror(req, 'Stream LLM error:', llmError.message);
                 res.write(`data: ${JSON.stringify({ error: `LLM error: ${llmError.message}` })}\n\n`);
                 clearInterval(keepAliveInterval);
                 return res.end();
@@ -1699,11 +1738,12 @@ async function init(router) {
                 session.chatHistory.splice(0, session.chatHistory.length - 100);
             }
 
+            tlog(req, `stream end after ${Date.now() - llmStartedAt}ms (${finalMessage.length} chars)`);
             res.write(`data: ${JSON.stringify({ done: true, message: finalMessage })}\n\n`);
             clearInterval(keepAliveInterval);
             return res.end();
         } catch (error) {
-            console.error('[TG] Stream send error:', error);
+            terror(req, 'Stream send error:', error);
             res.write(`data: ${JSON.stringify({ error: error.message })}\n\n`);
             clearInterval(keepAliveInterval);
             return res.end();
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+压测用的假服务：SillyTavern 插件 SSE 接口 + Telegram Bot API
+
+- 假插件：`POST {prefix}/send/stream` 按配置的 token 速率吐 SSE（started / delta / done），
+  回复末尾带 FINAL_MARK，便于统计“最终文本”送达时间；--replay 时改为按原始节奏回放
+  TG_SSE_RECORD_DIR 录下的真实流（可用 --replay-speed 缩放）
+- 假 Bot API：`/bot<token>/<method>`，按会话与全局令牌桶限流，超限返回 429 + retry_after；
+  同内容重复编辑返回 400 "message is not modified"，与真实 Telegram 行为一致
+- `GET /__stats` 返回调用计数与每个会话的事件时间线，`POST /__reset` 清空
+
+只依赖标准库，单独作为子进程运行，避免占用被测 Bot 进程的 CPU 与内存：
+
+    python bench/fake_servers.py --tokens-per-sec 30 --reply-chars 600
+    # stdout 第一行输出 {"st_port": ..., "bot_api_port": ...}
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import math
+import re
+import sys
+import time
+from collections import defaultdict
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs
+
+PLUGIN_API_BASE = '/api/plugins/telegram-integration'
+
+# 回复结束标记：包含它的 sendMessage / editMessageText 视为最终文本已送达
+FINAL_MARK = '▲'
+
+Body = Union[bytes, AsyncIterator[bytes]]
+Response = Tuple[int, str, Body]
+
+
+def _json_response(payload: Any, status: int = 200) -> Response:
+    return status, 'application/json', json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+class MiniHTTPServer:
+    """最小 HTTP/1.1 服务：支持 keep-alive、chunked 请求体与 chunked 流式响应"""
+
+    async def handle(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes) -> Response:
+        raise NotImplementedError
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._serve, host, port, backlog=1024)
+        return self._server.sockets[0].getsockname()[1]
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        parts = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                # 丢弃 trailer
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(parts)
+            parts.append(await reader.readexactly(size))
+            await reader.readline()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+
+                if headers.get('transfer-encoding', '').lower() == 'chunked':
+                    body = await self._read_chunked(reader)
+                else:
+                    body = await reader.readexactly(int(headers.get('content-length') or 0))
+
+                path, _, query = target.partition('?')
+                status, content_type, payload = await self.handle(method, path, query, headers, body)
+                head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n"
+                if isinstance(payload, bytes):
+                    writer.write(f"{head}Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload)
+                else:
+                    writer.write(f"{head}Transfer-Encoding: chunked\r\nCache-Control: no-cache\r\n\r\n".encode('latin-1'))
+                    async for piece in payload:
+                        writer.write(f"{len(piece):x}\r\n".encode('latin-1') + piece + b'\r\n')
+                        await writer.drain()
+                    writer.write(b'0\r\n\r\n')
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def load_recordings(path: str) -> List[List[list]]:
+    """读取 bot.py 录制的 SSE 流（单个文件或目录下的全部 *.json.gz），并在最后一段文本后追加 FINAL_MARK。"""
+    target = Path(path)
+    files = sorted(target.glob('*.json.gz')) if target.is_dir() else [target]
+    recordings = []
+    for file in files:
+        events = json.loads(gzip.decompress(file.read_bytes()))['events']
+        last_delta = None
+        for offset_ms, event in events:
+            if isinstance(event.get('delta'), str):
+                last_delta = event
+            if event.get('done') and isinstance(event.get('message'), str):
+                event['message'] += FINAL_MARK
+        if last_delta is not None:
+            last_delta['delta'] += FINAL_MARK
+        recordings.append(events)
+    if not recordings:
+        raise SystemExit(f'no recordings found at {path}')
+    return recordings
+
+
+class FakeSillyTavern(MiniHTTPServer):
+    """假插件：按固定速率流式输出回复，或回放录制的真实流"""
+
+    def __init__(self, *, tokens_per_sec: float, chars_per_token: int, reply_chars: int, first_token_ms: int,
+                 recordings: Optional[List[List[list]]] = None, replay_speed: float = 1.0):
+        self.token_interval = 1.0 / tokens_per_sec if tokens_per_sec > 0 else 0.0
+        self.chars_per_token = max(1, chars_per_token)
+        self.first_token_s = max(0, first_token_ms) / 1000.0
+        filler = '她轻轻推开门，夜风带着雨后的潮气涌进来。'
+        # Bot 最终编辑会截断到 4000 字，结束标记必须落在截断范围内
+        size = max(1, min(reply_chars, 3900) - 1)
+        self.reply = (filler * (size // len(filler) + 1))[:size] + FINAL_MARK
+        self.recordings = recordings or []
+        self.replay_speed = replay_speed if replay_speed > 0 else 1.0
+        self.requests = 0
+
+    @staticmethod
+    def _event(payload: Dict[str, Any]) -> bytes:
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+
+    async def _replay(self, events: List[list]) -> AsyncIterator[bytes]:
+        started = time.monotonic()
+        for offset_ms, payload in events:
+            delay = started + offset_ms / 1000.0 / self.replay_speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield self._event(payload)
+
+    async def _sse(self) -> AsyncIterator[bytes]:
+        event = self._event
+        yield event({'started': True, 'promptMs': 0})
+        await asyncio.sleep(self.first_token_s)
+        for i in range(0, len(self.reply), self.chars_per_token):
+            yield event({'delta': self.reply[i:i + self.chars_per_token]})
+            await asyncio.sleep(self.token_interval)
+        yield event({'done': True, 'message': self.reply})
+
+    async def handle(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes) -> Response:
+        if not path.startswith(PLUGIN_API_BASE):
+            return _json_response({'error': 'not found'}, 404)
+        route = path[len(PLUGIN_API_BASE):] or '/'
+        if method == 'POST' and route == '/send/stream':
+            self.requests += 1
+            if self.recordings:
+                # 按请求顺序轮流使用录制的流
+                events = self.recordings[(self.requests - 1) % len(self.recordings)]
+                return 200, 'text/event-stream', self._replay(events)
+            return 200, 'text/event-stream', self._sse()
+        if method == 'POST' and route == '/send':
+            self.requests += 1
+            tokens = math.ceil(len(self.reply) / self.chars_per_token)
+            await asyncio.sleep(self.first_token_s + tokens * self.token_interval)
+            return _json_response({'success': True, 'message': self.reply})
+        if route == '/tts':
+            return _json_response({'error': 'tts disabled in load test'}, 404)
+        return _json_response({'success': True})
+
+
+class _TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """返回拿到一个令牌还需等待的秒数（0 表示可以立即发送）"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class FakeBotAPI(MiniHTTPServer):
+    """假 Telegram Bot API：记录调用并模拟 flood control"""
+
+    # 计入限流的发送/编辑类方法；sendChatAction 等不计入
+    LIMITED_METHODS = {'sendMessage', 'editMessageText', 'sendVoice', 'sendPhoto', 'sendDocument'}
+
+    def __init__(self, *, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.reset()
+
+    def reset(self) -> None:
+        self.global_bucket = _TokenBucket(self.global_rate, self.global_burst)
+        self.chat_buckets: Dict[int, _TokenBucket] = {}
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.bytes_in: Dict[str, int] = defaultdict(int)
+        self.retry_after: Dict[str, int] = defaultdict(int)
+        self.not_modified = 0
+        self.events: Dict[int, list] = defaultdict(list)
+        self.message_ids: Dict[int, int] = defaultdict(int)
+        self.last_text: Dict[Tuple[int, int], int] = {}
+
+    @staticmethod
+    def _params(headers: Dict[str, str], body: bytes) -> Dict[str, str]:
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body or b'{}').items()}
+        if content_type.startswith('multipart/form-data'):
+            # 只取文本字段，文件内容忽略
+            fields = re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body)
+            return {k.decode(): v.decode('utf-8', 'replace') for k, v in fields}
+        return {k: v[-1] for k, v in parse_qs(body.decode('utf-8', 'replace')).items()}
+
+    def _throttle(self, chat_id: int) -> Optional[int]:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = _TokenBucket(self.chat_rate, self.chat_burst)
+        wait = max(bucket.wait_time(), self.global_bucket.wait_time())
+        if wait > 0:
+            return max(1, math.ceil(wait))
+        bucket.take()
+        self.global_bucket.take()
+        return None
+
+    @staticmethod
+    def _message(chat_id: int, message_id: int, **extra: Any) -> Dict[str, Any]:
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'},
+            **extra,
+        }
+
+    async def handle(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes) -> Response:
+        if path == '/__stats':
+            return _json_response({
+                'calls': self.calls,
+                'bytesIn': self.bytes_in,
+                'retryAfter': self.retry_after,
+                'notModified': self.not_modified,
+                'events': self.events,
+            })
+        if path == '/__reset':
+            self.reset()
+            return _json_response({'ok': True})
+
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        self.bytes_in[api_method] += len(body)
+        if api_method == 'getMe':
+            return _json_response({'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot',
+                'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False,
+            }})
+        if api_method not in self.LIMITED_METHODS:
+            return _json_response({'ok': True, 'result': True})
+
+        params = self._params(headers, body)
+        chat_id = int(params.get('chat_id') or 0)
+        retry_after = self._throttle(chat_id)
+        if retry_after is not None:
+            self.retry_after[api_method] += 1
+            return _json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after},
+            }, 429)
+
+        text = params.get('text', '')
+        if api_method == 'editMessageText':
+            message_id = int(params.get('message_id') or 0)
+            if self.last_text.get((chat_id, message_id)) == hash(text):
+                self.not_modified += 1
+                return _json_response({
+                    'ok': False,
+                    'error_code': 400,
+                    'description': 'Bad Request: message is not modified',
+                }, 400)
+        else:
+            self.message_ids[chat_id] += 1
+            message_id = self.message_ids[chat_id]
+        self.last_text[(chat_id, message_id)] = hash(text)
+        self.events[chat_id].append([time.time(), api_method, FINAL_MARK in text])
+
+        extra: Dict[str, Any] = {'text': text} if text else {}
+        if api_method == 'sendVoice':
+            extra['voice'] = {'file_id': f'voice-{chat_id}-{message_id}', 'file_unique_id': f'u{chat_id}-{message_id}', 'duration': 1}
+        return _json_response({'ok': True, 'result': self._message(chat_id, message_id, **extra)})
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group('fake servers')
+    group.add_argument('--tokens-per-sec', type=float, default=30.0, help='假插件每秒输出的 token 数（默认 30）')
+    group.add_argument('--chars-per-token', type=int, default=3, help='每个 token 的字符数（默认 3）')
+    group.add_argument('--reply-chars', type=int, default=600, help='每条回复的字符数（默认 600，上限 3900）')
+    group.add_argument('--first-token-ms', type=int, default=300, help='首个 token 前的延迟（默认 300ms）')
+    group.add_argument('--chat-rate', type=float, default=1.0, help='单会话限流：每秒令牌数（默认 1，0=不限）')
+    group.add_argument('--chat-burst', type=float, default=5.0, help='单会话限流：桶容量（默认 5）')
+    group.add_argument('--global-rate', type=float, default=30.0, help='全局限流：每秒令牌数（默认 30，0=不限）')
+    group.add_argument('--global-burst', type=float, default=30.0, help='全局限流：桶容量（默认 30）')
+    group.add_argument('--replay', default='', help='回放 TG_SSE_RECORD_DIR 录制的流（文件或目录），忽略上面的合成参数')
+    group.add_argument('--replay-speed', type=float, default=1.0, help='回放速度倍率（默认 1，2=两倍速）')
+
+
+async def serve(args: argparse.Namespace) -> None:
+    st = FakeSillyTavern(
+        tokens_per_sec=args.tokens_per_sec,
+        chars_per_token=args.chars_per_token,
+        reply_chars=args.reply_chars,
+        first_token_ms=args.first_token_ms,
+        recordings=load_recordings(args.replay) if args.replay else None,
+        replay_speed=args.replay_speed,
+    )
+    bot_api = FakeBotAPI(
+        chat_rate=args.chat_rate,
+        chat_burst=args.chat_burst,
+        global_rate=args.global_rate,
+        global_burst=args.global_burst,
+    )
+    st_port = await st.start()
+    bot_api_port = await bot_api.start()
+    print(json.dumps({'st_port': st_port, 'bot_api_port': bot_api_port}), flush=True)
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='SillyTavern 插件与 Telegram Bot API 的假服务')
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
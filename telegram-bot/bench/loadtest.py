@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+离线压测：在本进程内跑真实的 bot.py handler，对接子进程中的假插件与假 Bot API
+
+    cd telegram-bot
+    python bench/loadtest.py --users 200 --messages 3 --tokens-per-sec 30 --reply-chars 600
+
+每个虚拟用户顺序发送 N 条消息（上一条 handler 结束后再发下一条），update 经
+Application.update_processor 分发，受 TG_CONCURRENT_UPDATES 约束，与线上一致。
+
+报告：吞吐（回复/秒）、首次编辑耗时与最终文本耗时的 p50/p95/p99、Bot API 调用计数与请求字节数
+（含 429 次数）、本进程峰值 RSS。`--json` 输出机器可读结果，`--compare` 与之前保存的结果逐项对比。
+bot.py 的环境变量（TELEGRAM_STREAM_EDIT_INTERVAL_MS、TG_CONCURRENT_UPDATES 等）照常生效。
+
+用 TG_SSE_RECORD_DIR 录下真实的插件流后，`--replay <目录>` 按原始节奏回放（`--replay-speed` 缩放），
+不同版本的 bot 在同一份流上的编辑次数、字节数和耗时可以直接比较：
+
+    python bench/loadtest.py --users 1 --messages 20 --replay recordings/ --json before.json
+    python bench/loadtest.py --users 1 --messages 20 --replay recordings/ --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BENCH_DIR = Path(__file__).resolve().parent
+BOT_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(BENCH_DIR))
+
+import fake_servers  # noqa: E402
+
+BENCH_TOKEN = '123456:bench'
+USER_ID_BASE = 900_000_000
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {f'p{p}': percentile(values, p) for p in (50, 95, 99)}
+
+
+def start_fake_servers(args: argparse.Namespace) -> tuple[subprocess.Popen, Dict[str, int]]:
+    probe = argparse.ArgumentParser(add_help=False)
+    fake_servers.add_arguments(probe)
+    argv = []
+    for action in probe._actions:
+        argv += [action.option_strings[0], str(getattr(args, action.dest))]
+    proc = subprocess.Popen(
+        [sys.executable, str(BENCH_DIR / 'fake_servers.py'), *argv],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = proc.stdout.readline()
+    if not line:
+        proc.wait()
+        raise SystemExit('fake servers failed to start')
+    return proc, json.loads(line)
+
+
+def make_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id - USER_ID_BASE}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+            'from': user,
+            'text': text,
+        },
+    }
+
+
+def prepare_environment(ports: Dict[str, int], workdir: str) -> None:
+    """bot.py 在导入时读取配置，必须在 import bot 之前调用。"""
+    os.environ['TELEGRAM_BOT_TOKEN'] = BENCH_TOKEN
+    os.environ['SILLYTAVERN_URL'] = f"http://127.0.0.1:{ports['st_port']}"
+    os.environ['TG_AUTH_DB_PATH'] = os.path.join(workdir, 'auth.json')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('TG_METRICS_PORT', '0')
+    sys.path.insert(0, str(BOT_DIR))
+
+
+async def start_bot(bot_api_port: int):
+    import bot
+
+    app = bot.build_application(BENCH_TOKEN, base_url=f'http://127.0.0.1:{bot_api_port}/bot')
+    await app.initialize()
+    await bot.post_init(app)
+    return bot, app
+
+
+async def stop_bot(bot, app) -> None:
+    await bot.post_shutdown(app)
+    await app.shutdown()
+
+
+_update_ids = iter(range(1, 1 << 62))
+
+
+async def send_text(app, user_id: int, text: str) -> None:
+    """像 Application 的 update 分发那样处理一条私聊文本消息，返回时 handler 已结束。"""
+    from telegram import Update
+
+    update = Update.de_json(make_update(next(_update_ids), user_id, text), app.bot)
+    await app.update_processor.process_update(update, app.process_update(update))
+
+
+async def fetch_stats(bot_api_port: int, *, reset: bool = False) -> Dict[str, Any]:
+    import httpx
+
+    async with httpx.AsyncClient() as client:
+        stats = (await client.get(f'http://127.0.0.1:{bot_api_port}/__stats')).json()
+        if reset:
+            await client.post(f'http://127.0.0.1:{bot_api_port}/__reset')
+    return stats
+
+
+async def run(args: argparse.Namespace, bot_api_port: int) -> Dict[str, Any]:
+    bot, app = await start_bot(bot_api_port)
+    user_ids = [USER_ID_BASE + i for i in range(args.users)]
+    for user_id in user_ids:
+        await bot.auth_store.approve(user_id, approved_by=0, note='loadtest')
+
+    rounds: List[Dict[str, Any]] = []
+
+    async def virtual_user(index: int, user_id: int) -> None:
+        if args.ramp_s > 0:
+            await asyncio.sleep(args.ramp_s * index / max(1, args.users))
+        for n in range(args.messages):
+            started = time.time()
+            await send_text(app, user_id, f'load test message {n}')
+            rounds.append({'chat': user_id, 'start': started, 'end': time.time()})
+            if args.think_ms > 0:
+                await asyncio.sleep(args.think_ms / 1000.0)
+
+    wall_started = time.monotonic()
+    await asyncio.gather(*(virtual_user(i, uid) for i, uid in enumerate(user_ids)))
+    wall = time.monotonic() - wall_started
+
+    await stop_bot(bot, app)
+    stats = await fetch_stats(bot_api_port)
+
+    first_edit: List[float] = []
+    final: List[float] = []
+    handler: List[float] = []
+    completed = 0
+    for item in rounds:
+        handler.append(item['end'] - item['start'])
+        # 同一用户的消息是串行的，时间窗口内的事件都属于这一轮
+        window = [ev for ev in stats['events'].get(str(item['chat']), []) if item['start'] <= ev[0] <= item['end']]
+        edits = [ev[0] for ev in window if ev[1] == 'editMessageText']
+        finals = [ev[0] for ev in window if ev[2]]
+        if edits:
+            first_edit.append(edits[0] - item['start'])
+        if finals:
+            final.append(finals[0] - item['start'])
+            completed += 1
+
+    return {
+        'users': args.users,
+        'messagesPerUser': args.messages,
+        'rounds': len(rounds),
+        'completed': completed,
+        'failed': len(rounds) - completed,
+        'wallSeconds': wall,
+        'throughput': completed / wall if wall > 0 else 0.0,
+        'timeToFirstEdit': summarize(first_edit),
+        'timeToFinal': summarize(final),
+        'handlerTime': summarize(handler),
+        'botApiCalls': stats['calls'],
+        'botApiBytes': stats['bytesIn'],
+        'editsPerReply': stats['calls'].get('editMessageText', 0) / len(rounds) if rounds else 0.0,
+        'retryAfter': stats['retryAfter'],
+        'notModified': stats['notModified'],
+        # Linux 下 ru_maxrss 单位为 KiB
+        'peakRssMiB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def _fmt_ms(summary: Dict[str, Optional[float]]) -> str:
+    return '  '.join(
+        f"{name}={'n/a' if value is None else f'{value * 1000:.0f}ms':>8}" for name, value in summary.items()
+    )
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    calls = ' '.join(f'{k}={v}' for k, v in sorted(report['botApiCalls'].items()))
+    throttled = ' '.join(f'{k}={v}' for k, v in sorted(report['retryAfter'].items())) or '0'
+    print(f"users={report['users']} messages/user={report['messagesPerUser']} rounds={report['rounds']} "
+          f"completed={report['completed']} failed={report['failed']} wall={report['wallSeconds']:.1f}s")
+    print(f"throughput          {report['throughput']:.2f} replies/s")
+    print(f"time-to-first-edit  {_fmt_ms(report['timeToFirstEdit'])}")
+    print(f"time-to-final       {_fmt_ms(report['timeToFinal'])}")
+    print(f"handler time        {_fmt_ms(report['handlerTime'])}")
+    print(f"bot api calls       {calls}")
+    print(f"bot api bytes       {sum(report['botApiBytes'].values())}  (edits/reply: {report['editsPerReply']:.1f})")
+    print(f"429 retry_after     {throttled}  (not modified: {report['notModified']})")
+    print(f"peak RSS            {report['peakRssMiB']:.1f} MiB")
+
+
+# 对比项：(名称, 取值函数, 数值越小越好)
+_COMPARE_FIELDS = [
+    ('wall time (s)', lambda r: r['wallSeconds'], True),
+    ('throughput (replies/s)', lambda r: r['throughput'], False),
+    ('first edit p50 (ms)', lambda r: (r['timeToFirstEdit']['p50'] or 0) * 1000, True),
+    ('first edit p95 (ms)', lambda r: (r['timeToFirstEdit']['p95'] or 0) * 1000, True),
+    ('final p50 (ms)', lambda r: (r['timeToFinal']['p50'] or 0) * 1000, True),
+    ('final p95 (ms)', lambda r: (r['timeToFinal']['p95'] or 0) * 1000, True),
+    ('edits/reply', lambda r: r['editsPerReply'], True),
+    ('bot api calls', lambda r: sum(r['botApiCalls'].values()), True),
+    ('bot api bytes', lambda r: sum(r.get('botApiBytes', {}).values()), True),
+    ('429 responses', lambda r: sum(r['retryAfter'].values()), True),
+    ('failed replies', lambda r: r['failed'], True),
+    ('peak RSS (MiB)', lambda r: r['peakRssMiB'], True),
+]
+
+
+def print_comparison(before: Dict[str, Any], after: Dict[str, Any]) -> None:
+    print(f"\n{'metric':<24} {'before':>12} {'after':>12} {'change':>9}")
+    for name, value, lower_is_better in _COMPARE_FIELDS:
+        old, new = value(before), value(after)
+        change = f"{(new - old) * 100 / old:+.1f}%" if old else ('n/a' if new else '0.0%')
+        worse = old and ((new > old) if lower_is_better else (new < old))
+        print(f"{name:<24} {old:>12.1f} {new:>12.1f} {change:>9}{'  !' if worse else ''}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='bot.py 离线压测')
+    parser.add_argument('--users', type=int, default=50, help='虚拟用户数（默认 50）')
+    parser.add_argument('--messages', type=int, default=3, help='每个用户发送的消息数（默认 3）')
+    parser.add_argument('--ramp-s', type=float, default=0.0, help='在该时长内均匀启动用户（默认 0，同时启动）')
+    parser.add_argument('--think-ms', type=int, default=0, help='同一用户两条消息之间的间隔（默认 0）')
+    parser.add_argument('--json', dest='json_path', default='', help='把报告写入 JSON 文件')
+    parser.add_argument('--compare', default='', help='与之前 --json 保存的报告对比')
+    fake_servers.add_arguments(parser)
+    args = parser.parse_args()
+
+    proc, ports = start_fake_servers(args)
+    workdir = tempfile.mkdtemp(prefix='tg-loadtest-')
+    try:
+        prepare_environment(ports, workdir)
+        report = asyncio.run(run(args, ports['bot_api_port']))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print_report(report)
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text(encoding='utf-8')), report)
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(report, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
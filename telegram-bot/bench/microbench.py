@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+文本处理函数的微基准：statusblock 解析/渲染、分页、TTS 清理、预格式化分块
+
+    cd telegram-bot
+    python bench/microbench.py                     # 与基线对比，退化则退出码为 1
+    python bench/microbench.py --update-baseline   # 重新生成基线
+    python bench/microbench.py --filter stream     # 只跑名称包含 stream 的用例
+
+语料用固定种子生成，分 small/medium/large 三档；stream.* 用例模拟流式输出，
+每 --stream-step 个字符对当前前缀做一次与 handler 每个 tick 相同的解析+渲染。
+
+每个用例报告 ops/sec（多轮取最好）和单次调用的内存分配峰值（tracemalloc）。
+分配峰值与机器无关，容差较小；ops/sec 受机器影响，基线应在同一台机器上生成。
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+BOT_DIR = BENCH_DIR.parent
+BASELINE_PATH = BENCH_DIR / 'microbench_baseline.json'
+
+# bot.py 导入时会读取配置并打开授权库，指向临时目录避免碰到 /app/data
+os.environ.setdefault('TG_AUTH_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='tg-microbench-'), 'auth.json'))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, str(BOT_DIR))
+
+import bot  # noqa: E402
+
+SIZES = {
+    # 档位: (状态字段数, 正文字符数, 长文字符数)
+    'small': (8, 600, 2_000),
+    'medium': (30, 3_000, 20_000),
+    'large': (120, 12_000, 100_000),
+}
+
+_SENTENCES = [
+    '她轻轻推开门，夜风带着雨后的潮气涌进来。',
+    '**你注意到**桌上的信封还没有拆开。',
+    '远处传来钟声，一下，两下，像是在数着什么。',
+    '"我们没有多少时间了。"他低声说道。',
+    '烛火摇曳，墙上的影子被拉得很长。',
+    'The rain kept falling, and *nobody* said a word.',
+    '街角的小贩收起摊位，`灯笼`一盏盏熄灭。',
+]
+_STATUS_KEYS = ['好感度', '体力', '心情', '衣着', '姿态', '随身物品', '关系', '目标', '秘密', '伤势']
+_BODY_STOP_TAGS = ["<TIPS>", "<变量>", "<秘氛>", "<邪名>", "</stausblock>", "</statusblock>"]
+
+
+def _prose(rng: random.Random, chars: int) -> str:
+    parts: List[str] = []
+    size = 0
+    while size < chars:
+        sentence = rng.choice(_SENTENCES)
+        if rng.random() < 0.15:
+            sentence += '\n\n'
+        parts.append(sentence)
+        size += len(sentence)
+    return ''.join(parts)[:chars]
+
+
+def make_statusblock(rng: random.Random, fields: int, body_chars: int) -> str:
+    lines = [
+        '```xml',
+        '<statusblock>',
+        '<天气>小雨，气温 14℃</天气>',
+        '<地点>旧城区·钟楼下的咖啡馆</地点>',
+        '<日期>2026年3月14日</日期>',
+        '<时间>21:47</时间>',
+        f'<正文>{_prose(rng, body_chars)}</正文>',
+    ]
+    for i in range(fields):
+        key = f'{_STATUS_KEYS[i % len(_STATUS_KEYS)]}{i // len(_STATUS_KEYS) or ""}'
+        lines.append(f'<{key}>{_prose(rng, rng.randint(8, 60))}</{key}>')
+    lines.append('<TIPS>\n1. 询问信封的来历\n2. 跟随钟声前往钟楼\n3. 留在原地观察</TIPS>')
+    lines.append('</statusblock>')
+    lines.append('```')
+    return '\n'.join(lines)
+
+
+def build_corpora(seed: int) -> Dict[str, Dict[str, Any]]:
+    rng = random.Random(seed)
+    corpora: Dict[str, Dict[str, Any]] = {}
+    for size, (fields, body_chars, prose_chars) in SIZES.items():
+        statusblock = make_statusblock(rng, fields, body_chars)
+        corpora[size] = {
+            'statusblock': statusblock,
+            'fields': bot.parse_statusblock(statusblock) or {},
+            'prose': _prose(rng, prose_chars),
+        }
+    return corpora
+
+
+def _stream_tick(buffer: str) -> None:
+    """与 handle_message_streaming_ui 每个 tick 的文本处理一致"""
+    fields = bot.parse_status_fields_partial(buffer)
+    bot.render_status_panel_html(fields)
+    if "</tips>" in buffer.lower():
+        tips = bot.extract_partial_between(buffer, "<TIPS>", "</TIPS>")
+        if tips is not None:
+            bot.render_tips_html(tips)
+    body = bot.extract_partial_between(buffer, "<正文>", "</正文>", stop_tags=_BODY_STOP_TAGS)
+    if body is not None:
+        for page in bot.split_text_pages(body, max_chars=3500):
+            bot.render_body_html(page)
+
+
+def _stream(text: str, step: int) -> Callable[[], None]:
+    prefixes = [text[:i] for i in range(step, len(text) + step, step)]
+
+    def run() -> None:
+        for prefix in prefixes:
+            _stream_tick(prefix)
+    return run
+
+
+def build_cases(corpora: Dict[str, Dict[str, Any]], stream_step: int) -> List[Tuple[str, Callable[[], Any]]]:
+    cases: List[Tuple[str, Callable[[], Any]]] = []
+    for size, c in corpora.items():
+        sb, fields, prose = c['statusblock'], c['fields'], c['prose']
+        body = fields.get('正文', '')
+        cases += [
+            (f'parse_statusblock.{size}', lambda sb=sb: bot.parse_statusblock(sb)),
+            (f'parse_status_fields_partial.{size}', lambda sb=sb: bot.parse_status_fields_partial(sb)),
+            (f'extract_partial_between.{size}',
+             lambda sb=sb: bot.extract_partial_between(sb, "<正文>", "</正文>", stop_tags=_BODY_STOP_TAGS)),
+            (f'split_text_pages.{size}', lambda prose=prose: bot.split_text_pages(prose, max_chars=3500)),
+            (f'render_status_panel_html.{size}', lambda fields=fields: bot.render_status_panel_html(fields)),
+            (f'render_body_html.{size}', lambda body=body: bot.render_body_html(body)),
+            (f'render_full_state_messages.{size}',
+             lambda fields=fields: bot.render_full_state_messages(fields, exclude_keys={"正文"})),
+            (f'render_statusblock_messages.{size}', lambda fields=fields: bot.render_statusblock_messages(fields)),
+            (f'strip_markdown_for_tts.{size}', lambda prose=prose: bot.strip_markdown_for_tts(prose)),
+            (f'chunk_preformatted_html.{size}', lambda sb=sb, prose=prose: bot.chunk_preformatted_html(sb + prose)),
+            (f'stream.{size}', _stream(sb, stream_step)),
+        ]
+    return cases
+
+
+def measure(func: Callable[[], Any], *, min_time: float, repeat: int) -> Dict[str, float]:
+    # 先标定单轮次数，使每轮耗时不少于 min_time
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'ops_per_sec': number / best, 'alloc_peak_bytes': max(0, peak - base)}
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], *,
+            tolerance: float, alloc_tolerance: float) -> List[str]:
+    regressions: List[str] = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: ops/sec {result['ops_per_sec']:.1f} < baseline {base['ops_per_sec']:.1f} (-{tolerance:.0%})"
+            )
+        # 小于 1KiB 的波动不计，避免 small 档位被解释器内部缓存干扰
+        if result['alloc_peak_bytes'] > base['alloc_peak_bytes'] * (1 + alloc_tolerance) + 1024:
+            regressions.append(
+                f"{name}: alloc peak {result['alloc_peak_bytes']:.0f}B > baseline {base['alloc_peak_bytes']:.0f}B "
+                f"(+{alloc_tolerance:.0%})"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='bot.py 文本处理微基准')
+    parser.add_argument('--filter', default='', help='只运行名称包含该子串的用例')
+    parser.add_argument('--min-time', type=float, default=0.2, help='每轮最少耗时（秒，默认 0.2）')
+    parser.add_argument('--repeat', type=int, default=5, help='轮数，取最好的一轮（默认 5）')
+    parser.add_argument('--stream-step', type=int, default=16, help='流式模拟的前缀步长（字符，默认 16）')
+    parser.add_argument('--seed', type=int, default=20260314, help='语料生成种子')
+    parser.add_argument('--baseline', default=str(BASELINE_PATH), help='基线文件路径')
+    parser.add_argument('--update-baseline', action='store_true', help='用本次结果覆盖基线')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='ops/sec 允许下降的比例（默认 0.3）')
+    parser.add_argument('--alloc-tolerance', type=float, default=0.1, help='分配峰值允许上升的比例（默认 0.1）')
+    args = parser.parse_args()
+
+    cases = [(n, f) for n, f in build_cases(build_corpora(args.seed), args.stream_step) if args.filter in n]
+    results: Dict[str, Dict[str, float]] = {}
+    print(f"{'case':<40} {'ops/sec':>12} {'alloc peak':>12}")
+    for name, func in cases:
+        results[name] = measure(func, min_time=args.min_time, repeat=max(1, args.repeat))
+        print(f"{name:<40} {results[name]['ops_per_sec']:>12.1f} {results[name]['alloc_peak_bytes'] / 1024:>10.1f}KiB")
+
+    baseline_path = Path(args.baseline)
+    if args.update_baseline:
+        stored: Dict[str, Any] = {}
+        if baseline_path.exists():
+            stored = json.loads(baseline_path.read_text(encoding='utf-8')).get('cases', {})
+        stored.update({name: {k: round(v, 1) for k, v in r.items()} for name, r in results.items()})
+        baseline_path.write_text(json.dumps({
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'streamStep': args.stream_step,
+            'seed': args.seed,
+            'cases': dict(sorted(stored.items())),
+        }, indent=2, ensure_ascii=False) + '\n', encoding='utf-8')
+        print(f"baseline written to {baseline_path}")
+        return
+
+    if not baseline_path.exists():
+        print(f"no baseline at {baseline_path}; run with --update-baseline first")
+        return
+    baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+    if baseline.get('seed') != args.seed or baseline.get('streamStep') != args.stream_step:
+        print('corpus parameters differ from the baseline; comparison skipped')
+        return
+    regressions = compare(results, baseline.get('cases', {}),
+                          tolerance=args.tolerance, alloc_tolerance=args.alloc_tolerance)
+    if regressions:
+        print('\nREGRESSIONS:')
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"\nno regressions against {baseline_path.name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+内存浸泡测试：长时间运行离线压测，用户群体不断轮换，检测随用户数增长的内存
+
+    cd telegram-bot
+    python bench/soak.py --duration-s 7200 --active-users 50 --rotate-every-s 120
+
+同时在线 --active-users 个虚拟用户，每 --rotate-every-s 秒整批换成新的用户 ID（旧用户不再出现），
+模拟长期运行中不断有新用户到来。预热 --warmup-s 秒后取基准 tracemalloc 快照，之后每
+--snapshot-every-s 秒记录一次 RSS 与 Python 堆占用。
+
+结束时报告：增长最多的分配位置、稳态 RSS 与每个在线用户的 RSS，以及预热后每新增一个用户
+的堆增长（对各次采样的 堆占用-累计用户数 做线性回归取斜率，避免单次采样时在途请求的干扰）。
+堆增长超过 --budget-bytes-per-user 时退出码为 1。
+
+取快照会阻塞事件循环数秒，因此浸泡测试默认关闭 TG_LOOP_LAG_THRESHOLD_MS 卡顿检测。
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR))
+
+import fake_servers  # noqa: E402
+import loadtest  # noqa: E402
+
+# 快照中忽略解释器自身的分配
+_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+
+
+async def soak(args: argparse.Namespace, bot_api_port: int) -> Dict[str, Any]:
+    bot, app = await loadtest.start_bot(bot_api_port)
+    rss_idle = bot.process_rss_bytes()
+
+    users_seen = 0
+    generation = 0
+    started = time.monotonic()
+    deadline = started + args.duration_s
+    stop = asyncio.Event()
+
+    async def virtual_user(user_id: int, until: float) -> None:
+        n = 0
+        while time.monotonic() < until and not stop.is_set():
+            await loadtest.send_text(app, user_id, f'soak message {n}')
+            n += 1
+            await asyncio.sleep(args.think_ms / 1000.0)
+
+    async def population() -> None:
+        nonlocal users_seen, generation
+        while time.monotonic() < deadline:
+            until = min(deadline, time.monotonic() + args.rotate_every_s)
+            base = loadtest.USER_ID_BASE + generation * args.active_users
+            generation += 1
+            users_seen += args.active_users
+            await asyncio.gather(*(virtual_user(base + i, until) for i in range(args.active_users)))
+
+    samples: List[Dict[str, Any]] = []
+    baseline = None
+    baseline_users = 0
+
+    def record(elapsed: float) -> None:
+        current, _ = tracemalloc.get_traced_memory()
+        sample = {
+            'elapsedS': round(elapsed, 1),
+            'rssBytes': bot.process_rss_bytes(),
+            'tracedBytes': current,
+            'usersSeen': users_seen,
+        }
+        samples.append(sample)
+        print(f"[{sample['elapsedS']:>7.0f}s] rss={sample['rssBytes'] / 1048576:7.1f}MiB "
+              f"heap={current / 1048576:7.1f}MiB users={users_seen}", flush=True)
+
+    runner = asyncio.create_task(population())
+    try:
+        await asyncio.sleep(min(args.warmup_s, args.duration_s))
+        # 假 Bot API 的事件时间线会一直累积，定期清空以免拖慢它自身
+        await loadtest.fetch_stats(bot_api_port, reset=True)
+        baseline = take_snapshot()
+        baseline_users = users_seen
+        record(time.monotonic() - started)
+        while not runner.done():
+            await asyncio.wait({runner}, timeout=args.snapshot_every_s)
+            await loadtest.fetch_stats(bot_api_port, reset=True)
+            gc.collect()
+            record(time.monotonic() - started)
+    finally:
+        stop.set()
+        await runner
+    final = take_snapshot()
+    await loadtest.stop_bot(bot, app)
+
+    top = [
+        {
+            'site': str(stat.traceback[0]),
+            'sizeDiffBytes': stat.size_diff,
+            'countDiff': stat.count_diff,
+        }
+        for stat in final.compare_to(baseline, 'lineno')
+        if stat.size_diff > 0
+    ][:args.top]
+
+    steady = samples[1:] or samples
+    steady_rss = statistics.median(s['rssBytes'] for s in steady)
+    new_users = users_seen - baseline_users
+    heap_growth = samples[-1]['tracedBytes'] - samples[0]['tracedBytes']
+    xs = [s['usersSeen'] for s in samples]
+    if len(samples) >= 3 and len(set(xs)) > 1:
+        per_user = statistics.linear_regression(xs, [s['tracedBytes'] for s in samples]).slope
+    else:
+        per_user = heap_growth / new_users if new_users else 0.0
+    return {
+        'durationS': round(time.monotonic() - started, 1),
+        'activeUsers': args.active_users,
+        'usersSeen': users_seen,
+        'usersAfterWarmup': new_users,
+        'idleRssBytes': rss_idle,
+        'steadyRssBytes': steady_rss,
+        'rssPerActiveUserBytes': max(0.0, steady_rss - rss_idle) / max(1, args.active_users),
+        'heapGrowthBytes': heap_growth,
+        'heapGrowthPerUserBytes': per_user,
+        'budgetBytesPerUser': args.budget_bytes_per_user,
+        'topGrowth': top,
+        'samples': samples,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"\nduration={report['durationS']:.0f}s active users={report['activeUsers']} "
+          f"users seen={report['usersSeen']} (after warmup: {report['usersAfterWarmup']})")
+    print(f"RSS idle / steady     {report['idleRssBytes'] / 1048576:.1f} / {report['steadyRssBytes'] / 1048576:.1f} MiB")
+    print(f"RSS per active user   {report['rssPerActiveUserBytes'] / 1024:.1f} KiB")
+    print(f"heap growth           {report['heapGrowthBytes'] / 1024:.1f} KiB "
+          f"({report['heapGrowthPerUserBytes']:.0f} B per new user, budget {report['budgetBytesPerUser']} B)")
+    print("\ntop growing allocation sites:")
+    for item in report['topGrowth']:
+        print(f"  {item['sizeDiffBytes'] / 1024:+9.1f} KiB {item['countDiff']:+8d} blocks  {item['site']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='bot.py 内存浸泡测试')
+    parser.add_argument('--duration-s', type=float, default=3600, help='总时长（秒，默认 3600）')
+    parser.add_argument('--active-users', type=int, default=50, help='同时在线的虚拟用户数（默认 50）')
+    parser.add_argument('--rotate-every-s', type=float, default=120, help='每隔多少秒整批换成新用户（默认 120）')
+    parser.add_argument('--think-ms', type=int, default=2000, help='同一用户两条消息之间的间隔（默认 2000）')
+    parser.add_argument('--warmup-s', type=float, default=300, help='预热时长，之后取基准快照（默认 300）')
+    parser.add_argument('--snapshot-every-s', type=float, default=300, help='采样间隔（默认 300）')
+    parser.add_argument('--budget-bytes-per-user', type=int, default=4096,
+                        help='预热后每新增一个用户允许的堆增长（字节，默认 4096）')
+    parser.add_argument('--top', type=int, default=15, help='列出增长最多的分配位置数（默认 15）')
+    parser.add_argument('--json', dest='json_path', default='', help='把报告写入 JSON 文件')
+    fake_servers.add_arguments(parser)
+    parser.set_defaults(tokens_per_sec=200.0, reply_chars=300, first_token_ms=50, chat_rate=0.0, global_rate=0.0)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    proc, ports = loadtest.start_fake_servers(args)
+    workdir = tempfile.mkdtemp(prefix='tg-soak-')
+    try:
+        os.environ.setdefault('TG_LOOP_LAG_THRESHOLD_MS', '0')
+        loadtest.prepare_environment(ports, workdir)
+        report = asyncio.run(soak(args, ports['bot_api_port']))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print_report(report)
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(report, indent=2), encoding='utf-8')
+    if report['heapGrowthPerUserBytes'] > args.budget_bytes_per_user:
+        print(f"\nFAIL: heap growth per user {report['heapGrowthPerUserBytes']:.0f} B "
+              f"exceeds budget {args.budget_bytes_per_user} B")
+        sys.exit(1)
+    print('\nOK: heap growth per user within budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,24 +13,45 @@ import html
 import re
 import io
 import base64
+import gzip
+import zlib
 import hashlib
 import hmac
 import uuid
-from datetime import datetime
+import struct
+import statistics
+import bisect
+import signal
+import contextlib
+import contextvars
+import inspect
+import sys
+import threading
+import traceback
+from datetime import datetime, timedelta
 from urllib.parse import quote
-from typing import Dict, Any, AsyncIterator, Optional
+from collections import OrderedDict, deque
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, Collection, Hashable, Optional
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows：不支持共享模式
+    fcntl = None
+
 import httpx
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
-from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram import Bot, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    SimpleUpdateProcessor,
+    TypeHandler,
     filters
 )
 
@@ -41,6 +62,27 @@ SILLYTAVERN_URL = os.getenv('SILLYTAVERN_URL', 'http://sillytavern:8000')
 PLUGIN_API_BASE = '/api/plugins/telegram-integration'
 ALLOWED_USER_ID = int(os.getenv('ALLOWED_USER_ID', '0'))
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Webhook 模式下的 worker 进程数：>1 时前端进程只负责接收并按用户 ID 一致性哈希分发，
+# 各 worker 监听 127.0.0.1:TG_WORKER_PORT_BASE+i，授权库自动切换为共享模式
+TG_WEBHOOK_WORKERS = max(1, int(os.getenv('TG_WEBHOOK_WORKERS', '1')))
+TG_WORKER_PORT_BASE = int(os.getenv('TG_WORKER_PORT_BASE', '9100'))
+# 接收后等待处理的 update 上限（单进程为 update_queue + 并发上限前排队，多进程为前端每个 worker 的队列），
+# 超出后直接丢弃并应答 200，避免 Telegram 等待或重试
+TG_WEBHOOK_QUEUE_SIZE = int(os.getenv('TG_WEBHOOK_QUEUE_SIZE', '10000'))
+# Webhook secret token（X-Telegram-Bot-Api-Secret-Token），留空时由 bot token 派生；只允许 A-Z a-z 0-9 _ -
+TG_WEBHOOK_SECRET = os.getenv('TG_WEBHOOK_SECRET', '')
+# 由前端进程为 worker 设置（不需要手动配置）
+TG_WORKER_INDEX = int(os.getenv('TG_WORKER_INDEX', '-1'))
+TG_WORKER_PORT = int(os.getenv('TG_WORKER_PORT', '0'))
+
+
+def _per_worker_path(path: str) -> str:
+    """worker 进程各自写一份的文件（file_id 表、span 导出）加上 .w<i> 后缀，避免多进程覆盖。"""
+    if not path or TG_WORKER_INDEX < 0:
+        return path
+    p = Path(path)
+    return str(p.with_name(f"{p.stem}.w{TG_WORKER_INDEX}{p.suffix}"))
+
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 # SillyTavern Basic Auth（可选）
 ST_AUTH_USER = os.getenv('ST_AUTH_USER', '')
@@ -49,12 +91,42 @@ ST_AUTH_PASS = os.getenv('ST_AUTH_PASS', '')
 # Bot-level multi-user authorization (admin-managed allowlist)
 TG_AUTH_DB_PATH = os.getenv('TG_AUTH_DB_PATH', '/app/data/auth.json')
 TG_REGISTRATION_ENABLED_DEFAULT = os.getenv('TG_REGISTRATION_ENABLED', '1').lower() in ('1', 'true', 'yes', 'y', 'on')
+# 授权库 journal 累计多少条记录后压缩为新快照
+TG_AUTH_JOURNAL_COMPACT_EVERY = int(os.getenv('TG_AUTH_JOURNAL_COMPACT_EVERY', '500'))
+# 多个 bot 进程共用同一授权库（跨进程文件锁 + 变更检测）
+TG_AUTH_SHARED = os.getenv('TG_AUTH_SHARED', '0').lower() in ('1', 'true', 'yes', 'y', 'on')
+# 已接收 update 的持久化日志（重启后恢复未完成的 update、按 update_id 去重）；默认与授权库同目录，设为空关闭
+TG_UPDATE_JOURNAL_PATH = os.getenv('TG_UPDATE_JOURNAL_PATH', str(Path(TG_AUTH_DB_PATH).with_name('updates.journal')))
+# 消息超过该时长（秒）才轮到处理时不再调用 LLM，按会话合并为一条提示；0 为不限制
+TG_UPDATE_MAX_AGE_S = float(os.getenv('TG_UPDATE_MAX_AGE_S', '600'))
+# 收到 SIGTERM 后等待进行中的回复完成的最长时间（秒），超时的回复被取消并把占位消息改为中断提示；
+# 需小于容器的 stop_grace_period
+TG_SHUTDOWN_DRAIN_S = float(os.getenv('TG_SHUTDOWN_DRAIN_S', '45'))
+TG_AUTH_REFRESH_INTERVAL_MS = int(os.getenv('TG_AUTH_REFRESH_INTERVAL_MS', '1000'))
 
 # Bot performance (multi-user)
 TG_CONCURRENT_UPDATES = int(os.getenv('TG_CONCURRENT_UPDATES', '8'))
 TG_CONNECTION_POOL_SIZE = int(os.getenv('TG_CONNECTION_POOL_SIZE', '64'))
 TG_POOL_TIMEOUT = float(os.getenv('TG_POOL_TIMEOUT', '30'))
 
+# Bookkeeping bounds / housekeeping (防止陌生账号刷消息导致内存无限增长)
+TG_BOOKKEEPING_MAX_USERS = int(os.getenv('TG_BOOKKEEPING_MAX_USERS', '10000'))
+TG_VOICE_WARN_TTL_HOURS = float(os.getenv('TG_VOICE_WARN_TTL_HOURS', '24'))
+TG_INVITE_TTL_HOURS = float(os.getenv('TG_INVITE_TTL_HOURS', '168'))  # 0=永不过期
+TG_PENDING_TTL_HOURS = float(os.getenv('TG_PENDING_TTL_HOURS', '720'))  # 0=永不过期
+TG_HOUSEKEEPING_INTERVAL_S = float(os.getenv('TG_HOUSEKEEPING_INTERVAL_S', '600'))
+
+# Prometheus 指标端点（0=关闭，埋点几乎零开销）
+TG_METRICS_PORT = int(os.getenv('TG_METRICS_PORT', '0'))
+TG_METRICS_HOST = os.getenv('TG_METRICS_HOST', '127.0.0.1').strip() or '127.0.0.1'
+# 请求追踪：每个 update 一个 trace ID（出现在日志中，并以 X-Trace-Id 传给插件）；span 以 JSON lines 追加到该文件（空=不导出）
+TG_TRACE_FILE = os.getenv('TG_TRACE_FILE', '').strip()
+# 录制插件 SSE 流（事件 + 相对时间，gzip JSON）到该目录，供 bench/loadtest.py --replay 回放；含对话内容，仅在测试环境开启（空=关闭）
+TG_SSE_RECORD_DIR = os.getenv('TG_SSE_RECORD_DIR', '').strip()
+# 事件循环卡顿检测：心跳超过阈值未更新时记录循环线程的调用栈（0=关闭）
+TG_LOOP_LAG_THRESHOLD_MS = int(os.getenv('TG_LOOP_LAG_THRESHOLD_MS', '250'))
+TG_LOOP_LAG_INTERVAL_MS = int(os.getenv('TG_LOOP_LAG_INTERVAL_MS', '100'))
+
 # Telegram streaming / typing simulation
 TELEGRAM_STREAM_RESPONSES = os.getenv('TELEGRAM_STREAM_RESPONSES', '1').lower() in ('1', 'true', 'yes', 'y', 'on')
 TELEGRAM_STREAM_EDIT_INTERVAL_MS = int(os.getenv('TELEGRAM_STREAM_EDIT_INTERVAL_MS', '750'))
@@ -62,14 +134,54 @@ TELEGRAM_TYPING_INTERVAL_MS = int(os.getenv('TELEGRAM_TYPING_INTERVAL_MS', '3500
 TELEGRAM_STREAM_PLACEHOLDER = os.getenv('TELEGRAM_STREAM_PLACEHOLDER', '输入中...')
 
 # Optional voice reply via TTS (per-user toggle; provider configured via plugin)
-TG_TTS_MAX_CHARS = int(os.getenv('TG_TTS_MAX_CHARS', '1500'))
+TG_TTS_MAX_CHARS = int(os.getenv('TG_TTS_MAX_CHARS', '8000'))
+# 长回复按句切块并发合成：join=合并成一条语音，stream=每块完成后按顺序逐条发送
+TG_TTS_CHUNK_CHARS = int(os.getenv('TG_TTS_CHUNK_CHARS', '300'))
+TG_TTS_PARALLEL = int(os.getenv('TG_TTS_PARALLEL', '4'))
+TG_TTS_CHUNK_MODE = os.getenv('TG_TTS_CHUNK_MODE', 'join').strip().lower()  # join | stream
+# 流式生成时边生成边合成：每凑够 TG_TTS_PIPELINE_MIN_CHARS 个字符的完整句子就提交 TTS
+TG_TTS_PIPELINE = os.getenv('TG_TTS_PIPELINE', '0').lower() in ('1', 'true', 'yes', 'y', 'on')
+TG_TTS_PIPELINE_MIN_CHARS = int(os.getenv('TG_TTS_PIPELINE_MIN_CHARS', '60'))
+# 语音在后台工作池中发送：文字回复先结束，语音随后到达（0=在消息处理中直接发送）
+TG_VOICE_WORKERS = int(os.getenv('TG_VOICE_WORKERS', '4'))
+TG_VOICE_QUEUE_SIZE = int(os.getenv('TG_VOICE_QUEUE_SIZE', '256'))
+TG_VOICE_MAX_PENDING_PER_USER = int(os.getenv('TG_VOICE_MAX_PENDING_PER_USER', '2'))
+# 切换角色后在后台预合成的开场白条数（需启用语音缓存；0=关闭）
+TG_GREETING_PREWARM_MAX = int(os.getenv('TG_GREETING_PREWARM_MAX', '5'))
+# 各 TTS 提供商同时进行的远程合成请求上限，如 edge=4,plugin=2
+TG_TTS_PROVIDER_CONCURRENCY = os.getenv('TG_TTS_PROVIDER_CONCURRENCY', 'edge=4,plugin=4')
 TTS_PROVIDER = os.getenv('TTS_PROVIDER', 'plugin').strip().lower()  # plugin | edge
+# 多个 TTS 提供商时按滚动延迟/错误率为每次合成选择最优者，失败则在截止时间内换下一个（如 edge,plugin）
+TTS_PROVIDERS = [
+    v.strip().lower()
+    for v in (os.getenv('TTS_PROVIDERS', '').strip() or TTS_PROVIDER or 'plugin').split(',')
+    if v.strip()
+]
+TG_TTS_DEADLINE_S = float(os.getenv('TG_TTS_DEADLINE_S', '60'))
+TG_TTS_ATTEMPT_TIMEOUT_S = float(os.getenv('TG_TTS_ATTEMPT_TIMEOUT_S', '12'))
+TG_TTS_PROVIDER_COOLDOWN_S = float(os.getenv('TG_TTS_PROVIDER_COOLDOWN_S', '60'))
+# 各提供商之间等价的音色：逗号分隔的组，组内用 = 连接 provider:voice，如 edge:zh-CN-YunxiNeural=plugin:onyx
+TG_TTS_VOICE_MAP = os.getenv('TG_TTS_VOICE_MAP', '')
 # Edge TTS 配置（通过模拟 Microsoft Translator 签名获取）
 EDGE_TTS_DEFAULT_VOICE = os.getenv('EDGE_TTS_DEFAULT_VOICE', '').strip() or 'zh-CN-XiaoxiaoMultilingualNeural'
 EDGE_TTS_DEFAULT_RATE = os.getenv('EDGE_TTS_DEFAULT_RATE', '').strip() or '0'
 EDGE_TTS_DEFAULT_PITCH = os.getenv('EDGE_TTS_DEFAULT_PITCH', '').strip() or '0'
 EDGE_TTS_DEFAULT_STYLE = os.getenv('EDGE_TTS_DEFAULT_STYLE', '').strip() or 'general'
 EDGE_TTS_OUTPUT_FORMAT = os.getenv('EDGE_TTS_OUTPUT_FORMAT', '').strip() or 'audio-24khz-48kbitrate-mono-mp3'
+# 语音合成结果的内容寻址磁盘缓存（0=关闭）
+TG_TTS_CACHE_DIR = os.getenv('TG_TTS_CACHE_DIR', '').strip() or str(Path(TG_AUTH_DB_PATH).parent / 'tts-cache')
+TG_TTS_CACHE_MAX_MB = float(os.getenv('TG_TTS_CACHE_MAX_MB', '256'))
+# 单块语音回复边下载 TTS 边上传到 Telegram（不在内存中缓冲整段音频），每次转发的块大小
+TG_TTS_STREAM_UPLOAD = os.getenv('TG_TTS_STREAM_UPLOAD', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+TG_TTS_STREAM_CHUNK_KB = max(4, int(os.getenv('TG_TTS_STREAM_CHUNK_KB', '64')))
+# 已上传语音的 file_id 复用表（音频内容 sha256 -> file_id，保存在语音缓存目录下；0=关闭）
+TG_VOICE_FILE_ID_CACHE = int(os.getenv('TG_VOICE_FILE_ID_CACHE', '5000'))
+# 用本地 ffmpeg 把 TTS 输出转成 Telegram 原生 Ogg/Opus：off | auto（仅非 Ogg/Opus 输入）| always
+TG_TTS_TRANSCODE = os.getenv('TG_TTS_TRANSCODE', 'off').strip().lower()
+# 码率或档位：low=16k, medium=32k, high=64k，或直接写 24k 这样的值
+TG_TTS_TRANSCODE_BITRATE = os.getenv('TG_TTS_TRANSCODE_BITRATE', 'medium').strip().lower()
+TG_TTS_TRANSCODE_WORKERS = int(os.getenv('TG_TTS_TRANSCODE_WORKERS', '2'))
+TG_FFMPEG_PATH = os.getenv('TG_FFMPEG_PATH', '').strip() or 'ffmpeg'
 TG_TTS_CHOICES = [
     v.strip()
     for v in os.getenv('TG_TTS_CHOICES', '').split(',')
@@ -112,1094 +224,3882 @@ TG_MODEL_CHOICES = [
     if m.strip()
 ]
 
+# 当前 update 的 trace ID / 当前 span（asyncio 任务间按 contextvars 语义传递）
+_trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+_span_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("span_id", default=None)
+
+
+class _TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = _trace_id_var.get()
+        return True
+
+
 # Logging
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
     level=getattr(logging, LOG_LEVEL.upper(), logging.INFO)
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(_TraceIdFilter())
 logger = logging.getLogger(__name__)
 
-# HTTP Client with optional Basic Auth
+
+async def _inject_trace_header(request: httpx.Request) -> None:
+    trace_id = _trace_id_var.get()
+    if trace_id != "-":
+        request.headers["X-Trace-Id"] = trace_id
+
+
+# HTTP Client with optional Basic Auth（发往插件的请求带上 X-Trace-Id）
 _auth = httpx.BasicAuth(ST_AUTH_USER, ST_AUTH_PASS) if ST_AUTH_USER else None
-http_client = httpx.AsyncClient(timeout=120.0, auth=_auth)
+http_client = httpx.AsyncClient(timeout=120.0, auth=_auth, event_hooks={"request": [_inject_trace_header]})
 tts_http_client = httpx.AsyncClient(timeout=60.0)
 
 
-def md_escape(text: object) -> str:
-    return escape_markdown(str(text), version=1)
+# ============================================
+# Metrics（Prometheus 文本格式；TG_METRICS_PORT=0 时所有埋点直接返回）
+# ============================================
 
+_DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-def strip_markdown_for_tts(text: str) -> str:
-    """清理 Markdown 格式符号，用于 TTS 朗读"""
-    s = str(text or "")
-    # 移除代码块 ```...```
-    s = re.sub(r'```[\s\S]*?```', '', s)
-    # 移除行内代码 `...`
-    s = re.sub(r'`[^`]*`', '', s)
-    # 移除加粗/斜体 **text** / *text* / __text__ / _text_
-    s = re.sub(r'\*\*(.+?)\*\*', r'\1', s)
-    s = re.sub(r'\*(.+?)\*', r'\1', s)
-    s = re.sub(r'__(.+?)__', r'\1', s)
-    s = re.sub(r'_(.+?)_', r'\1', s)
-    # 移除删除线 ~~text~~
-    s = re.sub(r'~~(.+?)~~', r'\1', s)
-    # 移除剩余的孤立格式符号
-    s = re.sub(r'[*_~`]+', '', s)
-    # 清理多余空白
-    s = re.sub(r'\n{3,}', '\n\n', s)
-    return s.strip()
 
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-async def send_text_safe(send_func, text: str, *, parse_mode: str = None, reply_markup=None):
-    try:
-        if parse_mode:
-            return await send_func(text, reply_markup=reply_markup, parse_mode=parse_mode)
-        return await send_func(text, reply_markup=reply_markup)
-    except BadRequest as e:
-        if parse_mode and "Can't parse entities" in str(e):
-            return await send_func(text, reply_markup=reply_markup)
-        raise
 
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
 
-def _now_ms() -> int:
-    return int(time.time() * 1000)
 
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
 
-class AuthStore:
-    def __init__(self, path: str, *, admin_user_id: int, registration_enabled_default: bool):
-        self.path = Path(path)
-        self.admin_user_id = admin_user_id
-        self._lock = asyncio.Lock()
-        self.data: Dict[str, Any] = {
-            "version": 1,
-            "registrationEnabled": registration_enabled_default,
-            "allowedUsers": {},
-            "pendingUsers": {},
-            "invites": {},
-            "userSettings": {}
-        }
-        self._loaded = False
 
-    def load_sync(self) -> None:
-        if self._loaded:
-            return
-        try:
-            if self.path.exists():
-                self.data = json.loads(self.path.read_text(encoding='utf-8'))
-                if not isinstance(self.data.get("userSettings"), dict):
-                    self.data["userSettings"] = {}
-                self._loaded = True
-                return
-        except Exception as e:
-            logger.error(f"Auth DB load failed: {e}")
+_INF_LABEL = 'le="+Inf"'
 
-        try:
-            self.path.parent.mkdir(parents=True, exist_ok=True)
-            self.path.write_text(json.dumps(self.data, ensure_ascii=False, indent=2), encoding='utf-8')
-        except Exception as e:
-            logger.error(f"Auth DB init failed: {e}")
-        self._loaded = True
 
-    async def _save_unlocked(self) -> None:
-        self.path.parent.mkdir(parents=True, exist_ok=True)
-        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
-        tmp_path.write_text(json.dumps(self.data, ensure_ascii=False, indent=2), encoding='utf-8')
-        os.replace(tmp_path, self.path)
+class _Metric:
+    kind = "untyped"
 
-    async def save(self) -> None:
-        async with self._lock:
-            await self._save_unlocked()
+    def __init__(self, registry: "MetricsRegistry", name: str, help_text: str, labelnames: tuple):
+        self.enabled = registry.enabled
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
 
-    def is_admin(self, user_id: int) -> bool:
-        return self.admin_user_id != 0 and user_id == self.admin_user_id
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
 
-    def is_allowed(self, user_id: int) -> bool:
-        if self.admin_user_id == 0:
-            return True
-        if self.is_admin(user_id):
-            return True
-        return str(user_id) in (self.data.get("allowedUsers") or {})
+    def samples(self) -> list[str]:
+        return []
 
-    def registration_enabled(self) -> bool:
-        return bool(self.data.get("registrationEnabled", TG_REGISTRATION_ENABLED_DEFAULT))
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
 
-    async def set_registration_enabled(self, enabled: bool) -> None:
-        async with self._lock:
-            self.data["registrationEnabled"] = bool(enabled)
-            await self._save_unlocked()
 
-    async def request_access(self, user_id: int, user_name: str) -> bool:
-        async with self._lock:
-            if self.is_allowed(user_id):
-                return False
-            pending = self.data.get("pendingUsers") or {}
-            pending[str(user_id)] = {
-                "userId": int(user_id),
-                "userName": user_name,
-                "requestedAt": _now_ms(),
-            }
-            self.data["pendingUsers"] = pending
-            await self._save_unlocked()
-            return True
+class Counter(_Metric):
+    kind = "counter"
 
-    async def approve(self, user_id: int, *, approved_by: int, note: str = "") -> bool:
-        async with self._lock:
-            allowed = self.data.get("allowedUsers") or {}
-            pending = self.data.get("pendingUsers") or {}
-            user_key = str(user_id)
-            user_meta = pending.pop(user_key, None) or {"userId": int(user_id), "userName": "", "requestedAt": None}
-            allowed[user_key] = {
-                "userId": int(user_id),
-                "userName": user_meta.get("userName") or "",
-                "requestedAt": user_meta.get("requestedAt"),
-                "approvedAt": _now_ms(),
-                "approvedBy": int(approved_by),
-                "note": note,
-            }
-            self.data["allowedUsers"] = allowed
-            self.data["pendingUsers"] = pending
-            await self._save_unlocked()
-            return True
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._values: Dict[tuple, float] = {}
 
-    async def reject(self, user_id: int) -> bool:
-        async with self._lock:
-            pending = self.data.get("pendingUsers") or {}
-            removed = pending.pop(str(user_id), None)
-            self.data["pendingUsers"] = pending
-            await self._save_unlocked()
-            return removed is not None
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
 
-    async def revoke(self, user_id: int) -> bool:
-        async with self._lock:
-            allowed = self.data.get("allowedUsers") or {}
-            removed = allowed.pop(str(user_id), None)
-            self.data["allowedUsers"] = allowed
-            await self._save_unlocked()
-            return removed is not None
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in self._values.items()]
 
-    async def create_one_time_invite(self, *, created_by: int) -> str:
-        async with self._lock:
-            invites = self.data.get("invites") or {}
-            while True:
-                code = secrets.token_urlsafe(8)
-                if code not in invites:
-                    break
-            invites[code] = {
-                "code": code,
-                "usesRemaining": 1,
-                "createdAt": _now_ms(),
-                "createdBy": int(created_by),
-            }
-            self.data["invites"] = invites
-            await self._save_unlocked()
-            return code
 
-    async def redeem_invite(self, *, user_id: int, user_name: str, code: str, approved_by: int) -> bool:
-        async with self._lock:
-            if self.is_allowed(user_id):
-                return True
-            invites = self.data.get("invites") or {}
-            invite = invites.get(code)
-            if not invite:
-                return False
-            uses = int(invite.get("usesRemaining", 0))
-            if uses <= 0:
-                invites.pop(code, None)
-                self.data["invites"] = invites
-                await self._save_unlocked()
-                return False
+class Gauge(_Metric):
+    kind = "gauge"
 
-            invite["usesRemaining"] = uses - 1
-            if invite["usesRemaining"] <= 0:
-                invites.pop(code, None)
-            else:
-                invites[code] = invite
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._values: Dict[tuple, float] = {}
+        self._function: Optional[Callable[[], float]] = None
 
-            allowed = self.data.get("allowedUsers") or {}
-            allowed[str(user_id)] = {
-                "userId": int(user_id),
-                "userName": user_name,
-                "requestedAt": None,
-                "approvedAt": _now_ms(),
-                "approvedBy": int(approved_by),
-                "note": "invite",
-            }
-            pending = self.data.get("pendingUsers") or {}
-            pending.pop(str(user_id), None)
+    def set(self, value: float, **labels: Any) -> None:
+        if self.enabled:
+            self._values[self._key(labels)] = value
 
-            self.data["invites"] = invites
-            self.data["allowedUsers"] = allowed
-            self.data["pendingUsers"] = pending
-            await self._save_unlocked()
-            return True
+    def set_function(self, fn: Callable[[], float]) -> None:
+        """抓取时才求值（队列深度等），平时没有任何开销。"""
+        self._function = fn
 
-    def list_pending(self) -> list[dict]:
-        pending = self.data.get("pendingUsers") or {}
-        return [pending[k] for k in sorted(pending.keys())]
+    def samples(self) -> list[str]:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {_format_value(self._function())}"]
+            except Exception:
+                return []
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in self._values.items()]
 
-    def list_allowed(self) -> list[dict]:
-        allowed = self.data.get("allowedUsers") or {}
-        return [allowed[k] for k in sorted(allowed.keys())]
 
-    def get_user_llm_model(self, user_id: int) -> Optional[str]:
-        settings = self.data.get("userSettings") or {}
-        entry = settings.get(str(user_id)) if isinstance(settings, dict) else None
-        if not isinstance(entry, dict):
-            return None
-        model = entry.get("llmModel")
-        if not isinstance(model, str):
-            return None
-        model = model.strip()
-        return model or None
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
 
-    async def set_user_llm_model(self, user_id: int, model: Optional[str]) -> None:
-        key = str(user_id)
-        normalized = None
-        if isinstance(model, str):
-            normalized = model.strip() or None
+    def __init__(self, histogram: "Histogram", labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
 
-        async with self._lock:
-            settings = self.data.get("userSettings")
-            if not isinstance(settings, dict):
-                settings = {}
-
-            entry = settings.get(key)
-            if not isinstance(entry, dict):
-                entry = {}
-
-            if normalized is None:
-                entry.pop("llmModel", None)
-                if entry:
-                    settings[key] = entry
-                else:
-                    settings.pop(key, None)
-            else:
-                entry["llmModel"] = normalized
-                settings[key] = entry
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
 
-            self.data["userSettings"] = settings
-            await self._save_unlocked()
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
 
-    def get_user_voice_enabled(self, user_id: int) -> bool:
-        settings = self.data.get("userSettings") or {}
-        entry = settings.get(str(user_id)) if isinstance(settings, dict) else None
-        if not isinstance(entry, dict):
-            return False
-        enabled = entry.get("voiceEnabled")
-        return bool(enabled) if isinstance(enabled, bool) else False
 
-    async def set_user_voice_enabled(self, user_id: int, enabled: bool) -> None:
-        key = str(user_id)
-        normalized = bool(enabled)
+class Histogram(_Metric):
+    kind = "histogram"
 
-        async with self._lock:
-            settings = self.data.get("userSettings")
-            if not isinstance(settings, dict):
-                settings = {}
+    def __init__(self, *args, buckets: tuple = _DEFAULT_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶计数..., sum, count]
+        self._values: Dict[tuple, list] = {}
 
-            entry = settings.get(key)
-            if not isinstance(entry, dict):
-                entry = {}
+    def observe(self, value: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    def time(self, **labels: Any):
+        return _Timer(self, labels) if self.enabled else contextlib.nullcontext()
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, _INF_LABEL)} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, *, enabled: bool, prefix: str = "tgbot_"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._metrics: list[_Metric] = []
+
+    def _add(self, metric: _Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(self, self.prefix + name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        return self._add(Gauge(self, self.prefix + name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), *, buckets: tuple = _DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, self.prefix + name, help_text, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+
+metrics = MetricsRegistry(enabled=TG_METRICS_PORT > 0)
+
+M_ST_REQUEST_SECONDS = metrics.histogram("st_request_seconds", "SillyTavern plugin request latency", ("endpoint",))
+M_ST_REQUEST_ERRORS = metrics.counter("st_request_errors_total", "SillyTavern plugin request failures", ("endpoint",))
+M_STREAM_FIRST_TOKEN_SECONDS = metrics.histogram("stream_first_token_seconds", "Time from user message to first streamed delta")
+M_STREAM_FIRST_EDIT_SECONDS = metrics.histogram("stream_first_edit_seconds", "Time from user message to first placeholder edit")
+M_STREAM_REPLY_SECONDS = metrics.histogram("stream_reply_seconds", "Time from user message to final text reply")
+M_STREAM_EDITS_PER_REPLY = metrics.histogram(
+    "stream_edits_per_reply", "Message edits issued per streamed reply", buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+M_TELEGRAM_EDITS = metrics.counter("telegram_edits_total", "editMessageText calls")
+M_TELEGRAM_RETRY_AFTER = metrics.counter("telegram_retry_after_total", "RetryAfter (flood control) errors", ("method",))
+M_TTS_SECONDS = metrics.histogram("tts_seconds", "TTS synthesis latency per provider", ("provider",))
+M_TTS_ERRORS = metrics.counter("tts_errors_total", "TTS synthesis failures per provider", ("provider",))
+M_AUTH_WRITE_SECONDS = metrics.histogram(
+    "auth_store_write_seconds", "Auth store journal append / snapshot latency", ("kind",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+M_VOICE_QUEUE_DEPTH = metrics.gauge("voice_queue_depth", "Voice replies waiting in the delivery pool")
+M_VOICE_QUEUE_DEPTH.set_function(lambda: voice_pool.depth())
+M_TTS_PREWARM_DEPTH = metrics.gauge("tts_prewarm_queue_depth", "Texts waiting for background pre-synthesis")
+M_TTS_PREWARM_DEPTH.set_function(lambda: tts_prewarmer.depth())
+M_TTS_CACHE_BYTES = metrics.gauge("tts_cache_bytes", "Bytes held in the TTS disk cache")
+M_TTS_CACHE_BYTES.set_function(lambda: tts_cache.total_bytes)
+M_WEBHOOK_UPDATES = metrics.counter(
+    "webhook_updates_total", "Webhook requests by outcome (accepted, shed, unauthorized, invalid, dropped)", ("result",),
+)
+M_WEBHOOK_QUEUE_DEPTH = metrics.gauge("webhook_queue_depth", "Accepted webhook updates waiting to be processed")
+M_WEBHOOK_QUEUE_DEPTH.set_function(lambda: webhook_receiver.depth() if webhook_receiver else 0)
+M_LOOP_LAG_SECONDS = metrics.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop heartbeat beyond its scheduled wake-up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
 
-            entry["voiceEnabled"] = normalized
-            settings[key] = entry
 
-            self.data["userSettings"] = settings
-            await self._save_unlocked()
+# ============================================
+# Runtime stats（/perf 使用的进程内滚动统计，始终开启，与 TG_METRICS_PORT 无关）
+# ============================================
 
-    def get_user_tts_voice(self, user_id: int) -> Optional[str]:
-        settings = self.data.get("userSettings") or {}
-        entry = settings.get(str(user_id)) if isinstance(settings, dict) else None
-        if not isinstance(entry, dict):
-            return None
-        voice = entry.get("ttsVoice")
-        if not isinstance(voice, str):
-            return None
-        voice = voice.strip()
-        return voice or None
+class RollingCounter:
+    """按秒分桶的滚动计数，保留最近 horizon_s 秒；每个桶记录次数与最大值。"""
 
-    async def set_user_tts_voice(self, user_id: int, voice: Optional[str]) -> None:
-        key = str(user_id)
-        normalized = None
-        if isinstance(voice, str):
-            normalized = voice.strip() or None
+    __slots__ = ("horizon_s", "_buckets")
 
-        async with self._lock:
-            settings = self.data.get("userSettings")
-            if not isinstance(settings, dict):
-                settings = {}
-
-            entry = settings.get(key)
-            if not isinstance(entry, dict):
-                entry = {}
-
-            if normalized is None:
-                entry.pop("ttsVoice", None)
-                if entry:
-                    settings[key] = entry
-                else:
-                    settings.pop(key, None)
-            else:
-                entry["ttsVoice"] = normalized
-                settings[key] = entry
+    def __init__(self, horizon_s: int = 600):
+        self.horizon_s = int(horizon_s)
+        self._buckets: deque = deque()  # [second, count, max]
 
-            self.data["userSettings"] = settings
-            await self._save_unlocked()
+    def add(self, value: float = 0.0) -> None:
+        second = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == second:
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            if value > bucket[2]:
+                bucket[2] = value
+            return
+        self._buckets.append([second, 1, value])
+        while self._buckets[0][0] <= second - self.horizon_s:
+            self._buckets.popleft()
 
+    def _recent(self, window_s: int):
+        cutoff = int(time.monotonic()) - window_s
+        return (b for b in self._buckets if b[0] > cutoff)
 
-class SillyTavernClient:
-    """SillyTavern API Client"""
+    def count(self, window_s: int) -> int:
+        return sum(b[1] for b in self._recent(window_s))
 
-    def __init__(self, base_url: str, api_prefix: str = ''):
-        self.base_url = base_url.rstrip('/')
-        self.api_prefix = api_prefix
+    def max(self, window_s: int) -> float:
+        return max((b[2] for b in self._recent(window_s)), default=0.0)
 
-    async def _get(self, path: str, params: dict = None) -> Dict[str, Any]:
-        url = f"{self.base_url}{self.api_prefix}{path}"
-        response = await http_client.get(url, params=params)
-        response.raise_for_status()
-        return response.json()
 
-    async def _post(self, path: str, data: dict) -> Dict[str, Any]:
-        url = f"{self.base_url}{self.api_prefix}{path}"
-        response = await http_client.post(url, json=data)
-        response.raise_for_status()
-        return response.json()
+class LatencyWindow:
+    """最近 maxlen 个耗时样本，按时间窗口求分位数。"""
 
-    async def get_plugin_config(self) -> Dict[str, Any]:
-        return await self._get('/config')
+    __slots__ = ("_samples",)
 
-    async def set_plugin_config(self, updates: dict) -> Dict[str, Any]:
-        return await self._post('/config', updates)
+    def __init__(self, maxlen: int = 2048):
+        self._samples: deque = deque(maxlen=maxlen)  # (monotonic, seconds)
 
-    async def health_check(self) -> bool:
-        try:
-            result = await self._get('/health')
-            return result.get('success', False)
-        except Exception:
-            return False
+    def observe(self, seconds: float) -> None:
+        self._samples.append((time.monotonic(), seconds))
 
-    async def get_characters(self) -> Dict[str, Any]:
-        return await self._get('/characters')
+    def percentile(self, pct: float, window_s: float) -> Optional[float]:
+        cutoff = time.monotonic() - window_s
+        values = sorted(v for t, v in self._samples if t >= cutoff)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
 
-    async def get_presets(self) -> Dict[str, Any]:
-        return await self._get('/presets')
 
-    async def get_worldinfo(self) -> Dict[str, Any]:
-        return await self._get('/worldinfo')
+class RuntimeStats:
+    def __init__(self):
+        self.active_streams = 0
+        self.bot_api_calls: Dict[str, RollingCounter] = {}
+        self.bot_api_failures: Dict[str, RollingCounter] = {}
+        self.retry_after: Dict[str, RollingCounter] = {}
+        self.st_latency = LatencyWindow()
+        self.auth_writes = RollingCounter()
 
-    async def get_session(self, user_id: str) -> Dict[str, Any]:
-        return await self._get('/session', {'telegramUserId': user_id})
+    @staticmethod
+    def _bump(table: Dict[str, RollingCounter], key: str) -> None:
+        counter = table.get(key)
+        if counter is None:
+            counter = table[key] = RollingCounter()
+        counter.add()
 
-    async def switch_character(self, user_id: str, char_id: int,
-                                preset: str = None, world: str = None) -> Dict[str, Any]:
-        data = {'telegramUserId': user_id, 'characterId': char_id}
-        if preset:
-            data['presetName'] = preset
-        if world is not None:
-            data['worldInfoName'] = world
-        return await self._post('/character/switch', data)
+    def record_bot_api(self, method: str, status: int) -> None:
+        self._bump(self.bot_api_calls, method)
+        if status == 429:
+            self._bump(self.retry_after, method)
+        if status != 200:
+            self._bump(self.bot_api_failures, method)
 
-    async def set_preset(self, user_id: str, preset_name: str) -> Dict[str, Any]:
-        return await self._post('/session/preset', {
-            'telegramUserId': user_id,
-            'presetName': preset_name
-        })
+    @staticmethod
+    def total(table: Dict[str, RollingCounter], window_s: int, method: Optional[str] = None) -> int:
+        if method is not None:
+            counter = table.get(method)
+            return counter.count(window_s) if counter else 0
+        return sum(c.count(window_s) for c in table.values())
 
-    async def set_worldinfo(self, user_id: str, world_name: str) -> Dict[str, Any]:
-        return await self._post('/session/worldinfo', {
-            'telegramUserId': user_id,
-            'worldInfoName': world_name
-        })
 
-    async def send_message(self, user_id: str, message: str, user_name: str, llm_model: Optional[str] = None) -> Dict[str, Any]:
-        payload = {
-            'telegramUserId': user_id,
-            'message': message,
-            'user': user_name
-        }
-        if isinstance(llm_model, str) and llm_model.strip():
-            payload['llmModel'] = llm_model.strip()
-        return await self._post('/send', payload)
+runtime_stats = RuntimeStats()
 
-    async def tts(self, text: str, *, tts_model: Optional[str] = None, voice: Optional[str] = None, response_format: Optional[str] = None) -> bytes:
-        url = f"{self.base_url}{self.api_prefix}/tts"
-        payload: Dict[str, Any] = {"text": str(text or "")}
-        if isinstance(tts_model, str) and tts_model.strip():
-            payload["ttsModel"] = tts_model.strip()
-        if isinstance(voice, str) and voice.strip():
-            payload["voice"] = voice.strip()
-        if isinstance(response_format, str) and response_format.strip():
-            payload["format"] = response_format.strip()
-        response = await http_client.post(url, json=payload)
-        response.raise_for_status()
-        return response.content
 
-    async def send_message_stream(self, user_id: str, message: str, user_name: str, llm_model: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
-        url = f"{self.base_url}{self.api_prefix}/send/stream"
-        payload = {
-            'telegramUserId': user_id,
-            'message': message,
-            'user': user_name
-        }
-        if isinstance(llm_model, str) and llm_model.strip():
-            payload['llmModel'] = llm_model.strip()
+class CountingHTTPXRequest(HTTPXRequest):
+    """记录每次 Bot API 调用的方法名与 HTTP 状态码（429 即 RetryAfter）。"""
 
-        async with http_client.stream(
-            "POST",
-            url,
-            json=payload,
-            headers={"Accept": "text/event-stream"},
-            timeout=None,
-        ) as response:
-            response.raise_for_status()
-            async for line in response.aiter_lines():
-                if not line or not line.startswith('data:'):
-                    continue
-                data = line[5:].strip()
-                if not data:
-                    continue
-                try:
-                    yield json.loads(data)
-                except json.JSONDecodeError:
-                    continue
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            runtime_stats.record_bot_api(api_method, 0)
+            raise
+        runtime_stats.record_bot_api(api_method, code)
+        return code, payload
 
-    async def get_history(self, user_id: str, limit: int = 10, character_id: str = None) -> Dict[str, Any]:
-        params = {'telegramUserId': user_id, 'limit': limit}
-        if character_id is not None:
-            params['characterId'] = character_id
-        return await self._get('/history', params)
 
-    async def get_history_summary(self, user_id: str) -> Dict[str, Any]:
-        return await self._get('/history/summary', {'telegramUserId': user_id})
+class TrackedUpdateProcessor(SimpleUpdateProcessor):
+    """额外记录已进入处理器的 update 数：减去正在执行的即为在并发上限前排队的数量。"""
 
-    async def clear_history(self, user_id: str) -> Dict[str, Any]:
-        return await self._post('/history/clear', {'telegramUserId': user_id})
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.in_flight = 0
+        # 正在执行 handler 的 task，排空阶段等待它们结束
+        self.active: set[asyncio.Task] = set()
 
-    async def clear_all_history(self, user_id: str) -> Dict[str, Any]:
-        return await self._post('/history/clear/all', {'telegramUserId': user_id})
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.in_flight += 1
+        try:
+            if not isinstance(update, Update):
+                await super().process_update(update, coroutine)
+                return
+            # 重复（已处理或正在处理）与过期的 update 不进入 handler
+            if not await update_journal.begin(update) or update_journal.skip_if_stale(update):
+                coroutine.close()
+                return
+            if self._defer_if_draining(update, coroutine):
+                return
+            _current_update_id.set(update.update_id)
+            cancelled = False
+            try:
+                await super().process_update(update, coroutine)
+            except asyncio.CancelledError:
+                # 进程退出时被取消：不记 done，下次启动由 recover() 收尾
+                cancelled = True
+                raise
+            finally:
+                if not cancelled:
+                    await update_journal.finish(update.update_id)
+        finally:
+            self.in_flight -= 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # 在并发上限前排队期间进入了排空阶段的 update 同样不再开始
+        if isinstance(update, Update) and self._defer_if_draining(update, coroutine):
+            return
+        task = asyncio.current_task()
+        self.active.add(task)
+        try:
+            await super().do_process_update(update, coroutine)
+        finally:
+            self.active.discard(task)
+
+    @staticmethod
+    def _defer_if_draining(update: Update, coroutine: Awaitable[Any]) -> bool:
+        """排空阶段不再开始新的 update：保留在 journal 中，重启后继续处理。"""
+        if not shutdown_drain.draining:
+            return False
+        update_journal.defer(update.update_id)
+        coroutine.close()
+        return True
 
-    async def get_greeting(self, user_id: str, user_name: str) -> Dict[str, Any]:
-        return await self._get('/greeting', {
-            'telegramUserId': user_id,
-            'userName': user_name
-        })
+    @property
+    def queued(self) -> int:
+        return max(0, self.in_flight - self.current_concurrent_updates)
 
-    async def switch_greeting(self, user_id: str, direction: str) -> Dict[str, Any]:
-        """切换开场白 (next/prev/random)"""
-        return await self._post('/greeting/switch', {
-            'telegramUserId': user_id,
-            'greetingIndex': direction
-        })
 
+def process_rss_bytes() -> int:
+    """当前 RSS（读 /proc）；非 Linux 退回为峰值 RSS。"""
+    try:
+        with open("/proc/self/statm", "rb") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
 
-# Global client
-st_client = SillyTavernClient(SILLYTAVERN_URL, PLUGIN_API_BASE)
 
-auth_store = AuthStore(
-    TG_AUTH_DB_PATH,
-    admin_user_id=ALLOWED_USER_ID,
-    registration_enabled_default=TG_REGISTRATION_ENABLED_DEFAULT,
-)
-auth_store.load_sync()
+# ============================================
+# Tracing（span 导出为 JSON lines，TG_TRACE_FILE 为空时 span() 是空操作）
+# ============================================
 
-def is_authorized(user_id: int) -> bool:
-    return auth_store.is_allowed(user_id)
+class SpanExporter:
+    """把结束的 span 追加写入 JSON lines 文件（缓冲写，housekeeping 与退出时 flush）。"""
 
+    def __init__(self, path: str):
+        self.path = path
+        self._fh = None
+        self.exported = 0
 
-def is_admin(user_id: int) -> bool:
-    return auth_store.is_admin(user_id)
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
 
+    def export(self, record: Dict[str, Any]) -> None:
+        try:
+            if self._fh is None:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                self._fh = open(self.path, "a", encoding="utf-8")
+            self._fh.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.exported += 1
+        except Exception as e:
+            logger.error(f"Span export failed: {e}")
+            self.path = ""
 
-def get_register_help_text() -> str:
-    if ALLOWED_USER_ID == 0:
-        return "✅ 当前未启用授权限制（ALLOWED_USER_ID=0）"
-    if not auth_store.registration_enabled():
-        return "⛔ 当前未开放注册，请联系管理员开通。"
-    return (
-        "你尚未获得使用权限。\n\n"
-        "注册方式：\n"
-        "1) 有邀请码：发送 `/register <邀请码>`\n"
-        "2) 无邀请码：发送 `/register` 申请（管理员审批）"
-    )
+    def flush(self) -> None:
+        if self._fh is not None:
+            with contextlib.suppress(Exception):
+                self._fh.flush()
 
+    def close(self) -> None:
+        if self._fh is not None:
+            with contextlib.suppress(Exception):
+                self._fh.close()
+            self._fh = None
 
-_last_register_hint_at: Dict[int, float] = {}
 
+span_exporter = SpanExporter(_per_worker_path(TG_TRACE_FILE))
 
-async def maybe_send_register_hint(update: Update) -> None:
-    if not update.effective_chat or update.effective_chat.type != 'private':
-        return
-    user = update.effective_user
-    if not user:
-        return
-    message = update.effective_message
-    if not message:
-        return
-    now = time.monotonic()
-    last = _last_register_hint_at.get(user.id, 0.0)
-    if now - last < 10.0:
-        return
-    _last_register_hint_at[user.id] = now
-    try:
-        await send_text_safe(message.reply_text, get_register_help_text(), parse_mode='Markdown')
-    except Exception:
-        pass
 
+def new_trace_id() -> str:
+    return secrets.token_hex(8)
 
-def get_main_menu(user_id: Optional[int] = None) -> InlineKeyboardMarkup:
-    voice_enabled = auth_store.get_user_voice_enabled(user_id) if isinstance(user_id, int) else False
-    voice_label = "🔊 语音回复：开" if voice_enabled else "🔇 语音回复：关"
-    keyboard = [
-        [InlineKeyboardButton("🎭 选择角色", callback_data="menu_characters")],
-        [InlineKeyboardButton("📋 选择预设", callback_data="menu_presets")],
-        [InlineKeyboardButton("📚 选择世界书", callback_data="menu_worldinfo")],
-        [InlineKeyboardButton("📜 查看历史", callback_data="menu_history")],
-        [InlineKeyboardButton("🗑️ 清除当前角色历史", callback_data="menu_clear")],
-        [InlineKeyboardButton("🧹 一键清除全部历史", callback_data="menu_clear_all")],
-        [InlineKeyboardButton("ℹ️ 当前状态", callback_data="menu_status")],
-    ]
-    keyboard.insert(3, [InlineKeyboardButton("🧠 我的模型", callback_data="menu_my_model")])
-    keyboard.insert(4, [InlineKeyboardButton(voice_label, callback_data="menu_voice_toggle")])
-    keyboard.insert(5, [InlineKeyboardButton("🎙️ 选择音色", callback_data="menu_tts_voice")])
-    return InlineKeyboardMarkup(keyboard)
 
+def current_trace_id() -> str:
+    return _trace_id_var.get()
 
-async def send_typing_periodically(chat, interval_ms: int) -> None:
-    interval_s = max(0.5, interval_ms / 1000.0)
+
+@contextlib.contextmanager
+def trace_context(trace_id: str):
+    """在后台任务中恢复提交方的 trace ID。"""
+    token = _trace_id_var.set(trace_id or "-")
     try:
-        while True:
-            try:
-                await chat.send_action('typing')
-            except Exception:
-                pass
-            await asyncio.sleep(interval_s)
-    except asyncio.CancelledError:
-        return
+        yield
+    finally:
+        _trace_id_var.reset(token)
 
 
-async def edit_message_if_changed(message_obj, text: str) -> None:
-    try:
-        if getattr(message_obj, "text", None) == text:
-            return
-        await message_obj.edit_text(text)
-    except BadRequest as e:
-        if "Message is not modified" in str(e):
-            return
-        raise
+def record_span(name: str, started: float, ended: float, *, span_id: Optional[str] = None,
+                parent_id: Optional[str] = None, **attrs: Any) -> None:
+    """按 monotonic 起止时间补记一个 span（用于首 token 等不方便用 with 包裹的阶段）。"""
+    if not span_exporter.enabled:
+        return
+    span_exporter.export({
+        "trace_id": _trace_id_var.get(),
+        "span_id": span_id or secrets.token_hex(4),
+        "parent_id": parent_id if parent_id is not None else _span_id_var.get(),
+        "name": name,
+        "start": round((time.time() - (time.monotonic() - started)) * 1000, 1),
+        "duration_ms": round((ended - started) * 1000, 2),
+        **({"attrs": attrs} if attrs else {}),
+    })
+
+
+class _Span:
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "started", "_token")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "_Span":
+        self.span_id = secrets.token_hex(4)
+        self.parent_id = _span_id_var.get()
+        self._token = _span_id_var.set(self.span_id)
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _span_id_var.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        record_span(self.name, self.started, time.monotonic(), span_id=self.span_id,
+                    parent_id=self.parent_id, **self.attrs)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> None:
+        pass
 
+    def __enter__(self) -> "_NoopSpan":
+        return self
 
-async def edit_message_html_if_changed(message_obj, html_text: str) -> None:
-    try:
-        await message_obj.edit_text(html_text, parse_mode='HTML', disable_web_page_preview=True)
-    except BadRequest as e:
-        if "Message is not modified" in str(e):
-            return
-        if "Can't parse entities" in str(e):
-            safe = re.sub(r"<[^>]+>", "", html_text)
-            await edit_message_if_changed(message_obj, safe)
-            return
-        raise
+    def __exit__(self, *exc) -> None:
+        pass
 
 
-async def send_long_plain_text(bot, chat_id: int, text: str, *, chunk_size: int = 4000) -> None:
-    if not text:
-        return
-    for i in range(0, len(text), chunk_size):
-        await bot.send_message(chat_id=chat_id, text=text[i:i + chunk_size])
+_NOOP_SPAN = _NoopSpan()
 
 
-def looks_like_preformatted_block(text: str) -> bool:
-    if not text:
-        return False
-    lowered = text.lower()
-    return (
-        "<stausblock" in lowered
-        or "<statusblock" in lowered
-        or "```xml" in lowered
-        or "```" in lowered and ("<stausblock" in lowered or "<statusblock" in lowered)
-    )
+def span(name: str, **attrs: Any):
+    return _Span(name, attrs) if span_exporter.enabled else _NOOP_SPAN
 
 
-def _strip_code_fences(text: str) -> str:
-    if not text:
-        return text
-    stripped = text.strip()
-    if stripped.startswith("```") and stripped.endswith("```"):
-        inner = stripped[3:-3]
-        inner = re.sub(r"^\s*[a-zA-Z0-9_-]+\s*\n", "", inner, count=1)
-        return inner.strip()
-    return text
+async def begin_update_trace(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """group -1 的 TypeHandler：为每个 update 分配 trace ID，后续各组处理器在同一任务中继承。"""
+    _trace_id_var.set(new_trace_id())
+    _span_id_var.set(None)
+    logger.debug(f"Update {update.update_id} received")
 
 
-def _markdown_bold_to_html(escaped: str) -> str:
-    return re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", escaped)
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body, ctype = "200 OK", metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status, body, ctype = "404 Not Found", b"not found\n", "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
 
 
-def parse_statusblock(text: str) -> Optional[Dict[str, str]]:
-    if not text:
-        return None
-    text = _strip_code_fences(text)
-    lowered = text.lower()
-    if "<stausblock" not in lowered and "<statusblock" not in lowered:
+async def start_metrics_server() -> Optional[asyncio.base_events.Server]:
+    if not metrics.enabled:
         return None
+    server = await asyncio.start_server(_handle_metrics_request, TG_METRICS_HOST, TG_METRICS_PORT)
+    logger.info(f"Metrics endpoint on http://{TG_METRICS_HOST}:{TG_METRICS_PORT}/metrics")
+    return server
 
-    match = re.search(r"<(stausblock|statusblock)>([\s\S]*?)</\1>", text, flags=re.IGNORECASE)
-    if not match:
-        return None
 
-    inner = match.group(2)
-    pairs = re.findall(r"<([^<>/\s]+)>([\s\S]*?)</\1>", inner)
-    if not pairs:
-        return None
+# ============================================
+# Diagnostics（事件循环卡顿检测 / 采样分析）
+# ============================================
 
-    result: Dict[str, str] = {}
-    for tag, value in pairs:
-        tag = str(tag).strip()
-        value = str(value).strip()
-        if not tag:
-            continue
-        result[tag] = value
-    return result or None
+def _describe_entry(frame) -> str:
+    """从循环线程的栈顶往下找到紧挨着 asyncio 调度代码的那一帧：协程帧即当前任务的入口协程，否则是普通回调。"""
+    entry = None
+    while frame is not None:
+        if not _is_loop_frame(frame):
+            entry = frame
+        elif entry is not None:
+            break
+        frame = frame.f_back
+    if entry is None:
+        return "asyncio internals"
+    kind = "coroutine" if entry.f_code.co_flags & inspect.CO_COROUTINE else "loop callback"
+    return f"{kind} {_frame_label(entry)}"
+
+
+class LoopLagWatchdog:
+    """事件循环卡顿检测。
+
+    循环内的心跳任务每 interval 醒来一次，记录实际唤醒比预定晚了多少；另有一个守护线程盯着心跳，
+    超过 threshold 没有更新说明循环正被同步代码占用，此时抓取循环线程的调用栈写入日志
+    （每次卡顿只记录一次）。与采样分析一样只读取 sys._current_frames()，不在守护线程里访问
+    事件循环的状态（asyncio.current_task 等都不是线程安全的）。
+    """
+
+    def __init__(self, *, threshold_s: float, interval_s: float):
+        self.threshold_s = max(0.0, threshold_s)
+        self.interval_s = max(0.01, interval_s)
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self.stalls = 0
+        self.max_lag_s = 0.0
+        self.recent = RollingCounter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_s > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        self._thread.join(timeout=1.0)
+        self._thread = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval_s
+            await asyncio.sleep(self.interval_s)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            M_LOOP_LAG_SECONDS.observe(lag)
+            self.recent.add(lag)
+            if lag > self.max_lag_s:
+                self.max_lag_s = lag
+            if lag >= self.threshold_s:
+                self.stalls += 1
+                logger.warning(f"Event loop lag {lag * 1000:.0f}ms (threshold {self.threshold_s * 1000:.0f}ms)")
+
+    def _monitor(self) -> None:
+        reported_beat = None
+        check_every = min(self.interval_s, self.threshold_s) / 2
+        while not self._stopped.wait(check_every):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval_s
+            if blocked < self.threshold_s or beat == reported_beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                stack, entry = "(stack unavailable)\n", "unknown task"
+            else:
+                stack, entry = "".join(traceback.format_stack(frame)), _describe_entry(frame)
+            del frame
+            logger.warning(f"Event loop blocked for {blocked * 1000:.0f}ms in {entry}:\n{stack.rstrip()}")
 
+    def stats(self) -> str:
+        if not self.enabled:
+            return "loop_lag=off"
+        return f"loop_lag=max {self.max_lag_s * 1000:.0f}ms ({self.stalls} stalls)"
 
-def render_statusblock_messages(fields: Dict[str, str]) -> list[str]:
-    header_keys = ["天气", "地点", "日期", "时间"]
-    body_key = "正文"
-    tips_key = "TIPS"
 
-    def line(label: str, value: str) -> str:
-        escaped_value = _markdown_bold_to_html(html.escape(value, quote=False))
-        return f"<b>{html.escape(label, quote=False)}：</b>{escaped_value}"
+loop_watchdog = LoopLagWatchdog(
+    threshold_s=TG_LOOP_LAG_THRESHOLD_MS / 1000.0,
+    interval_s=TG_LOOP_LAG_INTERVAL_MS / 1000.0,
+)
 
-    sections: list[str] = []
 
-    header_lines: list[str] = []
-    for key in header_keys:
-        if fields.get(key):
-            header_lines.append(line(key, fields[key]))
-    if header_lines:
-        sections.append("\n".join(header_lines))
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
 
-    if fields.get(body_key):
-        body = _markdown_bold_to_html(html.escape(fields[body_key], quote=False))
-        sections.append(f"<b>正文</b>\n{body}")
 
-    if fields.get(tips_key):
-        tips_raw = fields[tips_key].strip()
-        tips_lines = [l.strip() for l in tips_raw.splitlines() if l.strip()]
-        tips_html = "\n".join(html.escape(l, quote=False) for l in tips_lines)
-        sections.append(f"<b>行动建议</b>\n{tips_html}")
+def _is_idle_frame(frame) -> bool:
+    return frame.f_code.co_filename.endswith("selectors.py")
 
-    skip = set(header_keys + [body_key, tips_key])
-    rest_lines: list[str] = []
-    for key, value in fields.items():
-        if key in skip:
-            continue
-        value = str(value).strip()
-        if not value:
-            continue
-        rest_lines.append(line(key, value))
-    if rest_lines:
-        sections.append("<b>状态</b>\n" + "\n".join(rest_lines))
 
-    messages: list[str] = []
-    current = ""
-    max_chars = 3500
+def _is_loop_frame(frame) -> bool:
+    filename = frame.f_code.co_filename
+    return f"{os.sep}asyncio{os.sep}" in filename or filename.endswith("selectors.py")
 
-    for section in sections:
-        section = section.strip()
-        if not section:
-            continue
-        candidate = f"{current}\n\n{section}" if current else section
-        if len(candidate) <= max_chars:
-            current = candidate
-            continue
-        if current:
-            messages.append(current)
-            current = ""
-        if len(section) <= max_chars:
-            current = section
-            continue
-        buf = ""
-        for ln in section.splitlines():
-            cand = f"{buf}\n{ln}" if buf else ln
-            if len(cand) <= max_chars:
-                buf = cand
-                continue
-            if buf:
-                messages.append(buf)
-            buf = ln
-        if buf:
-            current = buf
 
-    if current:
-        messages.append(current)
-    return messages
+def sample_thread_stacks(thread_id: int, seconds: float, *, interval_s: float = 0.005) -> Dict[str, Any]:
+    """在工作线程中对指定线程做栈采样（阻塞调用，需配合 asyncio.to_thread）。
 
+    self = 采样时位于栈顶的函数；total = 出现在栈中的函数（同一样本内去重，不含 asyncio 自身）。
+    栈顶位于 selectors 时视为事件循环空闲。
+    """
+    self_counts: Dict[str, int] = {}
+    total_counts: Dict[str, int] = {}
+    samples = idle = 0
+    started = time.monotonic()
+    deadline = started + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            if _is_idle_frame(frame):
+                idle += 1
+            else:
+                top = _frame_label(frame)
+                self_counts[top] = self_counts.get(top, 0) + 1
+                seen: set[str] = set()
+                while frame is not None:
+                    if not _is_loop_frame(frame):
+                        label = _frame_label(frame)
+                        if label not in seen:
+                            seen.add(label)
+                            total_counts[label] = total_counts.get(label, 0) + 1
+                    frame = frame.f_back
+            del frame
+        time.sleep(interval_s)
+    return {
+        "seconds": time.monotonic() - started,
+        "samples": samples,
+        "idle": idle,
+        "self": self_counts,
+        "total": total_counts,
+    }
+
+
+def format_profile_report(result: Dict[str, Any], *, top: int = 15) -> str:
+    samples = max(1, result["samples"])
+    lines = [
+        f"采样 {result['seconds']:.1f}s，{result['samples']} 个样本，空闲 {result['idle'] * 100 / samples:.1f}%",
+    ]
+    for title, key in (("自身 Top", "self"), ("累计 Top", "total")):
+        ranked = sorted(result[key].items(), key=lambda kv: kv[1], reverse=True)[:top]
+        lines.append("")
+        lines.append(f"{title} {len(ranked)}：")
+        if not ranked:
+            lines.append("  （无，事件循环全程空闲）")
+        for label, count in ranked:
+            lines.append(f"{count * 100 / samples:6.1f}%  {label}")
+    return "\n".join(lines)
 
-async def send_statusblock_html(bot, chat_id: int, text: str) -> bool:
-    parsed = parse_statusblock(text)
-    if not parsed:
-        return False
-    messages = render_statusblock_messages(parsed)
-    if not messages:
-        return False
-    for msg in messages:
-        await bot.send_message(chat_id=chat_id, text=msg, parse_mode='HTML', disable_web_page_preview=True)
-    return True
 
+_profile_lock = asyncio.Lock()
 
-def parse_status_fields_partial(text: str) -> Dict[str, str]:
-    text = _strip_code_fences(text or "")
-    lowered = text.lower()
 
-    start_tag = None
-    if "<stausblock" in lowered:
-        start_tag = "stausblock"
+def md_escape(text: object) -> str:
+    return escape_markdown(str(text), version=1)
+
+
+def strip_markdown_for_tts(text: str) -> str:
+    """清理 Markdown 格式符号，用于 TTS 朗读"""
+    s = str(text or "")
+    # 移除代码块 ```...```
+    s = re.sub(r'```[\s\S]*?```', '', s)
+    # 移除行内代码 `...`
+    s = re.sub(r'`[^`]*`', '', s)
+    # 移除加粗/斜体 **text** / *text* / __text__ / _text_
+    s = re.sub(r'\*\*(.+?)\*\*', r'\1', s)
+    s = re.sub(r'\*(.+?)\*', r'\1', s)
+    s = re.sub(r'__(.+?)__', r'\1', s)
+    s = re.sub(r'_(.+?)_', r'\1', s)
+    # 移除删除线 ~~text~~
+    s = re.sub(r'~~(.+?)~~', r'\1', s)
+    # 移除剩余的孤立格式符号
+    s = re.sub(r'[*_~`]+', '', s)
+    # 清理多余空白
+    s = re.sub(r'\n{3,}', '\n\n', s)
+    return s.strip()
+
+
+async def send_text_safe(send_func, text: str, *, parse_mode: str = None, reply_markup=None):
+    try:
+        if parse_mode:
+            return await send_func(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return await send_func(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if parse_mode and "Can't parse entities" in str(e):
+            return await send_func(text, reply_markup=reply_markup)
+        raise
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """容量有界的 TTL/LRU 映射：条目超过 ttl 秒失效，超过 maxsize 时淘汰最久未使用的。"""
+
+    def __init__(self, name: str, *, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any = True) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    add = set
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        expired = [k for k, (expires_at, _) in self._data.items() if expires_at <= now]
+        for k in expired:
+            del self._data[k]
+        self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self) -> str:
+        return f"{self.name}={len(self._data)}/{self.maxsize} (evicted {self.evictions}, expired {self.expirations})"
+
+
+class _UserRecord:
+    """Hot-path view of one user: allowlist flag + userSettings, keyed by int id."""
+
+    __slots__ = ("allowed", "llm_model", "voice_enabled", "tts_voice")
+
+    def __init__(self) -> None:
+        self.allowed: bool = False
+        self.llm_model: Optional[str] = None
+        self.voice_enabled: Optional[bool] = None
+        self.tts_voice: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return (
+            not self.allowed
+            and self.llm_model is None
+            and self.voice_enabled is None
+            and self.tts_voice is None
+        )
+
+    def settings_json(self) -> Dict[str, Any]:
+        entry: Dict[str, Any] = {}
+        if self.llm_model is not None:
+            entry["llmModel"] = self.llm_model
+        if self.voice_enabled is not None:
+            entry["voiceEnabled"] = self.voice_enabled
+        if self.tts_voice is not None:
+            entry["ttsVoice"] = self.tts_voice
+        return entry
+
+
+def _clean_setting_str(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    return value.strip() or None
+
+
+class AuthStore:
+    """auth.json 快照 + auth.json.journal 追加日志（JSON lines）。
+
+    每次修改只向 journal 追加一条记录（写入量与改动大小成正比）；journal 达到
+    TG_AUTH_JOURNAL_COMPACT_EVERY 条后压缩为新快照。启动时加载快照并重放 journal，
+    记录带递增 seq，快照中的 journalSeq 用于跳过已合并的记录。写入与 fsync 在线程中执行，不阻塞事件循环。
+
+    shared=True 时允许多个 bot 进程共用同一份库：写入在 auth.json.lock 上加 flock 排他锁，
+    并先追平其他进程追加的 journal；后台 refresh() 通过快照 inode/mtime 与 journal 长度
+    判断是否有变化，只重放新增记录，快照被替换时才整体重载。
+    """
+
+    _USER_SETTING_FIELDS = {"llmModel": "llm_model", "voiceEnabled": "voice_enabled", "ttsVoice": "tts_voice"}
+
+    def __init__(self, path: str, *, admin_user_id: int, registration_enabled_default: bool,
+                 compact_every: int = 500, shared: bool = False):
+        self.path = Path(path)
+        self.journal_path = self.path.with_suffix(self.path.suffix + ".journal")
+        self.lock_path = self.path.with_suffix(self.path.suffix + ".lock")
+        self.admin_user_id = admin_user_id
+        self.compact_every = max(1, int(compact_every))
+        if shared and fcntl is None:
+            logger.error("Auth DB shared mode requires fcntl (POSIX); falling back to single-process mode")
+            shared = False
+        self.shared = shared
+        self._lock = asyncio.Lock()
+        self._registration_default = registration_enabled_default
+        # userSettings 不保存在 data 中：由 _users 索引维护，仅在序列化时生成 JSON
+        self.data: Dict[str, Any] = {}
+        self._users: Dict[int, _UserRecord] = {}
+        self._seq = 0
+        self._reset_state()
+        self._journal_records = 0
+        self._journal_offset = 0
+        # journal 末尾有其他进程崩溃留下的半行（由 _replay_journal 在追平时发现）
+        self._journal_torn = False
+        self._journal_file = None
+        self._lock_fd: Optional[int] = None
+        self._snapshot_identity: Optional[tuple[int, int, int]] = None
+        self._loaded = False
+
+    def _load_tree(self, tree: Any) -> None:
+        if not isinstance(tree, dict):
+            tree = {}
+        settings = tree.pop("userSettings", None)
+        seq = tree.pop("journalSeq", 0)
+        self._seq = seq if isinstance(seq, int) else 0
+        for key in ("allowedUsers", "pendingUsers", "invites"):
+            if not isinstance(tree.get(key), dict):
+                tree[key] = {}
+        self.data = tree
+
+        users: Dict[int, _UserRecord] = {}
+        for key in tree["allowedUsers"]:
+            try:
+                uid = int(key)
+            except (TypeError, ValueError):
+                continue
+            users.setdefault(uid, _UserRecord()).allowed = True
+
+        if isinstance(settings, dict):
+            for key, entry in settings.items():
+                if not isinstance(entry, dict):
+                    continue
+                try:
+                    uid = int(key)
+                except (TypeError, ValueError):
+                    continue
+                rec = users.setdefault(uid, _UserRecord())
+                rec.llm_model = _clean_setting_str(entry.get("llmModel"))
+                enabled = entry.get("voiceEnabled")
+                rec.voice_enabled = enabled if isinstance(enabled, bool) else None
+                rec.tts_voice = _clean_setting_str(entry.get("ttsVoice"))
+                if rec.is_empty():
+                    users.pop(uid, None)
+        self._users = users
+
+    def _snapshot(self) -> Dict[str, Any]:
+        snapshot = dict(self.data)
+        settings: Dict[str, Any] = {}
+        for uid in sorted(self._users):
+            entry = self._users[uid].settings_json()
+            if entry:
+                settings[str(uid)] = entry
+        snapshot["userSettings"] = settings
+        snapshot["journalSeq"] = self._seq
+        return snapshot
+
+    def _record(self, user_id: int) -> _UserRecord:
+        rec = self._users.get(user_id)
+        if rec is None:
+            rec = self._users[user_id] = _UserRecord()
+        return rec
+
+    def _prune(self, user_id: int) -> None:
+        rec = self._users.get(user_id)
+        if rec is not None and rec.is_empty():
+            del self._users[user_id]
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        op = record.get("op")
+        if op == "registration":
+            self.data["registrationEnabled"] = bool(record.get("enabled"))
+        elif op == "request":
+            uid = int(record["userId"])
+            self.data["pendingUsers"][str(uid)] = {
+                "userId": uid,
+                "userName": record.get("userName") or "",
+                "requestedAt": record.get("at"),
+            }
+        elif op in ("approve", "invite_redeem"):
+            uid = int(record["userId"])
+            user_meta = self.data["pendingUsers"].pop(str(uid), None) or {}
+            if op == "invite_redeem":
+                code = record.get("code")
+                invite = self.data["invites"].get(code)
+                if invite is not None:
+                    invite["usesRemaining"] = int(invite.get("usesRemaining", 0)) - 1
+                    if invite["usesRemaining"] <= 0:
+                        self.data["invites"].pop(code, None)
+                user_name = record.get("userName") or ""
+                requested_at = None
+            else:
+                user_name = user_meta.get("userName") or ""
+                requested_at = user_meta.get("requestedAt")
+            self.data["allowedUsers"][str(uid)] = {
+                "userId": uid,
+                "userName": user_name,
+                "requestedAt": requested_at,
+                "approvedAt": record.get("at"),
+                "approvedBy": int(record.get("approvedBy") or 0),
+                "note": record.get("note") or "",
+            }
+            self._record(uid).allowed = True
+        elif op == "reject":
+            self.data["pendingUsers"].pop(str(record["userId"]), None)
+        elif op == "revoke":
+            uid = int(record["userId"])
+            self.data["allowedUsers"].pop(str(uid), None)
+            rec = self._users.get(uid)
+            if rec is not None:
+                rec.allowed = False
+                self._prune(uid)
+        elif op == "invite_create":
+            code = str(record["code"])
+            self.data["invites"][code] = {
+                "code": code,
+                "usesRemaining": 1,
+                "createdAt": record.get("at"),
+                "createdBy": int(record.get("createdBy") or 0),
+            }
+        elif op == "invite_drop":
+            self.data["invites"].pop(record.get("code"), None)
+        elif op == "expire":
+            for code in record.get("invites") or []:
+                self.data["invites"].pop(code, None)
+            for key in record.get("pending") or []:
+                self.data["pendingUsers"].pop(str(key), None)
+        elif op == "user_setting":
+            attr = self._USER_SETTING_FIELDS.get(record.get("field"))
+            if attr is None:
+                return
+            uid = int(record["userId"])
+            value = record.get("value")
+            if attr == "voice_enabled":
+                value = bool(value)
+            else:
+                value = _clean_setting_str(value)
+            setattr(self._record(uid), attr, value)
+            self._prune(uid)
+        else:
+            logger.warning(f"Auth journal: unknown op {op!r}")
+
+    def _reset_state(self) -> None:
+        self.data = {
+            "version": 1,
+            "registrationEnabled": self._registration_default,
+            "allowedUsers": {},
+            "pendingUsers": {},
+            "invites": {},
+        }
+        self._users = {}
+        self._seq = 0
+
+    def _replay_journal(self, start: int = 0) -> int:
+        """从字节偏移 start 开始应用 journal 中的完整行，返回应用条数并推进 _journal_offset。"""
+        try:
+            f = self.journal_path.open("rb")
+        except FileNotFoundError:
+            self._journal_offset = 0
+            self._journal_torn = False
+            return 0
+        applied = 0
+        with f:
+            f.seek(start)
+            chunk = f.read()
+        # 只消费以换行结尾的完整记录；剩余半行留到下次（或被下一次写入补齐换行后跳过）
+        end = chunk.rfind(b"\n") + 1
+        self._journal_torn = end < len(chunk)
+        for raw in chunk[:end].splitlines():
+            line = raw.strip()
+            if not line:
+                continue
+            self._journal_records += 1
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                # 进程在写入途中被杀：可能残留半行，直接丢弃
+                logger.warning("Auth journal: skipping truncated record")
+                continue
+            seq = record.get("seq") if isinstance(record, dict) else None
+            if not isinstance(seq, int) or seq <= self._seq:
+                continue
+            try:
+                self._apply(record)
+            except Exception as e:
+                logger.error(f"Auth journal replay failed at seq {seq}: {e}")
+            self._seq = seq
+            applied += 1
+        self._journal_offset = start + end
+        return applied
+
+    def _stat_identity(self, path: Path) -> Optional[tuple[int, int, int]]:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _reload_all(self) -> int:
+        self._reset_state()
+        self._journal_records = 0
+        self._snapshot_identity = self._stat_identity(self.path)
+        if self._snapshot_identity is not None:
+            try:
+                self._load_tree(json.loads(self.path.read_text(encoding='utf-8')))
+            except Exception as e:
+                logger.error(f"Auth DB load failed: {e}")
+        return self._replay_journal(0)
+
+    def _catch_up(self) -> None:
+        """共享模式：快照变化（其他进程压缩或手工编辑）则整体重载，否则只应用 journal 新增部分。"""
+        if self._stat_identity(self.path) != self._snapshot_identity:
+            replayed = self._reload_all()
+            logger.info(f"Auth DB changed on disk, reloaded snapshot (+{replayed} journal record(s))")
+            return
+        try:
+            size = self.journal_path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        if size < self._journal_offset:
+            self._reload_all()
+        elif size > self._journal_offset:
+            self._replay_journal(self._journal_offset)
+
+    def _changed_on_disk(self) -> bool:
+        if self._stat_identity(self.path) != self._snapshot_identity:
+            return True
+        try:
+            return self.journal_path.stat().st_size != self._journal_offset
+        except FileNotFoundError:
+            return self._journal_offset != 0
+
+    async def refresh(self) -> None:
+        """共享模式下由后台轮询调用：未变化时只有两次 stat。"""
+        if not self.shared or not self._changed_on_disk():
+            return
+        async with self._lock:
+            async with self._file_lock(exclusive=False):
+                self._catch_up()
+
+    def _lock_file(self) -> int:
+        if self._lock_fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._lock_fd
+
+    @contextlib.asynccontextmanager
+    async def _file_lock(self, *, exclusive: bool):
+        """跨进程 flock，不阻塞事件循环：拿不到时（LOCK_NB）短暂 sleep 后重试。
+
+        调用方必须持有 self._lock：flock 属于打开的文件描述，本进程的 refresh() 与写事务共用
+        _lock_fd，两者在进程内交错会把写事务的排他锁降级为共享锁，随后释放。
+        """
+        if not self.shared:
+            yield
+            return
+        fd = self._lock_file()
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(delay)
+                delay = min(0.05, delay * 2)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @contextlib.asynccontextmanager
+    async def _write_txn(self):
+        """进程内 asyncio 锁 + 共享模式下的跨进程排他锁；进入后状态已追平磁盘。"""
+        async with self._lock:
+            async with self._file_lock(exclusive=True):
+                if self.shared:
+                    self._catch_up()
+                yield
+
+    @contextlib.contextmanager
+    def _blocking_file_lock(self):
+        """仅供 load_sync 使用：模块加载时事件循环尚未运行，可以阻塞等待排他锁。"""
+        if not self.shared:
+            yield
+            return
+        fd = self._lock_file()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def load_sync(self) -> None:
+        if self._loaded:
+            return
+        with self._blocking_file_lock():
+            try:
+                replayed = self._reload_all()
+                if replayed:
+                    logger.info(f"Auth journal: replayed {replayed} record(s)")
+            except Exception as e:
+                logger.error(f"Auth journal replay failed: {e}")
+
+            try:
+                self._write_snapshot()
+            except Exception as e:
+                logger.error(f"Auth DB init failed: {e}")
+        self._loaded = True
+
+    def _snapshot_bytes(self) -> bytes:
+        return json.dumps(self._snapshot(), ensure_ascii=False, indent=2).encode("utf-8")
+
+    def _write_snapshot(self) -> None:
+        """写入新快照并清空 journal（先 fsync 快照再截断，崩溃时可按 seq 安全重放）。启动时同步调用。"""
+        runtime_stats.auth_writes.add()
+        with M_AUTH_WRITE_SECONDS.time(kind="snapshot"):
+            self._write_snapshot_unmeasured(self._snapshot_bytes())
+
+    def _write_snapshot_unmeasured(self, payload: bytes) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + f".{os.getpid()}.tmp")
+        with tmp_path.open("wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        with self.journal_path.open("wb"):
+            pass
+        self._journal_records = 0
+        self._journal_offset = 0
+        self._journal_torn = False
+        self._snapshot_identity = self._stat_identity(self.path)
+
+    def _append_journal_unmeasured(self, line: bytes) -> None:
+        if self._journal_file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._journal_file = self.journal_path.open("ab")
+        if self._journal_torn:
+            # 其他进程崩溃留下的半行：先补换行，避免与本条记录粘连。写事务开始时已在排他锁下追平
+            # journal，半行只能在那时发现，不必每次写入都 fstat
+            line = b"\n" + line
+            self._journal_torn = False
+        self._journal_file.write(line)
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+        self._journal_records += 1
+        self._journal_offset = self._journal_file.tell()
+
+    @staticmethod
+    async def _in_thread(func, *args) -> None:
+        """在线程中执行文件写入与 fsync，不阻塞事件循环。
+
+        线程里的写入无法取消：调用方被取消时仍等它结束再抛出 CancelledError，
+        期间一直持有 _write_txn 的锁，下一个写事务不会与之交错。
+        """
+        task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            await asyncio.wait({task})
+            raise
+
+    async def _commit_unlocked(self, op: str, **fields: Any) -> None:
+        # 调用方须在 _write_txn 内：写事务与 refresh() 都持有 _lock，写线程运行期间没有其他协程改动
+        # 库或 journal。读路径不加锁，在记录落盘前读到的是提交前的状态；落盘后（即使调用方已被取消）
+        # 立即应用到内存，否则下一条记录会复用同一个 seq
+        record: Dict[str, Any] = {"seq": self._seq + 1, "op": op, "at": _now_ms(), **fields}
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        runtime_stats.auth_writes.add()
+        written = False
+
+        def append() -> None:
+            nonlocal written
+            self._append_journal_unmeasured(line)
+            written = True
+
+        try:
+            with M_AUTH_WRITE_SECONDS.time(kind="journal"):
+                await self._in_thread(append)
+        finally:
+            if written:
+                self._seq = record["seq"]
+                self._apply(record)
+        if self._journal_records >= self.compact_every:
+            await self._save_unlocked()
+
+    async def _save_unlocked(self) -> None:
+        payload = self._snapshot_bytes()
+        runtime_stats.auth_writes.add()
+        with M_AUTH_WRITE_SECONDS.time(kind="snapshot"):
+            await self._in_thread(self._write_snapshot_unmeasured, payload)
+
+    async def save(self) -> None:
+        async with self._write_txn():
+            await self._save_unlocked()
+
+    async def close(self) -> None:
+        """等进行中的写入完成后关闭 journal 文件（每条记录写入时已 fsync）。"""
+        async with self._write_txn():
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+    def is_admin(self, user_id: int) -> bool:
+        return self.admin_user_id != 0 and user_id == self.admin_user_id
+
+    def is_allowed(self, user_id: int) -> bool:
+        if self.admin_user_id == 0 or user_id == self.admin_user_id:
+            return True
+        rec = self._users.get(user_id)
+        return rec is not None and rec.allowed
+
+    def registration_enabled(self) -> bool:
+        return bool(self.data.get("registrationEnabled", TG_REGISTRATION_ENABLED_DEFAULT))
+
+    async def set_registration_enabled(self, enabled: bool) -> None:
+        async with self._write_txn():
+            await self._commit_unlocked("registration", enabled=bool(enabled))
+
+    async def request_access(self, user_id: int, user_name: str) -> bool:
+        async with self._write_txn():
+            if self.is_allowed(user_id):
+                return False
+            await self._commit_unlocked("request", userId=int(user_id), userName=user_name)
+            return True
+
+    async def approve(self, user_id: int, *, approved_by: int, note: str = "") -> bool:
+        async with self._write_txn():
+            await self._commit_unlocked("approve", userId=int(user_id), approvedBy=int(approved_by), note=note)
+            return True
+
+    async def reject(self, user_id: int) -> bool:
+        async with self._write_txn():
+            if str(user_id) not in self.data["pendingUsers"]:
+                return False
+            await self._commit_unlocked("reject", userId=int(user_id))
+            return True
+
+    async def revoke(self, user_id: int) -> bool:
+        async with self._write_txn():
+            if str(user_id) not in self.data["allowedUsers"]:
+                return False
+            await self._commit_unlocked("revoke", userId=int(user_id))
+            return True
+
+    async def create_one_time_invite(self, *, created_by: int) -> str:
+        async with self._write_txn():
+            invites = self.data["invites"]
+            while True:
+                code = secrets.token_urlsafe(8)
+                if code not in invites:
+                    break
+            await self._commit_unlocked("invite_create", code=code, createdBy=int(created_by))
+            return code
+
+    async def redeem_invite(self, *, user_id: int, user_name: str, code: str, approved_by: int) -> bool:
+        async with self._write_txn():
+            if self.is_allowed(user_id):
+                return True
+            invite = self.data["invites"].get(code)
+            if not invite:
+                return False
+            if int(invite.get("usesRemaining", 0)) <= 0:
+                await self._commit_unlocked("invite_drop", code=code)
+                return False
+            await self._commit_unlocked(
+                "invite_redeem",
+                code=code,
+                userId=int(user_id),
+                userName=user_name,
+                approvedBy=int(approved_by),
+                note="invite",
+            )
+            return True
+
+    async def expire_stale(self, *, invite_ttl_ms: int, pending_ttl_ms: int) -> tuple[int, int]:
+        """清理过期邀请码与长期未审批的申请，返回 (invites, pending) 删除数量。"""
+        async with self._write_txn():
+            now = _now_ms()
+            invites: list[str] = []
+            pending: list[str] = []
+            if invite_ttl_ms > 0:
+                for code, invite in self.data["invites"].items():
+                    created_at = invite.get("createdAt") if isinstance(invite, dict) else None
+                    if not isinstance(created_at, (int, float)) or now - created_at > invite_ttl_ms:
+                        invites.append(code)
+            if pending_ttl_ms > 0:
+                for key, item in self.data["pendingUsers"].items():
+                    requested_at = item.get("requestedAt") if isinstance(item, dict) else None
+                    if not isinstance(requested_at, (int, float)) or now - requested_at > pending_ttl_ms:
+                        pending.append(key)
+            if invites or pending:
+                await self._commit_unlocked("expire", invites=invites, pending=pending)
+            return len(invites), len(pending)
+
+    def list_pending(self) -> list[dict]:
+        pending = self.data["pendingUsers"]
+        return [pending[k] for k in sorted(pending.keys())]
+
+    def list_allowed(self) -> list[dict]:
+        allowed = self.data["allowedUsers"]
+        return [allowed[k] for k in sorted(allowed.keys())]
+
+    def get_user_llm_model(self, user_id: int) -> Optional[str]:
+        rec = self._users.get(user_id)
+        return rec.llm_model if rec is not None else None
+
+    async def set_user_llm_model(self, user_id: int, model: Optional[str]) -> None:
+        async with self._write_txn():
+            await self._commit_unlocked("user_setting", userId=int(user_id), field="llmModel", value=_clean_setting_str(model))
+
+    def get_user_voice_enabled(self, user_id: int) -> bool:
+        rec = self._users.get(user_id)
+        return rec is not None and rec.voice_enabled is True
+
+    async def set_user_voice_enabled(self, user_id: int, enabled: bool) -> None:
+        async with self._write_txn():
+            await self._commit_unlocked("user_setting", userId=int(user_id), field="voiceEnabled", value=bool(enabled))
+
+    def get_user_tts_voice(self, user_id: int) -> Optional[str]:
+        rec = self._users.get(user_id)
+        return rec.tts_voice if rec is not None else None
+
+    async def set_user_tts_voice(self, user_id: int, voice: Optional[str]) -> None:
+        async with self._write_txn():
+            await self._commit_unlocked("user_setting", userId=int(user_id), field="ttsVoice", value=_clean_setting_str(voice))
+
+
+class SSERecording:
+    __slots__ = ("started", "events")
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.events: list[list] = []
+
+    def add(self, event: Dict[str, Any]) -> None:
+        self.events.append([round((time.monotonic() - self.started) * 1000, 1), event])
+
+    async def tee(self, events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """在后台任务中读取 events，到达时即记录时间；消费方编辑消息、等待 RetryAfter 的耗时
+        不会计入事件间隔。事件经无界队列交给消费方（单条回复的事件数有限）。"""
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump() -> None:
+            try:
+                async for event in events:
+                    self.add(event)
+                    queue.put_nowait(event)
+                queue.put_nowait(_MISSING)
+            except Exception as e:
+                queue.put_nowait(e)
+
+        task = asyncio.create_task(pump())
+        try:
+            while True:
+                item = await queue.get()
+                if item is _MISSING:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+
+class SSERecorder:
+    """把插件 SSE 流的事件及其相对请求开始的毫秒数保存为 gzip JSON，每个流一个文件。
+
+    写文件放到线程中执行，不占用事件循环；bench/fake_servers.py 按原速或缩放后的速度回放。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.saved = 0
+        self._pending: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def begin(self) -> Optional[SSERecording]:
+        return SSERecording() if self.enabled else None
+
+    def finish(self, recording: Optional[SSERecording]) -> None:
+        if recording is None or not recording.events:
+            return
+        payload = {
+            "version": 1,
+            "recordedAt": int(time.time() * 1000),
+            "traceId": current_trace_id(),
+            "events": recording.events,
+        }
+        task = asyncio.create_task(self._save(payload))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def flush(self) -> None:
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _save(self, payload: Dict[str, Any]) -> None:
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}.json.gz"
+        try:
+            await asyncio.to_thread(self._write, Path(self.directory) / name, payload)
+            self.saved += 1
+        except Exception as e:
+            logger.error(f"SSE recording save failed: {e}")
+
+    @staticmethod
+    def _write(path: Path, payload: Dict[str, Any]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(gzip.compress(data))
+        os.replace(tmp, path)
+
+
+sse_recorder = SSERecorder(TG_SSE_RECORD_DIR)
+
+
+class SillyTavernClient:
+    """SillyTavern API Client"""
+
+    def __init__(self, base_url: str, api_prefix: str = ''):
+        self.base_url = base_url.rstrip('/')
+        self.api_prefix = api_prefix
+
+    @contextlib.contextmanager
+    def _measure(self, path: str):
+        started = time.monotonic()
+        try:
+            with M_ST_REQUEST_SECONDS.time(endpoint=path), span("st.request", endpoint=path):
+                yield
+        except Exception:
+            M_ST_REQUEST_ERRORS.inc(endpoint=path)
+            raise
+        finally:
+            runtime_stats.st_latency.observe(time.monotonic() - started)
+
+    async def _get(self, path: str, params: dict = None) -> Dict[str, Any]:
+        url = f"{self.base_url}{self.api_prefix}{path}"
+        with self._measure(path):
+            response = await http_client.get(url, params=params)
+            response.raise_for_status()
+        return response.json()
+
+    async def _post(self, path: str, data: dict) -> Dict[str, Any]:
+        url = f"{self.base_url}{self.api_prefix}{path}"
+        with self._measure(path):
+            response = await http_client.post(url, json=data)
+            response.raise_for_status()
+        return response.json()
+
+    async def get_plugin_config(self) -> Dict[str, Any]:
+        return await self._get('/config')
+
+    async def set_plugin_config(self, updates: dict) -> Dict[str, Any]:
+        return await self._post('/config', updates)
+
+    async def health_check(self) -> bool:
+        try:
+            result = await self._get('/health')
+            return result.get('success', False)
+        except Exception:
+            return False
+
+    async def get_characters(self) -> Dict[str, Any]:
+        return await self._get('/characters')
+
+    async def get_presets(self) -> Dict[str, Any]:
+        return await self._get('/presets')
+
+    async def get_worldinfo(self) -> Dict[str, Any]:
+        return await self._get('/worldinfo')
+
+    async def get_session(self, user_id: str) -> Dict[str, Any]:
+        return await self._get('/session', {'telegramUserId': user_id})
+
+    async def switch_character(self, user_id: str, char_id: int,
+                                preset: str = None, world: str = None) -> Dict[str, Any]:
+        data = {'telegramUserId': user_id, 'characterId': char_id}
+        if preset:
+            data['presetName'] = preset
+        if world is not None:
+            data['worldInfoName'] = world
+        return await self._post('/character/switch', data)
+
+    async def set_preset(self, user_id: str, preset_name: str) -> Dict[str, Any]:
+        return await self._post('/session/preset', {
+            'telegramUserId': user_id,
+            'presetName': preset_name
+        })
+
+    async def set_worldinfo(self, user_id: str, world_name: str) -> Dict[str, Any]:
+        return await self._post('/session/worldinfo', {
+            'telegramUserId': user_id,
+            'worldInfoName': world_name
+        })
+
+    async def send_message(self, user_id: str, message: str, user_name: str, llm_model: Optional[str] = None) -> Dict[str, Any]:
+        payload = {
+            'telegramUserId': user_id,
+            'message': message,
+            'user': user_name
+        }
+        if isinstance(llm_model, str) and llm_model.strip():
+            payload['llmModel'] = llm_model.strip()
+        update_journal.mark_dispatched()
+        return await self._post('/send', payload)
+
+    @staticmethod
+    def _tts_payload(text: str, tts_model: Optional[str], voice: Optional[str], response_format: Optional[str]) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {"text": str(text or "")}
+        if isinstance(tts_model, str) and tts_model.strip():
+            payload["ttsModel"] = tts_model.strip()
+        if isinstance(voice, str) and voice.strip():
+            payload["voice"] = voice.strip()
+        if isinstance(response_format, str) and response_format.strip():
+            payload["format"] = response_format.strip()
+        return payload
+
+    async def tts(self, text: str, *, tts_model: Optional[str] = None, voice: Optional[str] = None, response_format: Optional[str] = None) -> bytes:
+        url = f"{self.base_url}{self.api_prefix}/tts"
+        with self._measure("/tts"):
+            response = await http_client.post(url, json=self._tts_payload(text, tts_model, voice, response_format))
+            response.raise_for_status()
+        return response.content
+
+    @contextlib.asynccontextmanager
+    async def tts_stream(self, text: str, *, tts_model: Optional[str] = None, voice: Optional[str] = None,
+                         response_format: Optional[str] = None) -> AsyncIterator[httpx.Response]:
+        """与 tts() 相同，但返回未读取的响应，由调用方按块消费 body。"""
+        url = f"{self.base_url}{self.api_prefix}/tts"
+        payload = self._tts_payload(text, tts_model, voice, response_format)
+        async with http_client.stream("POST", url, json=payload) as response:
+            if response.is_error:
+                # 读出错误 body，report_tts_error 需要其中的 error 字段
+                await response.aread()
+            response.raise_for_status()
+            yield response
+
+    async def send_message_stream(self, user_id: str, message: str, user_name: str, llm_model: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        url = f"{self.base_url}{self.api_prefix}/send/stream"
+        payload = {
+            'telegramUserId': user_id,
+            'message': message,
+            'user': user_name
+        }
+        if isinstance(llm_model, str) and llm_model.strip():
+            payload['llmModel'] = llm_model.strip()
+
+        started = time.monotonic()
+        recording = sse_recorder.begin()
+        update_journal.mark_dispatched()
+        try:
+            async with http_client.stream(
+                "POST",
+                url,
+                json=payload,
+                headers={"Accept": "text/event-stream"},
+                timeout=None,
+            ) as response:
+                if response.is_error:
+                    M_ST_REQUEST_ERRORS.inc(endpoint="/send/stream")
+                response.raise_for_status()
+                # 流式接口只统计到响应头返回的时间，首个 token 由 stream_first_token_seconds 统计
+                M_ST_REQUEST_SECONDS.observe(time.monotonic() - started, endpoint="/send/stream")
+                runtime_stats.st_latency.observe(time.monotonic() - started)
+                events = self._sse_events(response.aiter_lines())
+                if recording is not None:
+                    events = recording.tee(events)
+                async for event in events:
+                    yield event
+        finally:
+            sse_recorder.finish(recording)
+
+    @staticmethod
+    async def _sse_events(lines: AsyncIterator[str]) -> AsyncIterator[Dict[str, Any]]:
+        async for line in lines:
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if not data:
+                continue
+            try:
+                event = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            yield event
+
+    async def get_history(self, user_id: str, limit: int = 10, character_id: str = None) -> Dict[str, Any]:
+        params = {'telegramUserId': user_id, 'limit': limit}
+        if character_id is not None:
+            params['characterId'] = character_id
+        return await self._get('/history', params)
+
+    async def get_history_summary(self, user_id: str) -> Dict[str, Any]:
+        return await self._get('/history/summary', {'telegramUserId': user_id})
+
+    async def clear_history(self, user_id: str) -> Dict[str, Any]:
+        return await self._post('/history/clear', {'telegramUserId': user_id})
+
+    async def clear_all_history(self, user_id: str) -> Dict[str, Any]:
+        return await self._post('/history/clear/all', {'telegramUserId': user_id})
+
+    async def get_greeting(self, user_id: str, user_name: str) -> Dict[str, Any]:
+        return await self._get('/greeting', {
+            'telegramUserId': user_id,
+            'userName': user_name
+        })
+
+    async def switch_greeting(self, user_id: str, direction: str) -> Dict[str, Any]:
+        """切换开场白 (next/prev/random)"""
+        return await self._post('/greeting/switch', {
+            'telegramUserId': user_id,
+            'greetingIndex': direction
+        })
+
+
+# Global client
+st_client = SillyTavernClient(SILLYTAVERN_URL, PLUGIN_API_BASE)
+
+auth_store = AuthStore(
+    TG_AUTH_DB_PATH,
+    admin_user_id=ALLOWED_USER_ID,
+    registration_enabled_default=TG_REGISTRATION_ENABLED_DEFAULT,
+    compact_every=TG_AUTH_JOURNAL_COMPACT_EVERY,
+    shared=TG_AUTH_SHARED,
+)
+auth_store.load_sync()
+
+def is_authorized(user_id: int) -> bool:
+    return auth_store.is_allowed(user_id)
+
+
+def is_admin(user_id: int) -> bool:
+    return auth_store.is_admin(user_id)
+
+
+def get_register_help_text() -> str:
+    if ALLOWED_USER_ID == 0:
+        return "✅ 当前未启用授权限制（ALLOWED_USER_ID=0）"
+    if not auth_store.registration_enabled():
+        return "⛔ 当前未开放注册，请联系管理员开通。"
+    return (
+        "你尚未获得使用权限。\n\n"
+        "注册方式：\n"
+        "1) 有邀请码：发送 `/register <邀请码>`\n"
+        "2) 无邀请码：发送 `/register` 申请（管理员审批）"
+    )
+
+
+_last_register_hint_at = TTLCache("register_hint", maxsize=TG_BOOKKEEPING_MAX_USERS, ttl=10.0)
+
+
+async def run_housekeeping_once() -> None:
+    caches = (_last_register_hint_at, _tts_warned_user_ids, _voice_send_warned_user_ids)
+    for cache in caches:
+        cache.sweep()
+    await voice_file_ids.flush()
+    await tts_cache.housekeep()
+    span_exporter.flush()
+    invites, pending = await auth_store.expire_stale(
+        invite_ttl_ms=int(TG_INVITE_TTL_HOURS * 3600 * 1000),
+        pending_ttl_ms=int(TG_PENDING_TTL_HOURS * 3600 * 1000),
+    )
+    logger.info(
+        "Housekeeping: " + ", ".join(c.stats() for c in caches)
+        + f", {tts_cache.stats()}, {tts_router.stats()}, {audio_transcoder.stats()}, {voice_file_ids.stats()}, {voice_pool.stats()}, {tts_prewarmer.stats()}, {loop_watchdog.stats()}, {update_journal.stats()}; expired invites={invites}, pending={pending}"
+    )
+
+
+async def housekeeping_loop(interval_s: float) -> None:
+    while True:
+        await asyncio.sleep(max(10.0, interval_s))
+        try:
+            await run_housekeeping_once()
+        except Exception as e:
+            logger.error(f"Housekeeping error: {e}")
+
+
+async def auth_refresh_loop(interval_ms: int) -> None:
+    interval_s = max(0.1, interval_ms / 1000.0)
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await auth_store.refresh()
+        except Exception as e:
+            logger.error(f"Auth DB refresh error: {e}")
+
+
+async def maybe_send_register_hint(update: Update) -> None:
+    if not update.effective_chat or update.effective_chat.type != 'private':
+        return
+    user = update.effective_user
+    if not user:
+        return
+    message = update.effective_message
+    if not message:
+        return
+    if user.id in _last_register_hint_at:
+        return
+    _last_register_hint_at.add(user.id)
+    try:
+        await send_text_safe(message.reply_text, get_register_help_text(), parse_mode='Markdown')
+    except Exception:
+        pass
+
+
+def get_main_menu(user_id: Optional[int] = None) -> InlineKeyboardMarkup:
+    voice_enabled = auth_store.get_user_voice_enabled(user_id) if isinstance(user_id, int) else False
+    voice_label = "🔊 语音回复：开" if voice_enabled else "🔇 语音回复：关"
+    keyboard = [
+        [InlineKeyboardButton("🎭 选择角色", callback_data="menu_characters")],
+        [InlineKeyboardButton("📋 选择预设", callback_data="menu_presets")],
+        [InlineKeyboardButton("📚 选择世界书", callback_data="menu_worldinfo")],
+        [InlineKeyboardButton("📜 查看历史", callback_data="menu_history")],
+        [InlineKeyboardButton("🗑️ 清除当前角色历史", callback_data="menu_clear")],
+        [InlineKeyboardButton("🧹 一键清除全部历史", callback_data="menu_clear_all")],
+        [InlineKeyboardButton("ℹ️ 当前状态", callback_data="menu_status")],
+    ]
+    keyboard.insert(3, [InlineKeyboardButton("🧠 我的模型", callback_data="menu_my_model")])
+    keyboard.insert(4, [InlineKeyboardButton(voice_label, callback_data="menu_voice_toggle")])
+    keyboard.insert(5, [InlineKeyboardButton("🎙️ 选择音色", callback_data="menu_tts_voice")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def send_typing_periodically(chat, interval_ms: int) -> None:
+    interval_s = max(0.5, interval_ms / 1000.0)
+    try:
+        while True:
+            try:
+                await chat.send_action('typing')
+            except Exception:
+                pass
+            await asyncio.sleep(interval_s)
+    except asyncio.CancelledError:
+        return
+
+
+async def edit_message_if_changed(message_obj, text: str) -> None:
+    try:
+        if getattr(message_obj, "text", None) == text:
+            return
+        M_TELEGRAM_EDITS.inc()
+        with span("telegram.edit", chars=len(text)):
+            await message_obj.edit_text(text)
+    except RetryAfter:
+        M_TELEGRAM_RETRY_AFTER.inc(method="editMessageText")
+        raise
+    except BadRequest as e:
+        if "Message is not modified" in str(e):
+            return
+        raise
+
+
+async def edit_message_html_if_changed(message_obj, html_text: str) -> None:
+    try:
+        M_TELEGRAM_EDITS.inc()
+        with span("telegram.edit", chars=len(html_text), html=True):
+            await message_obj.edit_text(html_text, parse_mode='HTML', disable_web_page_preview=True)
+    except RetryAfter:
+        M_TELEGRAM_RETRY_AFTER.inc(method="editMessageText")
+        raise
+    except BadRequest as e:
+        if "Message is not modified" in str(e):
+            return
+        if "Can't parse entities" in str(e):
+            safe = re.sub(r"<[^>]+>", "", html_text)
+            await edit_message_if_changed(message_obj, safe)
+            return
+        raise
+
+
+async def send_long_plain_text(bot, chat_id: int, text: str, *, chunk_size: int = 4000) -> None:
+    if not text:
+        return
+    for i in range(0, len(text), chunk_size):
+        await bot.send_message(chat_id=chat_id, text=text[i:i + chunk_size])
+
+
+def looks_like_preformatted_block(text: str) -> bool:
+    if not text:
+        return False
+    lowered = text.lower()
+    return (
+        "<stausblock" in lowered
+        or "<statusblock" in lowered
+        or "```xml" in lowered
+        or "```" in lowered and ("<stausblock" in lowered or "<statusblock" in lowered)
+    )
+
+
+def _strip_code_fences(text: str) -> str:
+    if not text:
+        return text
+    stripped = text.strip()
+    if stripped.startswith("```") and stripped.endswith("```"):
+        inner = stripped[3:-3]
+        inner = re.sub(r"^\s*[a-zA-Z0-9_-]+\s*\n", "", inner, count=1)
+        return inner.strip()
+    return text
+
+
+def _markdown_bold_to_html(escaped: str) -> str:
+    return re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", escaped)
+
+
+def parse_statusblock(text: str) -> Optional[Dict[str, str]]:
+    if not text:
+        return None
+    text = _strip_code_fences(text)
+    lowered = text.lower()
+    if "<stausblock" not in lowered and "<statusblock" not in lowered:
+        return None
+
+    match = re.search(r"<(stausblock|statusblock)>([\s\S]*?)</\1>", text, flags=re.IGNORECASE)
+    if not match:
+        return None
+
+    inner = match.group(2)
+    pairs = re.findall(r"<([^<>/\s]+)>([\s\S]*?)</\1>", inner)
+    if not pairs:
+        return None
+
+    result: Dict[str, str] = {}
+    for tag, value in pairs:
+        tag = str(tag).strip()
+        value = str(value).strip()
+        if not tag:
+            continue
+        result[tag] = value
+    return result or None
+
+
+def render_statusblock_messages(fields: Dict[str, str]) -> list[str]:
+    header_keys = ["天气", "地点", "日期", "时间"]
+    body_key = "正文"
+    tips_key = "TIPS"
+
+    def line(label: str, value: str) -> str:
+        escaped_value = _markdown_bold_to_html(html.escape(value, quote=False))
+        return f"<b>{html.escape(label, quote=False)}：</b>{escaped_value}"
+
+    sections: list[str] = []
+
+    header_lines: list[str] = []
+    for key in header_keys:
+        if fields.get(key):
+            header_lines.append(line(key, fields[key]))
+    if header_lines:
+        sections.append("\n".join(header_lines))
+
+    if fields.get(body_key):
+        body = _markdown_bold_to_html(html.escape(fields[body_key], quote=False))
+        sections.append(f"<b>正文</b>\n{body}")
+
+    if fields.get(tips_key):
+        tips_raw = fields[tips_key].strip()
+        tips_lines = [l.strip() for l in tips_raw.splitlines() if l.strip()]
+        tips_html = "\n".join(html.escape(l, quote=False) for l in tips_lines)
+        sections.append(f"<b>行动建议</b>\n{tips_html}")
+
+    skip = set(header_keys + [body_key, tips_key])
+    rest_lines: list[str] = []
+    for key, value in fields.items():
+        if key in skip:
+            continue
+        value = str(value).strip()
+        if not value:
+            continue
+        rest_lines.append(line(key, value))
+    if rest_lines:
+        sections.append("<b>状态</b>\n" + "\n".join(rest_lines))
+
+    messages: list[str] = []
+    current = ""
+    max_chars = 3500
+
+    for section in sections:
+        section = section.strip()
+        if not section:
+            continue
+        candidate = f"{current}\n\n{section}" if current else section
+        if len(candidate) <= max_chars:
+            current = candidate
+            continue
+        if current:
+            messages.append(current)
+            current = ""
+        if len(section) <= max_chars:
+            current = section
+            continue
+        buf = ""
+        for ln in section.splitlines():
+            cand = f"{buf}\n{ln}" if buf else ln
+            if len(cand) <= max_chars:
+                buf = cand
+                continue
+            if buf:
+                messages.append(buf)
+            buf = ln
+        if buf:
+            current = buf
+
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def send_statusblock_html(bot, chat_id: int, text: str) -> bool:
+    parsed = parse_statusblock(text)
+    if not parsed:
+        return False
+    messages = render_statusblock_messages(parsed)
+    if not messages:
+        return False
+    for msg in messages:
+        await bot.send_message(chat_id=chat_id, text=msg, parse_mode='HTML', disable_web_page_preview=True)
+    return True
+
+
+def parse_status_fields_partial(text: str) -> Dict[str, str]:
+    text = _strip_code_fences(text or "")
+    lowered = text.lower()
+
+    start_tag = None
+    if "<stausblock" in lowered:
+        start_tag = "stausblock"
     elif "<statusblock" in lowered:
         start_tag = "statusblock"
     if not start_tag:
         return {}
 
-    start_marker = f"<{start_tag}>"
-    start_index = lowered.find(start_marker)
-    if start_index == -1:
-        return {}
+    start_marker = f"<{start_tag}>"
+    start_index = lowered.find(start_marker)
+    if start_index == -1:
+        return {}
+
+    inner = text[start_index + len(start_marker):]
+    end_marker = f"</{start_tag}>"
+    end_index = inner.lower().find(end_marker)
+    if end_index != -1:
+        inner = inner[:end_index]
+
+    pairs = re.findall(r"<([^<>/\s]+)>([\s\S]*?)</\1>", inner)
+    result: Dict[str, str] = {}
+    for tag, value in pairs:
+        tag = str(tag).strip()
+        if not tag or tag.lower() in ("stausblock", "statusblock"):
+            continue
+        result[tag] = str(value).strip()
+    return result
+
+
+def extract_partial_between(text: str, start_tag: str, end_tag: str, *, stop_tags: Optional[list[str]] = None) -> Optional[str]:
+    if not text:
+        return None
+    lowered = text.lower()
+    start = lowered.find(start_tag.lower())
+    if start == -1:
+        return None
+    start += len(start_tag)
+    after = text[start:]
+    after_lower = after.lower()
+
+    candidates: list[int] = []
+    end_pos = after_lower.find(end_tag.lower())
+    if end_pos != -1:
+        candidates.append(end_pos)
+
+    if stop_tags:
+        for tag in stop_tags:
+            p = after_lower.find(tag.lower())
+            if p != -1:
+                candidates.append(p)
+
+    cut = min(candidates) if candidates else len(after)
+    return after[:cut].strip()
+
+
+def split_text_pages(text: str, *, max_chars: int) -> list[str]:
+    if not text:
+        return [""]
+    pages: list[str] = []
+    remaining = text
+    while remaining:
+        if len(remaining) <= max_chars:
+            pages.append(remaining)
+            break
+        cut = remaining.rfind("\n", 0, max_chars)
+        if cut == -1 or cut < int(max_chars * 0.6):
+            cut = max_chars
+        pages.append(remaining[:cut].rstrip())
+        remaining = remaining[cut:].lstrip("\n")
+    return pages or [""]
+
+
+def render_status_panel_html(fields: Dict[str, str]) -> str:
+    if not fields:
+        return "状态读取中…"
+
+    header_order = ["天气", "地点", "日期", "时间"]
+    exclude = {"正文"}
+
+    lines: list[str] = []
+    for key in header_order:
+        if fields.get(key):
+            val = _markdown_bold_to_html(html.escape(fields[key], quote=False))
+            lines.append(f"<b>{html.escape(key, quote=False)}：</b>{val}")
+
+    other_keys = [k for k in fields.keys() if k not in set(header_order) and k not in exclude]
+    other_keys.sort()
+    for key in other_keys:
+        value = fields.get(key)
+        if not value:
+            continue
+        val = _markdown_bold_to_html(html.escape(str(value), quote=False))
+        lines.append(f"<b>{html.escape(key, quote=False)}：</b>{val}")
+
+    max_chars = 3500
+    output = ""
+    shown = 0
+    for ln in lines:
+        candidate = f"{output}\n{ln}" if output else ln
+        if len(candidate) > max_chars:
+            break
+        output = candidate
+        shown += 1
+
+    if shown < len(lines):
+        output += f"\n<b>…</b> 还有 {len(lines) - shown} 项（生成中/稍后发送）"
+    return output if output else "状态读取中…"
+
+
+def render_body_html(body: str) -> str:
+    escaped = _markdown_bold_to_html(html.escape(body or "", quote=False))
+    return escaped if escaped else "…"
+
+
+def render_tips_html(tips: str) -> str:
+    lines = [l.strip() for l in (tips or "").splitlines() if l.strip()]
+    joined = "\n".join(html.escape(l, quote=False) for l in lines)
+    return f"<b>行动建议</b>\n{joined}" if joined else "<b>行动建议</b>\n（无）"
+
+
+def render_full_state_messages(fields: Dict[str, str], *, exclude_keys: Optional[set[str]] = None) -> list[str]:
+    exclude_keys = exclude_keys or set()
+    items = [(k, v) for k, v in fields.items() if k not in exclude_keys and str(v).strip()]
+    if not items:
+        return []
+    items.sort(key=lambda kv: kv[0])
+
+    blocks: list[str] = []
+    current = "<b>状态（完整）</b>\n"
+    max_chars = 3500
+    for k, v in items:
+        line = f"<b>{html.escape(k, quote=False)}：</b>{_markdown_bold_to_html(html.escape(str(v), quote=False))}\n"
+        if len(current) + len(line) > max_chars:
+            blocks.append(current.rstrip())
+            current = "<b>状态（续）</b>\n" + line
+        else:
+            current += line
+    if current.strip():
+        blocks.append(current.rstrip())
+    return blocks
+
+
+def chunk_preformatted_html(text: str, *, max_message_chars: int = 3800) -> list[str]:
+    escaped_lines = html.escape(text, quote=False).splitlines()
+    chunks: list[str] = []
+    current = ""
+
+    def flush() -> None:
+        nonlocal current
+        if current:
+            chunks.append(current)
+            current = ""
+
+    for line in escaped_lines:
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > max_message_chars:
+            flush()
+            if len(line) > max_message_chars:
+                for i in range(0, len(line), max_message_chars):
+                    chunks.append(line[i:i + max_message_chars])
+            else:
+                current = line
+        else:
+            current = candidate
+
+    flush()
+    return chunks
+
+
+async def send_preformatted_html(bot, chat_id: int, text: str, *, max_message_chars: int = 3800) -> None:
+    if not text:
+        return
+
+    for chunk in chunk_preformatted_html(text, max_message_chars=max_message_chars):
+        payload = f"<pre>\n{chunk}\n</pre>"
+        await bot.send_message(chat_id=chat_id, text=payload, parse_mode='HTML')
+
+
+# Edge TTS 常量（模拟 Microsoft Translator App）
+_EDGE_ENDPOINT_URL = "https://dev.microsofttranslator.com/apps/endpoint?api-version=1.0"
+_EDGE_USER_AGENT = "okhttp/4.5.0"
+_EDGE_CLIENT_VERSION = "4.0.530a 5fe1dc6c"
+_EDGE_USER_ID = "0f04d16a175c411e"
+_EDGE_HOME_REGION = "zh-Hans-CN"
+_EDGE_CLIENT_TRACE_ID = "aab069b9-70a7-4844-a734-96cd78d94be9"
+_EDGE_DECODE_KEY = "oik6PdDdMnOXemTbwvMn9de/h9lFnfBaCWbGMMZqqoSaQaqUOqjVGm5NqsmjcBI1x+sS9ugjB55HEJWRiFXYFw=="
+
+_edge_endpoint_lock = asyncio.Lock()
+_edge_endpoint_cache: Optional[dict] = None
+_edge_endpoint_expires_at: float = 0.0
+
 
-    inner = text[start_index + len(start_marker):]
-    end_marker = f"</{start_tag}>"
-    end_index = inner.lower().find(end_marker)
-    if end_index != -1:
-        inner = inner[:end_index]
+def _edge_sign(url_str: str) -> str:
+    """生成 Microsoft Translator 签名"""
+    u = url_str.split("://")[1]
+    encoded_url = quote(u, safe='')
+    uuid_str = str(uuid.uuid4()).replace("-", "")
+    formatted_date = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S").lower() + "gmt"
+    bytes_to_sign = f"MSTranslatorAndroidApp{encoded_url}{formatted_date}{uuid_str}".lower().encode('utf-8')
+    decode = base64.b64decode(_EDGE_DECODE_KEY)
+    hmac_sha256 = hmac.new(decode, bytes_to_sign, hashlib.sha256)
+    secret_key = hmac_sha256.digest()
+    sign_base64 = base64.b64encode(secret_key).decode()
+    return f"MSTranslatorAndroidApp::{sign_base64}::{formatted_date}::{uuid_str}"
 
-    pairs = re.findall(r"<([^<>/\s]+)>([\s\S]*?)</\1>", inner)
-    result: Dict[str, str] = {}
-    for tag, value in pairs:
-        tag = str(tag).strip()
-        if not tag or tag.lower() in ("stausblock", "statusblock"):
+
+async def _edge_get_endpoint() -> dict:
+    """获取 TTS endpoint（带缓存）"""
+    global _edge_endpoint_cache, _edge_endpoint_expires_at
+
+    now = time.time()
+    if _edge_endpoint_cache and now < _edge_endpoint_expires_at - 60:
+        return _edge_endpoint_cache
+
+    async with _edge_endpoint_lock:
+        now = time.time()
+        if _edge_endpoint_cache and now < _edge_endpoint_expires_at - 60:
+            return _edge_endpoint_cache
+
+        signature = _edge_sign(_EDGE_ENDPOINT_URL)
+        headers = {
+            "Accept-Language": "zh-Hans",
+            "X-ClientVersion": _EDGE_CLIENT_VERSION,
+            "X-UserId": _EDGE_USER_ID,
+            "X-HomeGeographicRegion": _EDGE_HOME_REGION,
+            "X-ClientTraceId": _EDGE_CLIENT_TRACE_ID,
+            "X-MT-Signature": signature,
+            "User-Agent": _EDGE_USER_AGENT,
+            "Content-Type": "application/json; charset=utf-8",
+        }
+        resp = await tts_http_client.post(_EDGE_ENDPOINT_URL, headers=headers, content=b"")
+        resp.raise_for_status()
+        endpoint = resp.json()
+
+        # 解析 JWT 获取过期时间
+        jwt_parts = endpoint['t'].split('.')
+        if len(jwt_parts) >= 2:
+            jwt_payload = jwt_parts[1]
+            # 补齐 base64 padding
+            padding = 4 - len(jwt_payload) % 4
+            if padding != 4:
+                jwt_payload += '=' * padding
+            decoded_jwt = json.loads(base64.b64decode(jwt_payload).decode('utf-8'))
+            _edge_endpoint_expires_at = decoded_jwt.get('exp', now + 600)
+        else:
+            _edge_endpoint_expires_at = now + 600
+
+        _edge_endpoint_cache = endpoint
+        return endpoint
+
+
+def _edge_build_ssml(text: str, *, voice_name: str, rate: str, pitch: str, style: str) -> str:
+    """构建 SSML"""
+    safe_text = html.escape(str(text or ""), quote=False)
+    safe_voice = html.escape(str(voice_name or EDGE_TTS_DEFAULT_VOICE), quote=True)
+    safe_style = html.escape(str(style or EDGE_TTS_DEFAULT_STYLE), quote=True)
+
+    return (
+        '<speak xmlns="http://www.w3.org/2001/10/synthesis" '
+        'xmlns:mstts="http://www.w3.org/2001/mstts" version="1.0" xml:lang="zh-CN">'
+        f'<voice name="{safe_voice}">'
+        f'<mstts:express-as style="{safe_style}" styledegree="1.0" role="default">'
+        f'<prosody rate="{rate}%" pitch="{pitch}%">{safe_text}</prosody>'
+        '</mstts:express-as>'
+        '</voice>'
+        '</speak>'
+    )
+
+
+async def _edge_tts_request(text: str, voice_name: Optional[str]) -> httpx.Request:
+    endpoint = await _edge_get_endpoint()
+    voice = (voice_name or EDGE_TTS_DEFAULT_VOICE).strip() or EDGE_TTS_DEFAULT_VOICE
+    ssml = _edge_build_ssml(
+        str(text or ""),
+        voice_name=voice,
+        rate=EDGE_TTS_DEFAULT_RATE,
+        pitch=EDGE_TTS_DEFAULT_PITCH,
+        style=EDGE_TTS_DEFAULT_STYLE,
+    )
+    tts_url = f"https://{endpoint['r']}.tts.speech.microsoft.com/cognitiveservices/v1"
+    return tts_http_client.build_request(
+        "POST",
+        tts_url,
+        headers={
+            "Authorization": endpoint["t"],
+            "Content-Type": "application/ssml+xml",
+            "X-Microsoft-OutputFormat": EDGE_TTS_OUTPUT_FORMAT,
+        },
+        content=ssml.encode("utf-8"),
+    )
+
+
+async def edge_tts(text: str, *, voice_name: Optional[str] = None) -> bytes:
+    """Edge TTS 语音合成"""
+    resp = await tts_http_client.send(await _edge_tts_request(text, voice_name))
+    resp.raise_for_status()
+    return resp.content
+
+
+@contextlib.asynccontextmanager
+async def edge_tts_stream(text: str, *, voice_name: Optional[str] = None) -> AsyncIterator[httpx.Response]:
+    """Edge TTS 语音合成（流式读取响应 body）"""
+    resp = await tts_http_client.send(await _edge_tts_request(text, voice_name), stream=True)
+    try:
+        if resp.is_error:
+            await resp.aread()
+        resp.raise_for_status()
+        yield resp
+    finally:
+        await resp.aclose()
+
+
+class TTSAudioCache:
+    """内容寻址的语音缓存：键 = sha256(provider/voice/style/rate/pitch/format/text)。
+
+    文件保存在 root/<key[:2]>/<key>.audio，内存中只保留 key -> 文件大小 的 LRU 索引，
+    总大小超过 max_bytes 时删除最久未命中的文件。启动时按 mtime 重建索引，命中会刷新 mtime。
+    shared=True（多个 worker 进程共用目录）时索引未命中会再查一次磁盘，收录其他进程写入的文件；
+    housekeep() 会重新扫描目录、按所有进程写入的总大小淘汰，两次 housekeeping 之间
+    各进程只按自己的索引淘汰，目录可能短暂超出 max_bytes。
+    崩溃遗留的 *.tmp 在 housekeep() 中超过 STALE_TMP_S 后删除。
+    """
+
+    STALE_TMP_S = 3600.0
+
+    def __init__(self, root: str, *, max_bytes: int, shared: bool = False):
+        self.root = Path(root)
+        self.max_bytes = max(0, int(max_bytes))
+        self.shared = shared
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    @staticmethod
+    def make_key(provider: str, voice: str, style: str, rate: str, pitch: str, fmt: str, text: str) -> str:
+        text_hash = hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+        material = "\x1f".join([provider, voice, style, rate, pitch, fmt, text_hash])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.audio"
+
+    def _scan_sync(self) -> tuple[list[tuple[float, str, int]], int]:
+        """返回按 mtime 排序的 (mtime, key, size) 列表，并顺带删除过期的临时文件。"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        entries = []
+        removed_tmp = 0
+        stale_before = time.time() - self.STALE_TMP_S
+        for f in self.root.glob("*/*"):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            if f.suffix == ".audio":
+                entries.append((st.st_mtime, f.stem, st.st_size))
+            elif f.suffix == ".tmp" and st.st_mtime < stale_before:
+                with contextlib.suppress(OSError):
+                    f.unlink()
+                    removed_tmp += 1
+        entries.sort()
+        return entries, removed_tmp
+
+    def _rebuild(self, entries: list[tuple[float, str, int]]) -> None:
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._total = sum(self._index.values())
+        self._evict()
+
+    def load_sync(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            entries, _ = self._scan_sync()
+            self._rebuild(entries)
+        except Exception as e:
+            logger.error(f"TTS cache load failed: {e}")
+
+    async def housekeep(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            entries, removed_tmp = await asyncio.to_thread(self._scan_sync)
+        except Exception as e:
+            logger.error(f"TTS cache scan failed: {e}")
+            return
+        if removed_tmp:
+            logger.info(f"TTS cache: removed {removed_tmp} stale temp files")
+        if self.shared:
+            self._rebuild(entries)
+
+    def _evict(self) -> None:
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def _read(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def writer(self, key: str) -> Optional["TTSCacheWriter"]:
+        return TTSCacheWriter(self, key) if self.enabled else None
+
+    def _adopt(self, key: str, size: int) -> None:
+        self._total -= self._index.pop(key, 0)
+        self._index[key] = size
+        self._total += size
+        self._evict()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled or (key not in self._index and not self.shared):
+            self.misses += 1
+            return None
+        data = await asyncio.to_thread(self._read, key)
+        if data is not None and key not in self._index:
+            self._adopt(key, len(data))
+        if data is None:
+            self._total -= self._index.pop(key, 0)
+            self.misses += 1
+            return None
+        if key in self._index:
+            self._index.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        if not self.enabled or not data or len(data) > self.max_bytes:
+            return
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except Exception as e:
+            logger.error(f"TTS cache write failed: {e}")
+            return
+        self._adopt(key, len(data))
+
+    def stats(self) -> str:
+        return (
+            f"tts_cache={len(self._index)} files/{self._total // 1024}KiB "
+            f"(hits {self.hits}, misses {self.misses}, evicted {self.evictions})"
+        )
+
+
+class TTSCacheWriter:
+    """流式上传时把音频块顺带写入缓存临时文件；完整读完后 commit() 才会进入缓存。"""
+
+    def __init__(self, cache: TTSAudioCache, key: str):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self._path = cache._path(key)
+        self._tmp_path = self._path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        self._fh = None
+        self.failed = False
+
+    def _write_sync(self, chunk: bytes) -> None:
+        if self._fh is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._fh = open(self._tmp_path, "wb")
+        self._fh.write(chunk)
+
+    async def write(self, chunk: bytes) -> None:
+        if self.failed or not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_bytes:
+            self.failed = True
+            return
+        try:
+            await asyncio.to_thread(self._write_sync, chunk)
+        except Exception as e:
+            logger.error(f"TTS cache write failed: {e}")
+            self.failed = True
+
+    def _finish_sync(self, keep: bool) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if keep:
+            os.replace(self._tmp_path, self._path)
+        else:
+            with contextlib.suppress(OSError):
+                self._tmp_path.unlink()
+
+    async def commit(self) -> None:
+        keep = not self.failed and self.size > 0
+        try:
+            await asyncio.to_thread(self._finish_sync, keep)
+        except Exception as e:
+            logger.error(f"TTS cache write failed: {e}")
+            return
+        if keep:
+            self.cache._adopt(self.key, self.size)
+
+    async def discard(self) -> None:
+        with contextlib.suppress(Exception):
+            await asyncio.to_thread(self._finish_sync, False)
+
+
+tts_cache = TTSAudioCache(TG_TTS_CACHE_DIR, max_bytes=int(TG_TTS_CACHE_MAX_MB * 1024 * 1024), shared=TG_WORKER_INDEX >= 0)
+tts_cache.load_sync()
+
+
+class VoiceFileIdStore:
+    """音频内容哈希 -> Telegram file_id，同一段音频再次发送时直接引用 file_id，不再上传。
+
+    内存中为 LRU（最多 max_entries 条），由 housekeeping 与退出时整体写回 JSON 文件
+    （tmp + os.replace）；丢失最近几条只会导致多上传一次。
+    """
+
+    def __init__(self, path: str, *, max_entries: int):
+        self.path = Path(path)
+        self.max_entries = max(0, int(max_entries))
+        self._ids: "OrderedDict[str, str]" = OrderedDict()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def digest(audio: bytes) -> str:
+        return hashlib.sha256(audio).hexdigest()
+
+    def load_sync(self) -> None:
+        if not self.enabled or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            for digest, file_id in (data.get("fileIds") or {}).items():
+                if isinstance(digest, str) and isinstance(file_id, str) and file_id:
+                    self._ids[digest] = file_id
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+        except Exception as e:
+            logger.error(f"Voice file_id store load failed: {e}")
+
+    def get(self, digest: str) -> Optional[str]:
+        file_id = self._ids.get(digest) if self.enabled else None
+        if file_id is None:
+            self.misses += 1
+            return None
+        self._ids.move_to_end(digest)
+        self.hits += 1
+        return file_id
+
+    def set(self, digest: str, file_id: Optional[str]) -> None:
+        if not self.enabled or not file_id or self._ids.get(digest) == file_id:
+            return
+        self._ids[digest] = file_id
+        self._ids.move_to_end(digest)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+        self._dirty = True
+
+    def discard(self, digest: str) -> None:
+        if self._ids.pop(digest, None) is not None:
+            self._dirty = True
+
+    def _write(self, payload: str) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(payload, encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        self._dirty = False
+        payload = json.dumps({"fileIds": dict(self._ids)}, ensure_ascii=False)
+        try:
+            await asyncio.to_thread(self._write, payload)
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Voice file_id store save failed: {e}")
+
+    def stats(self) -> str:
+        return f"voice_file_ids={len(self._ids)} (hits {self.hits}, misses {self.misses})"
+
+
+voice_file_ids = VoiceFileIdStore(
+    _per_worker_path(str(Path(TG_TTS_CACHE_DIR) / "voice-file-ids.json")), max_entries=TG_VOICE_FILE_ID_CACHE,
+)
+voice_file_ids.load_sync()
+
+
+_tts_inflight: Dict[str, asyncio.Task] = {}
+
+
+def _parse_provider_limits(raw: str) -> Dict[str, int]:
+    limits: Dict[str, int] = {}
+    for item in str(raw or "").split(","):
+        name, _, value = item.partition("=")
+        name = name.strip().lower()
+        try:
+            limits[name] = max(1, int(value))
+        except ValueError:
             continue
-        result[tag] = str(value).strip()
-    return result
+    return limits
 
 
-def extract_partial_between(text: str, start_tag: str, end_tag: str, *, stop_tags: Optional[list[str]] = None) -> Optional[str]:
-    if not text:
-        return None
-    lowered = text.lower()
-    start = lowered.find(start_tag.lower())
-    if start == -1:
+_tts_provider_limits = _parse_provider_limits(TG_TTS_PROVIDER_CONCURRENCY)
+_tts_provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _tts_provider_semaphore(provider: str) -> asyncio.Semaphore:
+    sem = _tts_provider_semaphores.get(provider)
+    if sem is None:
+        sem = _tts_provider_semaphores[provider] = asyncio.Semaphore(_tts_provider_limits.get(provider, 4))
+    return sem
+
+
+async def _plugin_tts(text: str, voice: Optional[str]) -> bytes:
+    return await st_client.tts(text, tts_model=voice, voice=voice) if voice else await st_client.tts(text)
+
+
+def _plugin_tts_stream(text: str, voice: Optional[str]):
+    return st_client.tts_stream(text, tts_model=voice, voice=voice) if voice else st_client.tts_stream(text)
+
+
+# 提供商名 -> 合成函数 / 流式打开函数（async context manager，产出未读取的 httpx 响应）；新增提供商在此登记
+TTS_BACKENDS: Dict[str, Callable[[str, Optional[str]], Awaitable[bytes]]] = {
+    "edge": lambda text, voice: edge_tts(text, voice_name=voice),
+    "plugin": _plugin_tts,
+}
+TTS_STREAM_BACKENDS: Dict[str, Callable[[str, Optional[str]], Any]] = {
+    "edge": lambda text, voice: edge_tts_stream(text, voice_name=voice),
+    "plugin": _plugin_tts_stream,
+}
+
+
+class _ProviderHealth:
+    __slots__ = ("latency", "error_rate", "failures", "cooldown_until", "calls")
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+
+
+class TTSProviderRouter:
+    """按滚动延迟与错误率（EWMA）给提供商排序。
+
+    得分 = 延迟 * (1 + 4 * 错误率) * (1 + 0.25 * 配置顺序)；还没有成功过的提供商（未测过或一直失败）
+    取已测同伴延迟的中位数（都没测过时取 DEFAULT_LATENCY_S）作为先验延迟，错误率惩罚照样生效。
+    连续失败 3 次进入冷却，冷却期内排到最后（仍可作为最后的兜底）。
+    """
+
+    ALPHA = 0.2
+    FAILURES_BEFORE_COOLDOWN = 3
+    DEFAULT_LATENCY_S = 1.0
+
+    def __init__(self, providers: list[str], *, cooldown_s: float):
+        self.providers = [p for p in dict.fromkeys(providers) if p in TTS_BACKENDS]
+        unknown = [p for p in providers if p not in TTS_BACKENDS]
+        if unknown:
+            logger.warning(f"Unknown TTS providers ignored: {', '.join(unknown)}")
+        if not self.providers:
+            self.providers = ["plugin"]
+        self.cooldown_s = max(0.0, float(cooldown_s))
+        self._health = {p: _ProviderHealth() for p in self.providers}
+
+    def _prior_latency(self) -> float:
+        measured = [h.latency for h in self._health.values() if h.latency is not None]
+        return statistics.median(measured) if measured else self.DEFAULT_LATENCY_S
+
+    def _score(self, provider: str, index: int, prior: float) -> float:
+        h = self._health[provider]
+        latency = h.latency if h.latency is not None else prior
+        return latency * (1.0 + 4.0 * h.error_rate) * (1.0 + 0.25 * index)
+
+    def order(self, *, exclude: Collection[str] = ()) -> list[str]:
+        now = time.monotonic()
+        prior = self._prior_latency()
+        ranked = sorted(
+            ((i, p) for i, p in enumerate(self.providers) if p not in exclude),
+            key=lambda item: (self._health[item[1]].cooldown_until > now, self._score(item[1], item[0], prior)),
+        )
+        return [p for _, p in ranked]
+
+    def record(self, provider: str, latency_s: Optional[float], *, ok: bool) -> None:
+        h = self._health.get(provider)
+        if h is None:
+            return
+        h.calls += 1
+        h.error_rate += self.ALPHA * ((0.0 if ok else 1.0) - h.error_rate)
+        if ok:
+            h.failures = 0
+            if latency_s is not None:
+                h.latency = latency_s if h.latency is None else h.latency + self.ALPHA * (latency_s - h.latency)
+            return
+        h.failures += 1
+        if h.failures >= self.FAILURES_BEFORE_COOLDOWN and len(self.providers) > 1:
+            h.cooldown_until = time.monotonic() + self.cooldown_s
+            logger.warning(f"TTS provider {provider} failed {h.failures} times in a row, cooling down {self.cooldown_s:.0f}s")
+
+    def stats(self) -> str:
+        parts = []
+        for p in self.providers:
+            h = self._health[p]
+            latency = f"{h.latency * 1000:.0f}ms" if h.latency is not None else "-"
+            parts.append(f"{p} {latency} err {h.error_rate:.0%}")
+        return "tts_providers=[" + ", ".join(parts) + "]"
+
+
+tts_router = TTSProviderRouter(TTS_PROVIDERS, cooldown_s=TG_TTS_PROVIDER_COOLDOWN_S)
+
+_EDGE_VOICE_RE = re.compile(r'^[a-z]{2,3}(?:-[A-Za-z0-9]+)+Neural$')
+
+
+def _parse_tts_voice_map(raw: str) -> Dict[str, Dict[str, str]]:
+    """返回 音色 -> {provider: 等价音色}。"""
+    mapping: Dict[str, Dict[str, str]] = {}
+    for group in str(raw or "").split(","):
+        members: Dict[str, str] = {}
+        for item in group.split("="):
+            provider, sep, voice = item.partition(":")
+            if sep and provider.strip() and voice.strip():
+                members[provider.strip().lower()] = voice.strip()
+        for voice in members.values():
+            mapping[voice] = members
+    return mapping
+
+
+_tts_voice_map = _parse_tts_voice_map(TG_TTS_VOICE_MAP)
+
+
+def map_tts_voice(voice: Optional[str], provider: str) -> Optional[str]:
+    """把用户选择的音色换成 provider 上的等价音色；无法对应时返回 None（用该提供商默认音色）。"""
+    voice = (voice or "").strip()
+    if not voice:
         return None
-    start += len(start_tag)
-    after = text[start:]
-    after_lower = after.lower()
+    members = _tts_voice_map.get(voice)
+    if members is not None:
+        return members.get(provider)
+    if len(tts_router.providers) < 2:
+        return voice
+    # 未登记映射时：Edge 风格的音色名只交给 edge，其余音色不交给 edge
+    return voice if (provider == "edge") == bool(_EDGE_VOICE_RE.match(voice)) else None
+
+
+_TRANSCODE_BITRATE_PROFILES = {"low": "16k", "medium": "32k", "high": "64k"}
+
+
+def is_ogg_opus(audio: bytes) -> bool:
+    return audio[:4] == b"OggS" and b"OpusHead" in audio[:128]
+
+
+class AudioTranscoder:
+    """用本地 ffmpeg（或参数兼容的命令）把 TTS 输出统一转成 Telegram 原生的 Ogg/Opus。
+
+    同时最多 workers 个子进程，每段记录输入/输出大小与耗时；找不到可执行文件时记一次错误并停用，
+    转码失败或超时则原样返回输入。transcode() 返回 (音频, ok)：ok 为 False 表示转码失败、音频不是
+    profile 对应的格式，调用方不应按含 profile 的缓存键保存。
+    """
+
+    def __init__(self, binary: str, *, mode: str, bitrate: str, workers: int, timeout_s: float = 30.0):
+        self.binary = binary
+        self.mode = mode if mode in ("auto", "always") else "off"
+        self.bitrate = _TRANSCODE_BITRATE_PROFILES.get(bitrate, bitrate) or "32k"
+        self.workers = max(1, int(workers))
+        self.timeout_s = timeout_s
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._broken = False
+        self.clips = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off" and not self._broken
+
+    @property
+    def profile(self) -> str:
+        """写进缓存键，换档位后不会读到旧格式的缓存。"""
+        return f"{self.mode}:opus@{self.bitrate}" if self.enabled else ""
+
+    def _command(self) -> list[str]:
+        return [
+            self.binary, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+            "-vn", "-ac", "1", "-c:a", "libopus", "-b:a", self.bitrate, "-application", "voip",
+            "-f", "ogg", "pipe:1",
+        ]
+
+    async def transcode(self, audio: bytes) -> tuple[bytes, bool]:
+        if not self.enabled or not audio or (self.mode == "auto" and is_ogg_opus(audio)):
+            return audio, True
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *self._command(),
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as e:
+                self._broken = True
+                logger.error(f"Audio transcoder unavailable ({self.binary}): {e}; transcoding disabled")
+                return audio, False
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(audio), timeout=self.timeout_s)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+                await proc.wait()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.failures += 1
+                logger.error(f"Audio transcode timed out after {self.timeout_s:.0f}s")
+                return audio, False
+            elapsed = time.monotonic() - started
+        if proc.returncode != 0 or not is_ogg_opus(out):
+            self.failures += 1
+            detail = err.decode("utf-8", "replace").strip()[-300:]
+            logger.error(f"Audio transcode failed (exit {proc.returncode}): {detail}")
+            return audio, False
+        self.clips += 1
+        self.bytes_in += len(audio)
+        self.bytes_out += len(out)
+        self.seconds += elapsed
+        logger.debug(f"Transcoded clip {len(audio)}B -> {len(out)}B in {elapsed * 1000:.0f}ms")
+        return out, True
+
+    def stats(self) -> str:
+        if self.mode == "off":
+            return "transcode=off"
+        avg_ms = self.seconds / self.clips * 1000 if self.clips else 0.0
+        return (
+            f"transcode={self.clips} clips {self.bytes_in // 1024}KiB->{self.bytes_out // 1024}KiB "
+            f"avg {avg_ms:.0f}ms (failed {self.failures}{', disabled' if self._broken else ''})"
+        )
+
+
+audio_transcoder = AudioTranscoder(
+    TG_FFMPEG_PATH,
+    mode=TG_TTS_TRANSCODE,
+    bitrate=TG_TTS_TRANSCODE_BITRATE,
+    workers=TG_TTS_TRANSCODE_WORKERS,
+)
 
-    candidates: list[int] = []
-    end_pos = after_lower.find(end_tag.lower())
-    if end_pos != -1:
-        candidates.append(end_pos)
 
-    if stop_tags:
-        for tag in stop_tags:
-            p = after_lower.find(tag.lower())
-            if p != -1:
-                candidates.append(p)
+class PluginTTSConfig:
+    """插件 TTS 配置（ttsModel / ttsVoice / ttsFormat）的指纹，写进 plugin 的缓存键：插件换了模型、
+    默认音色或格式后不会再读到旧音频。最多每 ttl 秒经 get_plugin_config() 刷新一次，取不到时沿用上次的值。
+    """
 
-    cut = min(candidates) if candidates else len(after)
-    return after[:cut].strip()
+    FIELDS = ("ttsModel", "ttsVoice", "ttsFormat")
 
+    def __init__(self, *, ttl: float = 60.0):
+        self.ttl = ttl
+        self.fingerprint = ""
+        self._checked_at: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
 
-def split_text_pages(text: str, *, max_chars: int) -> list[str]:
-    if not text:
-        return [""]
-    pages: list[str] = []
-    remaining = text
-    while remaining:
-        if len(remaining) <= max_chars:
-            pages.append(remaining)
-            break
-        cut = remaining.rfind("\n", 0, max_chars)
-        if cut == -1 or cut < int(max_chars * 0.6):
-            cut = max_chars
-        pages.append(remaining[:cut].rstrip())
-        remaining = remaining[cut:].lstrip("\n")
-    return pages or [""]
+    def _fresh(self) -> bool:
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.ttl
 
+    async def refresh(self) -> None:
+        if self._fresh():
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._fresh():
+                return
+            try:
+                result = await st_client.get_plugin_config()
+            except Exception as e:
+                logger.debug(f"Plugin TTS config refresh failed: {e}")
+            else:
+                cfg = result.get("config", {}) if isinstance(result, dict) else {}
+                material = json.dumps([cfg.get(field) for field in self.FIELDS], ensure_ascii=False)
+                self.fingerprint = hashlib.sha256(material.encode("utf-8")).hexdigest()[:16]
+            self._checked_at = time.monotonic()
 
-def render_status_panel_html(fields: Dict[str, str]) -> str:
-    if not fields:
-        return "状态读取中…"
 
-    header_order = ["天气", "地点", "日期", "时间"]
-    exclude = {"正文"}
+plugin_tts_config = PluginTTSConfig()
 
-    lines: list[str] = []
-    for key in header_order:
-        if fields.get(key):
-            val = _markdown_bold_to_html(html.escape(fields[key], quote=False))
-            lines.append(f"<b>{html.escape(key, quote=False)}：</b>{val}")
 
-    other_keys = [k for k in fields.keys() if k not in set(header_order) and k not in exclude]
-    other_keys.sort()
-    for key in other_keys:
-        value = fields.get(key)
-        if not value:
+def _tts_cache_key(provider: str, text: str, voice: Optional[str]) -> tuple[str, Optional[str]]:
+    """返回 (缓存键, 实际传给提供商的音色)。"""
+    if provider == "edge":
+        voice_name = (voice or EDGE_TTS_DEFAULT_VOICE).strip() or EDGE_TTS_DEFAULT_VOICE
+        key = TTSAudioCache.make_key(
+            "edge", voice_name, EDGE_TTS_DEFAULT_STYLE, EDGE_TTS_DEFAULT_RATE,
+            EDGE_TTS_DEFAULT_PITCH, EDGE_TTS_OUTPUT_FORMAT + audio_transcoder.profile, text,
+        )
+        return key, voice_name
+    # plugin 的模型/默认音色/格式由插件配置决定：音色为空串代表“插件默认”，配置本身以指纹计入
+    key = TTSAudioCache.make_key(
+        provider, voice or "", plugin_tts_config.fingerprint, "", "", audio_transcoder.profile, text,
+    )
+    return key, voice
+
+
+def _tts_candidates(text: str, voice: Optional[str], *,
+                    exclude: Collection[str] = ()) -> list[tuple[str, str, Optional[str]]]:
+    """按路由顺序返回 [(provider, 缓存键, 该提供商上的音色)]，跳过 exclude 中的提供商。"""
+    candidates = []
+    for provider in tts_router.order(exclude=exclude):
+        key, provider_voice = _tts_cache_key(provider, text, map_tts_voice(voice, provider))
+        candidates.append((provider, key, provider_voice))
+    return candidates
+
+
+async def _synthesize_with_failover(text: str, candidates: list[tuple[str, str, Optional[str]]]) -> tuple[str, bytes]:
+    """依次尝试各提供商，整体不超过 TG_TTS_DEADLINE_S；还有后备时单次尝试最多 TG_TTS_ATTEMPT_TIMEOUT_S。"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TG_TTS_DEADLINE_S
+    last_error: Optional[BaseException] = None
+    for index, (provider, key, provider_voice) in enumerate(candidates):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        timeout = remaining if index == len(candidates) - 1 else min(remaining, TG_TTS_ATTEMPT_TIMEOUT_S)
+        started = loop.time()
+        try:
+            async with asyncio.timeout(timeout):
+                async with _tts_provider_semaphore(provider):
+                    started = loop.time()
+                    with span("tts.synthesize", provider=provider, chars=len(text)):
+                        audio = await TTS_BACKENDS[provider](text, provider_voice)
+        except Exception as e:
+            tts_router.record(provider, None, ok=False)
+            M_TTS_ERRORS.inc(provider=provider)
+            last_error = e
+            if index < len(candidates) - 1:
+                logger.warning(f"TTS provider {provider} failed ({type(e).__name__}: {e}), trying {candidates[index + 1][0]}")
             continue
-        val = _markdown_bold_to_html(html.escape(str(value), quote=False))
-        lines.append(f"<b>{html.escape(key, quote=False)}：</b>{val}")
+        tts_router.record(provider, loop.time() - started, ok=True)
+        M_TTS_SECONDS.observe(loop.time() - started, provider=provider)
+        return key, audio
+    raise last_error or TimeoutError("TTS deadline exceeded")
+
+
+async def synthesize_tts(text: str, *, voice: Optional[str] = None, exclude: Collection[str] = ()) -> bytes:
+    """按提供商路由合成语音（失败自动换下一个）；相同参数 + 相同文本直接读磁盘缓存。
+    exclude：刚刚失败、这次不再尝试的提供商。"""
+    if "plugin" in TTS_PROVIDERS:
+        await plugin_tts_config.refresh()
+    candidates = _tts_candidates(text, voice, exclude=exclude)
+    for index, (_, candidate_key, _) in enumerate(candidates):
+        # 首选提供商总是查一次（计入 miss），其他提供商只在确有缓存时读取
+        if index == 0 or candidate_key in tts_cache:
+            cached = await tts_cache.get(candidate_key)
+            if cached:
+                return cached
+    key = candidates[0][1]
+
+    # 同一段文本正在合成（如同一回复中重复的句子）时复用同一个请求
+    inflight = _tts_inflight.get(key)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+
+    async def run() -> bytes:
+        used_key, audio = await _synthesize_with_failover(text, candidates)
+        audio, transcoded = await audio_transcoder.transcode(audio)
+        # 转码失败时音频仍是提供商原始格式，不能存进带转码档位的缓存键
+        if audio and transcoded:
+            await tts_cache.put(used_key, audio)
+        return audio
+
+    task = asyncio.create_task(run())
+    _tts_inflight[key] = task
+    task.add_done_callback(lambda _t: _tts_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+# 句末：中英文终止标点（可连续，如“？！”“……”）+ 可选的闭合引号/括号；英文句点需后接空白
+_TTS_SENTENCE_RE = re.compile(
+    r'.*?(?:(?:[。！？!?；;…]+|\.+(?=\s|$))[”’"\'」』）)】]*|\n+|$)',
+    re.S,
+)
+_TTS_SOFT_BREAKS = "，、,：: "
 
-    max_chars = 3500
-    output = ""
-    shown = 0
-    for ln in lines:
-        candidate = f"{output}\n{ln}" if output else ln
-        if len(candidate) > max_chars:
-            break
-        output = candidate
-        shown += 1
 
-    if shown < len(lines):
-        output += f"\n<b>…</b> 还有 {len(lines) - shown} 项（生成中/稍后发送）"
-    return output if output else "状态读取中…"
+def split_tts_sentences(text: str) -> list[str]:
+    sentences: list[str] = []
+    for m in _TTS_SENTENCE_RE.finditer(str(text or "")):
+        piece = m.group(0).strip()
+        if piece:
+            sentences.append(piece)
+    return sentences
 
 
-def render_body_html(body: str) -> str:
-    escaped = _markdown_bold_to_html(html.escape(body or "", quote=False))
-    return escaped if escaped else "…"
+def split_tts_chunks(text: str, *, max_chars: int) -> list[str]:
+    """按句子边界把文本切成不超过 max_chars 的块（保留原文的空白/换行）；超长句子在逗号/空格处硬切。"""
+    text = str(text or "")
+    max_chars = max(16, int(max_chars))
+    chunks: list[str] = []
+    start = end = None
+    for m in _TTS_SENTENCE_RE.finditer(text):
+        piece = m.group(0)
+        if not piece.strip():
+            continue
+        s_start = m.start() + len(piece) - len(piece.lstrip())
+        s_end = m.start() + len(piece.rstrip())
+        if start is not None and s_end - start <= max_chars:
+            end = s_end
+            continue
+        if start is not None:
+            chunks.append(text[start:end].strip())
+        start, end = s_start, s_end
+        while end - start > max_chars:
+            window = text[start:start + max_chars]
+            cut = max(window.rfind(ch) for ch in _TTS_SOFT_BREAKS) + 1
+            if cut < max_chars // 2:
+                cut = max_chars
+            head = text[start:start + cut].strip()
+            if head:
+                chunks.append(head)
+            start += cut
+    if start is not None and text[start:end].strip():
+        chunks.append(text[start:end].strip())
+    return chunks
+
+
+# Ogg 的 CRC-32（多项式 0x04C11DB7，不反射，初值 0）等于把每个字节位序反转后做 zlib 的反射 CRC-32
+# 再整体反转：bytes.translate 与 zlib.crc32 都在 C 中按整段处理，1MB 约 1ms
+_BIT_REVERSE = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+_OGG_HEADER = struct.Struct("<4sBBqIIIB")
+
+
+def _ogg_crc(data: bytes) -> int:
+    crc = zlib.crc32(bytes(data).translate(_BIT_REVERSE), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+def _ogg_pages(data: bytes) -> list[list]:
+    """解析 Ogg 页：[header_type, granule, serial, seq, segment_table, body]。"""
+    pages: list[list] = []
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 4] != b"OggS":
+            raise ValueError("invalid Ogg page")
+        _, _, header_type, granule, serial, seq, _, nsegs = _OGG_HEADER.unpack_from(data, pos)
+        seg_start = pos + _OGG_HEADER.size
+        segments = data[seg_start:seg_start + nsegs]
+        body_start = seg_start + nsegs
+        body_end = body_start + sum(segments)
+        if body_end > len(data):
+            raise ValueError("truncated Ogg page")
+        pages.append([header_type, granule, serial, seq, segments, data[body_start:body_end]])
+        pos = body_end
+    return pages
+
+
+def _ogg_write_page(out: bytearray, header_type: int, granule: int, serial: int, seq: int,
+                    segments: bytes, body: bytes) -> None:
+    header = _OGG_HEADER.pack(b"OggS", 0, header_type, granule, serial, seq, 0, len(segments))
+    page = bytearray(header + segments + body)
+    struct.pack_into("<I", page, 22, _ogg_crc(page))
+    out += page
+
+
+def _opus_packet_samples(packet: bytes) -> int:
+    """根据 TOC 字节计算一个 Opus 包解码后的采样数（48kHz）。"""
+    if not packet:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config & 3]
+    elif config < 16:
+        frame = (480, 960)[config & 1]
+    else:
+        frame = (120, 240, 480, 960)[config & 3]
+    code = toc & 3
+    if code == 0:
+        count = 1
+    elif code in (1, 2):
+        count = 2
+    else:
+        count = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * count
+
+
+def join_ogg_opus(parts: list[bytes]) -> bytes:
+    """把多段独立的 Ogg/Opus 合成一个逻辑流（单一 serial），Telegram 才会当作一条语音播放。
+
+    保留第一段的 OpusHead/OpusTags，后续各段丢弃头部两个包；音频页改写 serial 与页序号，
+    granule 按各包 TOC 算出的实际采样数累加（中间段不再做结尾裁剪，只有最后一页保留原始
+    裁剪），并重新计算 CRC。
+    """
+    out = bytearray()
+    serial = None
+    seq = 0
+    offset = 0
+    last = len(parts) - 1
+    for index, data in enumerate(parts):
+        pages = _ogg_pages(data)
+        if serial is None and pages:
+            serial = pages[0][2]
+        headers_left = 2
+        samples = 0
+        packet = bytearray()
+        for page_index, (header_type, granule, _, _, segments, body) in enumerate(pages):
+            is_header_page = headers_left > 0
+            completed = False
+            pos = 0
+            for seg in segments:
+                packet += body[pos:pos + seg]
+                pos += seg
+                if seg < 255:
+                    if headers_left:
+                        headers_left -= 1
+                    else:
+                        samples += _opus_packet_samples(packet)
+                        completed = True
+                    packet = bytearray()
+            if is_header_page and index:
+                continue
 
+            header_type &= ~0x04
+            if index:
+                header_type &= ~0x02
+            is_final = index == last and page_index == len(pages) - 1
+            if is_final:
+                header_type |= 0x04
+                if granule != -1:
+                    granule += offset
+            elif not is_header_page:
+                granule = offset + samples if completed else -1
+            _ogg_write_page(out, header_type, granule, serial, seq, segments, body)
+            seq += 1
+        offset += samples
+    return bytes(out)
+
+
+def join_audio_chunks(parts: list[bytes]) -> bytes:
+    parts = [p for p in parts if p]
+    if len(parts) <= 1:
+        return parts[0] if parts else b""
+    if all(p[:4] == b"OggS" for p in parts):
+        try:
+            return join_ogg_opus(parts)
+        except (ValueError, struct.error) as e:
+            logger.error(f"Ogg join failed, falling back to concatenation: {e}")
+    # MP3 等按帧组织的格式可以直接拼接
+    return b"".join(parts)
 
-def render_tips_html(tips: str) -> str:
-    lines = [l.strip() for l in (tips or "").splitlines() if l.strip()]
-    joined = "\n".join(html.escape(l, quote=False) for l in lines)
-    return f"<b>行动建议</b>\n{joined}" if joined else "<b>行动建议</b>\n（无）"
 
+async def synthesize_tts_chunks(chunks: list[str], *, voice: Optional[str], parallel: int) -> list[asyncio.Task]:
+    """并发合成（最多 parallel 个同时进行），返回与 chunks 顺序一致的任务列表。"""
+    semaphore = asyncio.Semaphore(max(1, int(parallel)))
 
-def render_full_state_messages(fields: Dict[str, str], *, exclude_keys: Optional[set[str]] = None) -> list[str]:
-    exclude_keys = exclude_keys or set()
-    items = [(k, v) for k, v in fields.items() if k not in exclude_keys and str(v).strip()]
-    if not items:
-        return []
-    items.sort(key=lambda kv: kv[0])
+    async def run(chunk: str) -> bytes:
+        async with semaphore:
+            return await synthesize_tts(chunk, voice=voice)
 
-    blocks: list[str] = []
-    current = "<b>状态（完整）</b>\n"
-    max_chars = 3500
-    for k, v in items:
-        line = f"<b>{html.escape(k, quote=False)}：</b>{_markdown_bold_to_html(html.escape(str(v), quote=False))}\n"
-        if len(current) + len(line) > max_chars:
-            blocks.append(current.rstrip())
-            current = "<b>状态（续）</b>\n" + line
+    return [asyncio.create_task(run(chunk)) for chunk in chunks]
+
+
+_tts_warned_user_ids = TTLCache("tts_warned", maxsize=TG_BOOKKEEPING_MAX_USERS, ttl=TG_VOICE_WARN_TTL_HOURS * 3600)
+_voice_send_warned_user_ids = TTLCache("voice_send_warned", maxsize=TG_BOOKKEEPING_MAX_USERS, ttl=TG_VOICE_WARN_TTL_HOURS * 3600)
+
+
+async def _upload_voice_stream(bot, *, chat_id: int, body: AsyncIterator[bytes]) -> Optional[str]:
+    """直接调用 Bot API sendVoice，multipart body 以 chunked 方式边读边发。
+
+    PTB 的 InputFile 会先把整个文件读进内存，所以这里绕过它；错误按 PTB 的异常类型抛出，
+    便于与 send_voice 共用处理逻辑。
+    """
+    boundary = uuid.uuid4().hex
+
+    async def multipart() -> AsyncIterator[bytes]:
+        yield (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="chat_id"\r\n\r\n{chat_id}\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="voice"; filename="reply.ogg"\r\n'
+            'Content-Type: audio/ogg\r\n\r\n'
+        ).encode("utf-8")
+        async for chunk in body:
+            yield chunk
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    resp = await tts_http_client.post(
+        f"{bot.base_url}/sendVoice",
+        content=multipart(),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    runtime_stats.record_bot_api("sendVoice", resp.status_code)
+    try:
+        data = resp.json()
+    except ValueError:
+        data = {}
+    if resp.status_code == 200 and data.get("ok"):
+        return ((data.get("result") or {}).get("voice") or {}).get("file_id")
+    description = str(data.get("description") or f"HTTP {resp.status_code}")
+    retry_after = (data.get("parameters") or {}).get("retry_after")
+    if retry_after is not None:
+        raise RetryAfter(int(retry_after))
+    if resp.status_code == 403:
+        raise Forbidden(description)
+    if resp.status_code == 400:
+        raise BadRequest(description)
+    raise TelegramError(description)
+
+
+async def send_voice_note(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int,
+                          audio: "bytes | AsyncIterator[bytes]") -> bool:
+    """发送一条语音（bytes 或按块产生的音频流）；对方限制语音消息时提示一次并返回 False。"""
+    with span("telegram.send_voice", streamed=not isinstance(audio, (bytes, bytearray))):
+        return await _send_voice_note(context, user_id=user_id, chat_id=chat_id, audio=audio)
+
+
+async def _send_voice_note(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int,
+                           audio: "bytes | AsyncIterator[bytes]") -> bool:
+    # 读取音频流（TTS）时的异常：属于合成错误，交给调用方（report_tts_error），不算发送失败
+    source_error: Optional[BaseException] = None
+    try:
+        if isinstance(audio, (bytes, bytearray)):
+            digest = VoiceFileIdStore.digest(audio)
+            file_id = voice_file_ids.get(digest)
+            if file_id:
+                try:
+                    await context.bot.send_voice(chat_id=chat_id, voice=file_id)
+                    return True
+                except BadRequest as e:
+                    # file_id 失效（如更换了 bot token）时重新上传；其他错误照常处理
+                    if "file" not in str(e).lower():
+                        raise
+                    logger.warning(f"Stale voice file_id, re-uploading: {e}")
+                    voice_file_ids.discard(digest)
+            voice_file = InputFile(io.BytesIO(audio), filename="reply.ogg")
+            message = await context.bot.send_voice(chat_id=chat_id, voice=voice_file)
+            if message is not None and message.voice is not None:
+                voice_file_ids.set(digest, message.voice.file_id)
         else:
-            current += line
-    if current.strip():
-        blocks.append(current.rstrip())
-    return blocks
+            hasher = hashlib.sha256()
+
+            async def hashed() -> AsyncIterator[bytes]:
+                nonlocal source_error
+                try:
+                    async for chunk in audio:
+                        hasher.update(chunk)
+                        yield chunk
+                except Exception as e:
+                    source_error = e
+                    raise
 
+            try:
+                file_id = await _upload_voice_stream(context.bot, chat_id=chat_id, body=hashed())
+            except Exception:
+                if source_error is not None:
+                    raise source_error
+                raise
+            voice_file_ids.set(hasher.hexdigest(), file_id)
+        return True
+    except RetryAfter:
+        M_TELEGRAM_RETRY_AFTER.inc(method="sendVoice")
+        if not isinstance(audio, (bytes, bytearray)):
+            # 流已被消费，由 stream_voice_reply 等待后用缓存中的完整音频重发
+            raise
+        return False
+    except Forbidden as e:
+        if user_id not in _voice_send_warned_user_ids:
+            _voice_send_warned_user_ids.add(user_id)
+            await context.bot.send_message(chat_id=chat_id, text="语音发送失败：对方隐私设置/限制语音消息；已保留文字回复，可在菜单关闭语音回复。")
+        logger.error(f"Voice send forbidden: {e}")
+    except BadRequest as e:
+        if user_id not in _voice_send_warned_user_ids:
+            _voice_send_warned_user_ids.add(user_id)
+            await context.bot.send_message(chat_id=chat_id, text="语音发送失败：对方隐私设置/限制语音消息；已保留文字回复，可在菜单关闭语音回复。")
+        logger.error(f"Voice send bad request: {e}")
+    except (TelegramError, httpx.HTTPError) as e:
+        if e is source_error:
+            raise
+        # 网络错误、Telegram 5xx：是发送失败而不是 TTS 失败，不提示用户去配置 TTS
+        logger.error(f"Voice send failed: {type(e).__name__}: {e}")
+    return False
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+async def stream_voice_reply(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int,
+                             text: str, voice: Optional[str]) -> bool:
+    """合成一段语音并边下载边上传，内存中最多保留一个 TG_TTS_STREAM_CHUNK_KB 块。
+
+    缓存命中或同一文本正在合成时走普通路径；上传的同时写入缓存临时文件，完整结束才入缓存。
+    首选提供商在开始上传前失败时，退回普通路径（由 synthesize_tts 换下一个提供商，不再重试失败的那个）。
+    上传遇到 RetryAfter 时流已消费：等待后按普通路径重发（完整音频此时已在缓存中）。
+    """
+    failed: set[str] = set()
+    resend_after: Optional[float] = None
+    if "plugin" in TTS_PROVIDERS:
+        await plugin_tts_config.refresh()
+    candidates = _tts_candidates(text, voice)
+    provider, key, provider_voice = candidates[0]
+    # 需要转码时拿不到边下边传的原始流，也走普通路径
+    if (any(k in tts_cache for _, k, _ in candidates) or key in _tts_inflight
+            or provider not in TTS_STREAM_BACKENDS or audio_transcoder.enabled):
+        audio = await synthesize_tts(text, voice=voice)
+        return await send_voice_note(context, user_id=user_id, chat_id=chat_id, audio=audio) if audio else True
+
+    async with contextlib.AsyncExitStack() as stack:
+        try:
+            await stack.enter_async_context(_tts_provider_semaphore(provider))
+            resp = await stack.enter_async_context(TTS_STREAM_BACKENDS[provider](text, provider_voice))
+            chunks = resp.aiter_bytes(TG_TTS_STREAM_CHUNK_KB * 1024)
+            # 先取到第一块再开始上传：TTS 报错或返回空音频时不会向 Telegram 发出半截请求
+            first = await anext(chunks, b"")
+        except Exception as e:
+            tts_router.record(provider, None, ok=False)
+            M_TTS_ERRORS.inc(provider=provider)
+            if len(candidates) < 2:
+                raise
+            logger.warning(f"TTS provider {provider} stream failed ({type(e).__name__}: {e}), falling back")
+            failed = {provider}
+        else:
+            tts_router.record(provider, None, ok=True)
+            if not first:
+                return True
+            writer = tts_cache.writer(key)
+            complete = False
+
+            async def body() -> AsyncIterator[bytes]:
+                nonlocal complete
+                chunk = first
+                while chunk:
+                    if writer is not None:
+                        await writer.write(chunk)
+                    yield chunk
+                    chunk = await anext(chunks, b"")
+                complete = True
 
-async def send_preformatted_html(bot, chat_id: int, text: str, *, max_message_chars: int = 3800) -> None:
-    if not text:
+            try:
+                return await send_voice_note(context, user_id=user_id, chat_id=chat_id, audio=body())
+            except RetryAfter as e:
+                resend_after = _retry_after_seconds(e)
+            finally:
+                if writer is not None:
+                    await (writer.commit() if complete else writer.discard())
+
+    if resend_after is not None:
+        # 已退出提供商信号量再等待；synthesize_tts 先读缓存，未入缓存（如缓存关闭）时重新合成
+        logger.warning(f"Voice upload rate limited, resending in {resend_after:.0f}s")
+        await asyncio.sleep(resend_after)
+    audio = await synthesize_tts(text, voice=voice, exclude=failed)
+    return await send_voice_note(context, user_id=user_id, chat_id=chat_id, audio=audio) if audio else True
+
+
+async def report_tts_error(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int, error: Exception) -> None:
+    if isinstance(error, httpx.HTTPStatusError):
+        if user_id not in _tts_warned_user_ids:
+            _tts_warned_user_ids.add(user_id)
+            detail = ""
+            try:
+                data = error.response.json()
+                if isinstance(data, dict) and isinstance(data.get("error"), str):
+                    detail = f"\n{data['error']}"
+            except Exception:
+                detail = ""
+            await context.bot.send_message(chat_id=chat_id, text=f"语音生成失败（请先配置 TTS）。{detail}".strip())
+        logger.error(f"TTS HTTP error: {error}")
         return
+    if user_id not in _tts_warned_user_ids:
+        _tts_warned_user_ids.add(user_id)
+        await context.bot.send_message(chat_id=chat_id, text="语音生成失败（请先配置 TTS）。")
+    logger.error(f"TTS error: {error}")
 
-    escaped_lines = html.escape(text, quote=False).splitlines()
-    chunks: list[str] = []
-    current = ""
 
-    def flush() -> None:
-        nonlocal current
-        if current:
-            chunks.append(current)
-            current = ""
+def tts_chunks_for_text(text: str) -> list[str]:
+    """语音回复实际送去合成的分块（预合成必须与发送时一致，才能命中缓存）。"""
+    # 清理 Markdown 格式符号，避免朗读星号等
+    normalized = strip_markdown_for_tts(text)
+    if not normalized:
+        return []
+    clipped = normalized[: max(32, TG_TTS_MAX_CHARS)]
+    return split_tts_chunks(clipped, max_chars=TG_TTS_CHUNK_CHARS)
 
-    for line in escaped_lines:
-        candidate = f"{current}\n{line}" if current else line
-        if len(candidate) > max_message_chars:
-            flush()
-            if len(line) > max_message_chars:
-                for i in range(0, len(line), max_message_chars):
-                    chunks.append(line[i:i + max_message_chars])
-            else:
-                current = line
-        else:
-            current = candidate
 
-    flush()
+async def maybe_send_voice_reply(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int, text: str) -> None:
+    if not auth_store.get_user_voice_enabled(user_id):
+        return
 
-    for chunk in chunks:
-        payload = f"<pre>\n{chunk}\n</pre>"
-        await bot.send_message(chat_id=chat_id, text=payload, parse_mode='HTML')
+    chunks = tts_chunks_for_text(text)
+    if not chunks:
+        return
+    tasks: list[asyncio.Task] = []
+    try:
+        user_voice = auth_store.get_user_tts_voice(user_id)
+        if TG_TTS_STREAM_UPLOAD and len(chunks) == 1:
+            await stream_voice_reply(context, user_id=user_id, chat_id=chat_id, text=chunks[0], voice=user_voice)
+            return
+        tasks = await synthesize_tts_chunks(chunks, voice=user_voice, parallel=TG_TTS_PARALLEL)
+        if TG_TTS_CHUNK_MODE == "stream":
+            for task in tasks:
+                audio = await task
+                if audio and not await send_voice_note(context, user_id=user_id, chat_id=chat_id, audio=audio):
+                    return
+            return
 
+        audio = await asyncio.to_thread(join_audio_chunks, list(await asyncio.gather(*tasks)))
+        if not audio:
+            return
+        await send_voice_note(context, user_id=user_id, chat_id=chat_id, audio=audio)
+    except Exception as e:
+        await report_tts_error(context, user_id=user_id, chat_id=chat_id, error=e)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_TTS_BREAK_CHARS_RE = re.compile(r'[。！？!?；;….\n]')
+
+
+class TTSPipeline:
+    """流式生成期间把已经结束的句子提前送去合成，隐藏 TTS 延迟。
+
+    feed() 接收 SSE delta；某句之后已出现后续字符才认为该句结束（避免把 "3." 当句末）。
+    流式期间只合成不发送：回复可能在结尾才变成状态栏/代码块（与非流水线行为一致，不发语音），
+    已发出的语音无法撤回。发送在 finish() 中进行，finish() 作为 voice_pool 任务按用户排队执行，
+    不会与同一用户下一条回复的语音交错；stream 模式按顺序逐块发送，join 模式合并为一条。
+    """
+
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int,
+                 voice: Optional[str], mode: str, parallel: int):
+        self.context = context
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.voice = voice
+        self.mode = mode
+        self._semaphore = asyncio.Semaphore(max(1, int(parallel)))
+        self._raw = ""
+        self._consumed = 0
+        self._chars = 0
+        self._tasks: list[asyncio.Task] = []
+        self.aborted = False
+
+    def feed(self, delta: str) -> None:
+        if self.aborted or not delta:
+            return
+        self._raw += delta
+        if not _TTS_BREAK_CHARS_RE.search(delta):
+            return
+        if looks_like_preformatted_block(self._raw):
+            self.abort()
+            return
+        end = self._consumed
+        for m in _TTS_SENTENCE_RE.finditer(self._raw, self._consumed):
+            if m.end() >= len(self._raw):
+                break
+            end = m.end()
+        if end <= self._consumed:
+            return
+        pending = self._raw[self._consumed:end]
+        if self._tasks and len(pending.strip()) < TG_TTS_PIPELINE_MIN_CHARS:
+            return
+        self._consumed = end
+        self._submit(pending)
+
+    def _submit(self, raw_piece: str) -> None:
+        normalized = strip_markdown_for_tts(raw_piece)
+        for chunk in split_tts_chunks(normalized, max_chars=TG_TTS_CHUNK_CHARS):
+            budget = max(32, TG_TTS_MAX_CHARS) - self._chars
+            if budget <= 0:
+                return
+            chunk = chunk[:budget]
+            self._chars += len(chunk)
+            self._tasks.append(asyncio.create_task(self._synthesize(chunk)))
+
+    async def _synthesize(self, chunk: str) -> bytes:
+        async with self._semaphore:
+            return await synthesize_tts(chunk, voice=self.voice)
+
+    async def _send_in_order(self) -> None:
+        for task in self._tasks:
+            audio = await task
+            if audio and not await send_voice_note(self.context, user_id=self.user_id, chat_id=self.chat_id, audio=audio):
+                return
 
-# Edge TTS 常量（模拟 Microsoft Translator App）
-_EDGE_ENDPOINT_URL = "https://dev.microsofttranslator.com/apps/endpoint?api-version=1.0"
-_EDGE_USER_AGENT = "okhttp/4.5.0"
-_EDGE_CLIENT_VERSION = "4.0.530a 5fe1dc6c"
-_EDGE_USER_ID = "0f04d16a175c411e"
-_EDGE_HOME_REGION = "zh-Hans-CN"
-_EDGE_CLIENT_TRACE_ID = "aab069b9-70a7-4844-a734-96cd78d94be9"
-_EDGE_DECODE_KEY = "oik6PdDdMnOXemTbwvMn9de/h9lFnfBaCWbGMMZqqoSaQaqUOqjVGm5NqsmjcBI1x+sS9ugjB55HEJWRiFXYFw=="
+    async def finish(self, final_text: str) -> None:
+        if self.aborted:
+            return
+        if looks_like_preformatted_block(final_text):
+            self.abort()
+            return
+        # 插件在 done 事件里返回宏替换后的最终文本；前缀一致时以它为准
+        source = final_text if final_text.startswith(self._raw[:self._consumed]) else self._raw
+        rest = source[self._consumed:]
+        if rest.strip():
+            self._consumed = len(source)
+            self._submit(rest)
+        try:
+            if self.mode == "stream":
+                await self._send_in_order()
+                return
+            audio = await asyncio.to_thread(join_audio_chunks, list(await asyncio.gather(*self._tasks)))
+            if audio:
+                await send_voice_note(self.context, user_id=self.user_id, chat_id=self.chat_id, audio=audio)
+        except Exception as e:
+            await report_tts_error(self.context, user_id=self.user_id, chat_id=self.chat_id, error=e)
+        finally:
+            self.abort()
+
+    def abort(self) -> None:
+        self.aborted = True
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # 标记异常已读取，避免 "exception was never retrieved"
+
+
+class VoiceDeliveryPool:
+    """后台语音发送工作池。
+
+    每个用户一个待发送队列（超过 max_pending_per_user 时丢弃最旧的），同一用户同一时刻只有
+    一个任务在执行以保证顺序；有待发送任务的用户排在 _ready 中轮流被 worker 取走。
+    全局待发送总数超过 max_queue 时直接丢弃新任务。
+    """
+
+    def __init__(self, *, workers: int, max_queue: int, max_pending_per_user: int):
+        self.workers = max(0, int(workers))
+        self.max_queue = max(1, int(max_queue))
+        self.max_pending_per_user = max(1, int(max_pending_per_user))
+        self._pending: Dict[int, deque] = {}
+        self._scheduled: set[int] = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._size = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def depth(self) -> int:
+        return self._size
+
+    def start(self) -> None:
+        if self.running or self.workers <= 0:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
 
-_edge_endpoint_lock = asyncio.Lock()
-_edge_endpoint_cache: Optional[dict] = None
-_edge_endpoint_expires_at: float = 0.0
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+        for queue in self._pending.values():
+            while queue:
+                self._drop(queue.popleft())
+        self._pending.clear()
+        self._scheduled.clear()
+        self._size = 0
+
+    async def join(self, timeout: float) -> bool:
+        """等待已入队的语音发送完（最多 timeout 秒），返回是否已全部完成。"""
+        deadline = time.monotonic() + timeout
+        while self._scheduled and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return not self._scheduled
+
+    def _drop(self, item: tuple) -> None:
+        self.dropped += 1
+        on_drop = item[1]
+        if on_drop is not None:
+            try:
+                on_drop()
+            except Exception as e:
+                logger.error(f"Voice job drop callback failed: {e}")
+
+    def submit(self, user_id: int, job: Callable[[], Awaitable[None]], *,
+               on_drop: Optional[Callable[[], None]] = None) -> bool:
+        """入队；工作池未运行时返回 False，由调用方直接执行。"""
+        if not self.running:
+            return False
+        if self._size >= self.max_queue:
+            logger.warning(f"Voice queue full ({self._size}), dropping clip for user {user_id}")
+            self._drop((job, on_drop))
+            return True
+        queue = self._pending.setdefault(user_id, deque())
+        queue.append((job, on_drop, current_trace_id()))
+        self._size += 1
+        while len(queue) > self.max_pending_per_user:
+            self._drop(queue.popleft())
+            self._size -= 1
+        if user_id not in self._scheduled:
+            self._scheduled.add(user_id)
+            self._ready.put_nowait(user_id)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            user_id = await self._ready.get()
+            queue = self._pending.get(user_id)
+            if not queue:
+                self._scheduled.discard(user_id)
+                self._pending.pop(user_id, None)
+                continue
+            job, _, trace_id = queue.popleft()
+            self._size -= 1
+            try:
+                with trace_context(trace_id):
+                    await job()
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Voice job failed: {e}")
+            finally:
+                if queue:
+                    self._ready.put_nowait(user_id)
+                else:
+                    self._scheduled.discard(user_id)
+                    self._pending.pop(user_id, None)
 
+    def stats(self) -> str:
+        return (
+            f"voice_queue={self._size}/{self.max_queue} users={len(self._scheduled)} "
+            f"(done {self.completed}, failed {self.failed}, dropped {self.dropped})"
+        )
 
-def _edge_sign(url_str: str) -> str:
-    """生成 Microsoft Translator 签名"""
-    u = url_str.split("://")[1]
-    encoded_url = quote(u, safe='')
-    uuid_str = str(uuid.uuid4()).replace("-", "")
-    formatted_date = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S").lower() + "gmt"
-    bytes_to_sign = f"MSTranslatorAndroidApp{encoded_url}{formatted_date}{uuid_str}".lower().encode('utf-8')
-    decode = base64.b64decode(_EDGE_DECODE_KEY)
-    hmac_sha256 = hmac.new(decode, bytes_to_sign, hashlib.sha256)
-    secret_key = hmac_sha256.digest()
-    sign_base64 = base64.b64encode(secret_key).decode()
-    return f"MSTranslatorAndroidApp::{sign_base64}::{formatted_date}::{uuid_str}"
 
+voice_pool = VoiceDeliveryPool(
+    workers=TG_VOICE_WORKERS,
+    max_queue=TG_VOICE_QUEUE_SIZE,
+    max_pending_per_user=TG_VOICE_MAX_PENDING_PER_USER,
+)
 
-async def _edge_get_endpoint() -> dict:
-    """获取 TTS endpoint（带缓存）"""
-    global _edge_endpoint_cache, _edge_endpoint_expires_at
 
-    now = time.time()
-    if _edge_endpoint_cache and now < _edge_endpoint_expires_at - 60:
-        return _edge_endpoint_cache
+def tts_is_cached(text: str, voice: Optional[str]) -> bool:
+    return any(key in tts_cache for _, key, _ in _tts_candidates(text, voice))
 
-    async with _edge_endpoint_lock:
-        now = time.time()
-        if _edge_endpoint_cache and now < _edge_endpoint_expires_at - 60:
-            return _edge_endpoint_cache
 
-        signature = _edge_sign(_EDGE_ENDPOINT_URL)
-        headers = {
-            "Accept-Language": "zh-Hans",
-            "X-ClientVersion": _EDGE_CLIENT_VERSION,
-            "X-UserId": _EDGE_USER_ID,
-            "X-HomeGeographicRegion": _EDGE_HOME_REGION,
-            "X-ClientTraceId": _EDGE_CLIENT_TRACE_ID,
-            "X-MT-Signature": signature,
-            "User-Agent": _EDGE_USER_AGENT,
-            "Content-Type": "application/json; charset=utf-8",
-        }
-        resp = await tts_http_client.post(_EDGE_ENDPOINT_URL, headers=headers, content=b"")
-        resp.raise_for_status()
-        endpoint = resp.json()
+class TTSPrewarmer:
+    """低优先级的后台预合成（如角色开场白），结果写入 tts_cache，之后发送时直接命中缓存。
 
-        # 解析 JWT 获取过期时间
-        jwt_parts = endpoint['t'].split('.')
-        if len(jwt_parts) >= 2:
-            jwt_payload = jwt_parts[1]
-            # 补齐 base64 padding
-            padding = 4 - len(jwt_payload) % 4
-            if padding != 4:
-                jwt_payload += '=' * padding
-            decoded_jwt = json.loads(base64.b64decode(jwt_payload).decode('utf-8'))
-            _edge_endpoint_expires_at = decoded_jwt.get('exp', now + 600)
-        else:
-            _edge_endpoint_expires_at = now + 600
+    单个 worker 顺序处理，后台语音发送队列中有任务时让路；队列满或重复提交的文本直接忽略。
+    """
+
+    def __init__(self, *, max_queue: int):
+        self.max_queue = max(1, int(max_queue))
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: set[tuple[str, str]] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.synthesized = 0
+        self.skipped = 0
 
-        _edge_endpoint_cache = endpoint
-        return endpoint
+    def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._worker())
 
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        self._task = None
+        self._queued.clear()
+
+    def submit(self, texts: list[str], *, voice: Optional[str]) -> int:
+        if self._task is None or not tts_cache.enabled:
+            return 0
+        added = 0
+        for text in texts:
+            item = (str(text or ""), voice or "")
+            if not item[0].strip() or item in self._queued or len(self._queued) >= self.max_queue:
+                continue
+            self._queued.add(item)
+            self._queue.put_nowait(item)
+            added += 1
+        return added
 
-def _edge_build_ssml(text: str, *, voice_name: str, rate: str, pitch: str, style: str) -> str:
-    """构建 SSML"""
-    safe_text = html.escape(str(text or ""), quote=False)
-    safe_voice = html.escape(str(voice_name or EDGE_TTS_DEFAULT_VOICE), quote=True)
-    safe_style = html.escape(str(style or EDGE_TTS_DEFAULT_STYLE), quote=True)
+    async def _worker(self) -> None:
+        while True:
+            item = await self._queue.get()
+            text, voice = item
+            try:
+                for chunk in tts_chunks_for_text(text):
+                    # 让正在等待的真实语音回复优先使用 TTS 提供商
+                    while voice_pool.depth() > 0:
+                        await asyncio.sleep(0.5)
+                    if tts_is_cached(chunk, voice or None):
+                        self.skipped += 1
+                        continue
+                    await synthesize_tts(chunk, voice=voice or None)
+                    self.synthesized += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"TTS prewarm failed: {e}")
+            finally:
+                self._queued.discard(item)
+
+    def depth(self) -> int:
+        return len(self._queued)
+
+    def stats(self) -> str:
+        return f"tts_prewarm={len(self._queued)} queued (synthesized {self.synthesized}, already cached {self.skipped})"
+
+
+tts_prewarmer = TTSPrewarmer(max_queue=256)
+
+
+def prewarm_greetings(user_id: int, result: Dict[str, Any]) -> None:
+    """切换角色后预合成该角色的开场白（当前开场白优先），仅对开启语音的用户。"""
+    if TG_GREETING_PREWARM_MAX <= 0 or not auth_store.get_user_voice_enabled(user_id):
+        return
+    greetings = [g for g in (result.get("greetings") or []) if isinstance(g, str)]
+    current = result.get("currentGreetingIndex", 0)
+    if isinstance(current, int) and 0 <= current < len(greetings):
+        greetings.insert(0, greetings.pop(current))
+    tts_prewarmer.submit(greetings[:TG_GREETING_PREWARM_MAX], voice=auth_store.get_user_tts_voice(user_id))
+
+
+async def deliver_voice_reply(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int, text: str,
+                              pipeline: Optional["TTSPipeline"] = None) -> None:
+    """把语音回复交给后台工作池；工作池未启用时在当前处理中直接发送。"""
+    if pipeline is not None:
+        job = lambda: pipeline.finish(text)
+        on_drop = pipeline.abort
+    else:
+        if not auth_store.get_user_voice_enabled(user_id):
+            return
+        job = lambda: maybe_send_voice_reply(context, user_id=user_id, chat_id=chat_id, text=text)
+        on_drop = None
+    if voice_pool.submit(user_id, job, on_drop=on_drop):
+        return
+    await job()
 
-    return (
-        '<speak xmlns="http://www.w3.org/2001/10/synthesis" '
-        'xmlns:mstts="http://www.w3.org/2001/mstts" version="1.0" xml:lang="zh-CN">'
-        f'<voice name="{safe_voice}">'
-        f'<mstts:express-as style="{safe_style}" styledegree="1.0" role="default">'
-        f'<prosody rate="{rate}%" pitch="{pitch}%">{safe_text}</prosody>'
-        '</mstts:express-as>'
-        '</voice>'
-        '</speak>'
+
+def start_tts_pipeline(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int) -> Optional[TTSPipeline]:
+    if not TG_TTS_PIPELINE or not auth_store.get_user_voice_enabled(user_id):
+        return None
+    return TTSPipeline(
+        context,
+        user_id=user_id,
+        chat_id=chat_id,
+        voice=auth_store.get_user_tts_voice(user_id),
+        mode=TG_TTS_CHUNK_MODE,
+        parallel=TG_TTS_PARALLEL,
     )
 
 
-async def edge_tts(text: str, *, voice_name: Optional[str] = None) -> bytes:
-    """Edge TTS 语音合成"""
-    endpoint = await _edge_get_endpoint()
-    voice = (voice_name or EDGE_TTS_DEFAULT_VOICE).strip() or EDGE_TTS_DEFAULT_VOICE
-    ssml = _edge_build_ssml(
-        str(text or ""),
-        voice_name=voice,
-        rate=EDGE_TTS_DEFAULT_RATE,
-        pitch=EDGE_TTS_DEFAULT_PITCH,
-        style=EDGE_TTS_DEFAULT_STYLE,
-    )
-    tts_url = f"https://{endpoint['r']}.tts.speech.microsoft.com/cognitiveservices/v1"
-    resp = await tts_http_client.post(
-        tts_url,
-        headers={
-            "Authorization": endpoint["t"],
-            "Content-Type": "application/ssml+xml",
-            "X-Microsoft-OutputFormat": EDGE_TTS_OUTPUT_FORMAT,
-        },
-        content=ssml.encode("utf-8"),
-    )
-    resp.raise_for_status()
-    return resp.content
+class _StreamTimings:
+    """一次流式回复的埋点：首个 delta、首次编辑、编辑轮数、总耗时。
 
+    同时补记 span：stream.reply 为根，其下 st.prompt_build（插件报告的耗时）、llm.first_byte、
+    stream.end；期间的 telegram.edit / tts.synthesize 等 span 也挂在 stream.reply 下。
+    """
 
-_tts_warned_user_ids: set[int] = set()
-_voice_send_warned_user_ids: set[int] = set()
+    __slots__ = ("started", "got_token", "edits", "span_id")
 
+    def __init__(self):
+        self.started = time.monotonic()
+        self.got_token = False
+        self.edits = 0
+        self.span_id = secrets.token_hex(4)
+        if span_exporter.enabled:
+            _span_id_var.set(self.span_id)
+        runtime_stats.active_streams += 1
 
-async def maybe_send_voice_reply(context: ContextTypes.DEFAULT_TYPE, *, user_id: int, chat_id: int, text: str) -> None:
-    if not auth_store.get_user_voice_enabled(user_id):
-        return
+    def event(self, event: Dict[str, Any]) -> None:
+        if event.get("started") and isinstance(event.get("promptMs"), (int, float)):
+            now = time.monotonic()
+            record_span("st.prompt_build", now - event["promptMs"] / 1000.0, now, reported_by="plugin")
+        if event.get("done"):
+            record_span("stream.end", self.started, time.monotonic())
 
-    # 清理 Markdown 格式符号，避免朗读星号等
-    normalized = strip_markdown_for_tts(text)
-    if not normalized:
-        return
+    def token(self) -> None:
+        if not self.got_token:
+            self.got_token = True
+            M_STREAM_FIRST_TOKEN_SECONDS.observe(time.monotonic() - self.started)
+            record_span("llm.first_byte", self.started, time.monotonic())
 
-    clipped = normalized[: max(32, TG_TTS_MAX_CHARS)]
-    try:
-        user_voice = auth_store.get_user_tts_voice(user_id)
-        provider = (TTS_PROVIDER or "plugin").strip().lower()
-        if provider == "edge":
-            audio = await edge_tts(clipped, voice_name=user_voice or EDGE_TTS_DEFAULT_VOICE)
-        else:
-            audio = await st_client.tts(clipped, tts_model=user_voice, voice=user_voice) if user_voice else await st_client.tts(clipped)
-        if not audio:
-            return
-        voice_file = InputFile(io.BytesIO(audio), filename="reply.ogg")
-        try:
-            await context.bot.send_voice(chat_id=chat_id, voice=voice_file)
-        except RetryAfter:
-            return
-        except Forbidden as e:
-            if user_id not in _voice_send_warned_user_ids:
-                _voice_send_warned_user_ids.add(user_id)
-                await context.bot.send_message(chat_id=chat_id, text="语音发送失败：对方隐私设置/限制语音消息；已保留文字回复，可在菜单关闭语音回复。")
-            logger.error(f"Voice send forbidden: {e}")
-        except BadRequest as e:
-            if user_id not in _voice_send_warned_user_ids:
-                _voice_send_warned_user_ids.add(user_id)
-                await context.bot.send_message(chat_id=chat_id, text="语音发送失败：对方隐私设置/限制语音消息；已保留文字回复，可在菜单关闭语音回复。")
-            logger.error(f"Voice send bad request: {e}")
-    except httpx.HTTPStatusError as e:
-        if user_id not in _tts_warned_user_ids:
-            _tts_warned_user_ids.add(user_id)
-            detail = ""
-            try:
-                data = e.response.json()
-                if isinstance(data, dict) and isinstance(data.get("error"), str):
-                    detail = f"\n{data['error']}"
-            except Exception:
-                detail = ""
-            await context.bot.send_message(chat_id=chat_id, text=f"语音生成失败（请先配置 TTS）。{detail}".strip())
-        logger.error(f"TTS HTTP error: {e}")
-    except Exception as e:
-        if user_id not in _tts_warned_user_ids:
-            _tts_warned_user_ids.add(user_id)
-            await context.bot.send_message(chat_id=chat_id, text="语音生成失败（请先配置 TTS）。")
-        logger.error(f"TTS error: {e}")
+    def edit(self) -> None:
+        if not self.edits:
+            M_STREAM_FIRST_EDIT_SECONDS.observe(time.monotonic() - self.started)
+        self.edits += 1
+
+    def done(self) -> None:
+        runtime_stats.active_streams -= 1
+        M_STREAM_REPLY_SECONDS.observe(time.monotonic() - self.started)
+        M_STREAM_EDITS_PER_REPLY.observe(self.edits)
+        record_span("stream.reply", self.started, time.monotonic(), span_id=self.span_id,
+                    parent_id="", edits=self.edits)
 
 
 async def handle_message_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1212,8 +4112,10 @@ async def handle_message_streaming(update: Update, context: ContextTypes.DEFAULT
     message = update.message.text
 
     typing_task = asyncio.create_task(send_typing_periodically(update.message.chat, TELEGRAM_TYPING_INTERVAL_MS))
+    pipeline = start_tts_pipeline(context, user_id=update.effective_user.id, chat_id=update.effective_chat.id)
+    timings = _StreamTimings()
     try:
-        placeholder = await update.message.reply_text(TELEGRAM_STREAM_PLACEHOLDER)
+        placeholder = update_journal.placeholder(await update.message.reply_text(TELEGRAM_STREAM_PLACEHOLDER))
 
         parts: list[str] = []
         final_message: Optional[str] = None
@@ -1224,10 +4126,14 @@ async def handle_message_streaming(update: Update, context: ContextTypes.DEFAULT
         async for event in st_client.send_message_stream(user_id, message, user_name):
             if isinstance(event.get('error'), str) and event['error']:
                 raise RuntimeError(event['error'])
+            timings.event(event)
 
             delta = event.get('delta')
             if isinstance(delta, str) and delta:
                 parts.append(delta)
+                timings.token()
+                if pipeline:
+                    pipeline.feed(delta)
 
             if event.get('done') and isinstance(event.get('message'), str):
                 final_message = event['message']
@@ -1239,6 +4145,7 @@ async def handle_message_streaming(update: Update, context: ContextTypes.DEFAULT
                     placeholder,
                     partial_text[:4000] if partial_text else TELEGRAM_STREAM_PLACEHOLDER,
                 )
+                timings.edit()
                 last_edit = now
 
         if final_message is None:
@@ -1261,10 +4168,20 @@ async def handle_message_streaming(update: Update, context: ContextTypes.DEFAULT
         if len(final_message) > 4000:
             for i in range(4000, len(final_message), 4000):
                 await update.message.reply_text(final_message[i:i+4000])
-        await maybe_send_voice_reply(context, user_id=update.effective_user.id, chat_id=update.effective_chat.id, text=final_message)
+        await deliver_voice_reply(
+            context,
+            user_id=update.effective_user.id,
+            chat_id=update.effective_chat.id,
+            text=final_message,
+            pipeline=pipeline,
+        )
+        # 流水线已交给 deliver_voice_reply，finally 中不能再 abort
+        pipeline = None
 
     except httpx.HTTPStatusError as e:
         if getattr(e.response, "status_code", None) == 404:
+            if pipeline:
+                pipeline.abort()
             await handle_message(update, context)
         else:
             await update.message.reply_text(f"? 错误: {e}")
@@ -1276,6 +4193,9 @@ async def handle_message_streaming(update: Update, context: ContextTypes.DEFAULT
         logger.error(f"Streaming message error: {e}")
         await update.message.reply_text(f"? 错误: {e}")
     finally:
+        timings.done()
+        if pipeline:
+            pipeline.abort()
         typing_task.cancel()
         try:
             await typing_task
@@ -1295,8 +4215,10 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
     llm_model = auth_store.get_user_llm_model(update.effective_user.id)
 
     typing_task = asyncio.create_task(send_typing_periodically(update.message.chat, TELEGRAM_TYPING_INTERVAL_MS))
+    pipeline = start_tts_pipeline(context, user_id=update.effective_user.id, chat_id=update.effective_chat.id)
+    timings = _StreamTimings()
     try:
-        status_message = await update.message.reply_text(TELEGRAM_STREAM_PLACEHOLDER)
+        status_message = update_journal.placeholder(await update.message.reply_text(TELEGRAM_STREAM_PLACEHOLDER))
 
         buffer = ""
         final_message: Optional[str] = None
@@ -1311,10 +4233,14 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
         async for event in st_client.send_message_stream(user_id, message, user_name, llm_model=llm_model):
             if isinstance(event.get('error'), str) and event['error']:
                 raise RuntimeError(event['error'])
+            timings.event(event)
 
             delta = event.get('delta')
             if isinstance(delta, str) and delta:
                 buffer += delta
+                timings.token()
+                if pipeline:
+                    pipeline.feed(delta)
 
             if event.get('done') and isinstance(event.get('message'), str):
                 final_message = event['message']
@@ -1329,13 +4255,14 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
             if not status_mode and ("<stausblock" in lowered or "<statusblock" in lowered):
                 status_mode = True
                 await edit_message_html_if_changed(status_message, "状态读取中…")
-                body_messages.append(await update.message.reply_text("正文生成中…"))
+                body_messages.append(update_journal.placeholder(await update.message.reply_text("正文生成中…")))
 
             if not status_mode:
                 await edit_message_if_changed(
                     status_message,
                     buffer[:4000] if buffer else TELEGRAM_STREAM_PLACEHOLDER,
                 )
+                timings.edit()
                 last_edit = now
                 continue
 
@@ -1361,13 +4288,14 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
             )
             if body is not None:
                 if not body_messages:
-                    body_messages.append(await update.message.reply_text("正文生成中…"))
+                    body_messages.append(update_journal.placeholder(await update.message.reply_text("正文生成中…")))
                 pages = split_text_pages(body, max_chars=3500)
                 while len(body_messages) < len(pages):
-                    body_messages.append(await update.message.reply_text("…"))
+                    body_messages.append(update_journal.placeholder(await update.message.reply_text("…")))
                 for i, page in enumerate(pages):
                     await edit_message_html_if_changed(body_messages[i], f"<b>正文</b>\n{render_body_html(page)}")
 
+            timings.edit()
             last_edit = now
 
         if final_message is None:
@@ -1389,10 +4317,10 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
                 )
                 if body_final is not None:
                     if not body_messages:
-                        body_messages.append(await update.message.reply_text("…"))
+                        body_messages.append(update_journal.placeholder(await update.message.reply_text("…")))
                     pages = split_text_pages(body_final, max_chars=3500)
                     while len(body_messages) < len(pages):
-                        body_messages.append(await update.message.reply_text("…"))
+                        body_messages.append(update_journal.placeholder(await update.message.reply_text("…")))
                     for i, page in enumerate(pages):
                         await edit_message_html_if_changed(body_messages[i], f"<b>正文</b>\n{render_body_html(page)}")
 
@@ -1422,10 +4350,20 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
         if len(final_message) > 4000:
             for i in range(4000, len(final_message), 4000):
                 await update.message.reply_text(final_message[i:i+4000])
-        await maybe_send_voice_reply(context, user_id=update.effective_user.id, chat_id=update.effective_chat.id, text=final_message)
+        await deliver_voice_reply(
+            context,
+            user_id=update.effective_user.id,
+            chat_id=update.effective_chat.id,
+            text=final_message,
+            pipeline=pipeline,
+        )
+        # 流水线已交给 deliver_voice_reply，finally 中不能再 abort
+        pipeline = None
 
     except httpx.HTTPStatusError as e:
         if getattr(e.response, "status_code", None) == 404:
+            if pipeline:
+                pipeline.abort()
             await handle_message(update, context)
         else:
             await update.message.reply_text(f"? 错误: {e}")
@@ -1437,6 +4375,9 @@ async def handle_message_streaming_ui(update: Update, context: ContextTypes.DEFA
         logger.error(f"Streaming message error: {e}")
         await update.message.reply_text(f"? 错误: {e}")
     finally:
+        timings.done()
+        if pipeline:
+            pipeline.abort()
         typing_task.cancel()
         try:
             await typing_task
@@ -1616,6 +4557,85 @@ async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("\n".join(lines))
 
 
+def _format_ms(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def format_perf_report(app: Application) -> str:
+    """只读进程内计数器，不访问插件或磁盘。"""
+    stats = runtime_stats
+    calls_1m = stats.total(stats.bot_api_calls, 60)
+    top_methods = sorted(
+        ((m, c.count(60)) for m, c in stats.bot_api_calls.items()), key=lambda kv: kv[1], reverse=True,
+    )
+    top_text = ", ".join(f"{m} {n}" for m, n in top_methods[:3] if n)
+    edits_5m = stats.total(stats.bot_api_calls, 300, "editMessageText")
+    edit_failures_5m = stats.total(stats.bot_api_failures, 300, "editMessageText")
+    edit_rate = f"{(edits_5m - edit_failures_5m) * 100 / edits_5m:.1f}%" if edits_5m else "-"
+    retry_10m = stats.total(stats.retry_after, 600)
+    retry_text = ", ".join(
+        f"{m} {c.count(600)}" for m, c in sorted(stats.retry_after.items()) if c.count(600)
+    )
+    lookups = tts_cache.hits + tts_cache.misses
+    cache_rate = f"{tts_cache.hits * 100 / lookups:.1f}%" if lookups else "-"
+    processor = app.update_processor
+    queued = processor.queued if isinstance(processor, TrackedUpdateProcessor) else 0
+    lag = (
+        f"{_format_ms(loop_watchdog.recent.max(60))}（最近 1 分钟最大），卡顿 {loop_watchdog.stalls} 次"
+        if loop_watchdog.enabled else "未开启"
+    )
+    lines = [
+        "📈 运行状态",
+        f"流式回复进行中：{stats.active_streams}",
+        f"update 处理中：{processor.current_concurrent_updates}/{processor.max_concurrent_updates}，排队 {queued}",
+        f"语音发送队列：{voice_pool.depth()}，预合成队列：{tts_prewarmer.depth()}",
+        *([f"Webhook：{webhook_receiver.summary()}"] if webhook_receiver else []),
+        f"Bot API 调用（1 分钟）：{calls_1m}" + (f"（{top_text}）" if top_text else ""),
+        f"编辑成功率（5 分钟）：{edit_rate}（{edits_5m} 次）",
+        f"RetryAfter（10 分钟）：{retry_10m}" + (f"（{retry_text}）" if retry_text else ""),
+        f"SillyTavern p50/p95（5 分钟）：{_format_ms(stats.st_latency.percentile(50, 300))} / "
+        f"{_format_ms(stats.st_latency.percentile(95, 300))}",
+        f"TTS 缓存命中率：{cache_rate}（{tts_cache.hits}/{lookups}）",
+        f"授权库写入（1 分钟）：{stats.auth_writes.count(60)}",
+        f"RSS：{process_rss_bytes() / (1024 * 1024):.1f} MiB",
+        f"事件循环延迟：{lag}",
+    ]
+    return "\n".join(lines)
+
+
+async def cmd_perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_chat or update.effective_chat.type != 'private':
+        return
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    await update.message.reply_text(format_perf_report(context.application))
+
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_chat or update.effective_chat.type != 'private':
+        return
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    seconds = 10.0
+    if context.args:
+        try:
+            seconds = float(context.args[0])
+        except ValueError:
+            await update.message.reply_text("用法：/profile [秒数]（1-60，默认 10）")
+            return
+    seconds = min(60.0, max(1.0, seconds))
+
+    if _profile_lock.locked():
+        await update.message.reply_text("已有采样正在进行，请稍后再试。")
+        return
+    async with _profile_lock:
+        await update.message.reply_text(f"⏳ 正在采样 {seconds:.0f} 秒…")
+        result = await asyncio.to_thread(sample_thread_stacks, threading.get_ident(), seconds)
+    await send_preformatted_html(context.bot, update.effective_chat.id, format_profile_report(result))
+
+
 async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat or update.effective_chat.type != 'private':
         return
@@ -1856,7 +4876,7 @@ async def cmd_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         "未识别的命令。\n"
         "可用命令：/start /help /status /chars /presets /worlds /clear /mymodel /delmodel\n"
         "多用户：/register\n"
-        "（管理员：/invite /pending /approve /revoke /registration /users）"
+        "（管理员：/invite /pending /approve /revoke /registration /users /perf /profile）"
     )
 
 
@@ -1893,7 +4913,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     await update.message.reply_text(ai_response[i:i+4000])
             else:
                 await update.message.reply_text(ai_response)
-            await maybe_send_voice_reply(context, user_id=update.effective_user.id, chat_id=update.effective_chat.id, text=ai_response)
+            await deliver_voice_reply(context, user_id=update.effective_user.id, chat_id=update.effective_chat.id, text=ai_response)
         else:
             error = result.get('error', 'Unknown error')
             await update.message.reply_text(f"❌ {error}")
@@ -2516,12 +5536,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
                 safe_name = md_escape(char.get('name') or 'Unknown')
                 text = f"✅ 已选择角色: **{safe_name}**\n"
+                # 先排队预合成，当前开场白的语音随后直接命中缓存
+                prewarm_greetings(update.effective_user.id, result)
                 if greeting:
                     await send_long_plain_text(
                         context.bot,
                         query.message.chat_id,
                         f"💬 开场白 ({current_index + 1}/{greetings_count}):\n{greeting}",
                     )
+                    await deliver_voice_reply(context, user_id=update.effective_user.id,
+                                              chat_id=query.message.chat_id, text=greeting)
                     text += f"\n💬 开场白 ({current_index + 1}/{greetings_count}) 已发送"
 
                 keyboard = []
@@ -2560,6 +5584,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         query.message.chat_id,
                         f"💬 开场白 ({current_index + 1}/{greetings_count}):\n{greeting}",
                     )
+                    await deliver_voice_reply(context, user_id=update.effective_user.id,
+                                              chat_id=query.message.chat_id, text=greeting)
                     text = f"💬 已发送开场白：({current_index + 1}/{greetings_count})"
                 else:
                     text = f"💬 开场白：({current_index + 1}/{greetings_count})（无开场白）"
@@ -2673,27 +5699,980 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.error(f"Exception: {context.error}")
 
 
-def main() -> None:
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("TELEGRAM_BOT_TOKEN not set!")
-        return
+# ============================================
+# Update journal（已接收 update 的持久化：重启后不丢失、不重复）
+# ============================================
+
+# 当前 task 正在处理的 update_id（TrackedUpdateProcessor 为每个 update 的 task 设置）
+_current_update_id: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_update_id", default=None)
+
+_INTERRUPTED_TEXT = "⚠️ 这条回复因 Bot 重启中断，请重新发送上一条消息。"
+
+
+class JournalFile:
+    """追加写的 JSON lines 文件。
+
+    write() 只写入页缓存；需要落盘时 await sync()：fsync 在线程中执行、不阻塞事件循环，
+    同时等待的多条记录共用一次 fsync（组提交）。rewrite() 用于压缩，频率很低，在事件循环上同步完成；
+    有 fsync 正在进行时跳过（不能在线程使用 fd 时关闭文件），下次再压缩。
+    """
+
+    def __init__(self, path: str, *, label: str):
+        self.path = Path(path) if path else None
+        self.label = label
+        self.records = 0
+        self._file = None
+        self._written = 0
+        self._synced = 0
+        self._sync_task: Optional[asyncio.Task] = None
+        self._failed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _fail(self, action: str, error: OSError) -> None:
+        if not self._failed:
+            logger.error(f"{self.label} {action} failed: {error}")
+        self._failed = True
+
+    @staticmethod
+    def _encode(record: Dict[str, Any]) -> bytes:
+        return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        if self.path is None:
+            return
+        try:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = self.path.open("ab")
+            self._file.write(self._encode(record))
+            self._file.flush()
+            self.records += 1
+            self._written += 1
+        except OSError as e:
+            self._fail("write", e)
+
+    async def sync(self) -> None:
+        """等待到目前为止写入的记录全部 fsync。"""
+        target = self._written
+        while self._file is not None and self._synced < target:
+            if self._sync_task is None:
+                self._sync_task = asyncio.create_task(self._fsync())
+            await asyncio.shield(self._sync_task)
+
+    async def _fsync(self) -> None:
+        upto = self._written
+        try:
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+        except OSError as e:
+            self._fail("fsync", e)
+        finally:
+            # 失败时同样推进，避免等待方反复重试；错误已记日志
+            self._synced = max(self._synced, upto)
+            self._sync_task = None
+
+    def read(self) -> list[Dict[str, Any]]:
+        if self.path is None:
+            return []
+        try:
+            raw = self.path.read_bytes()
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            logger.error(f"{self.label} load failed: {e}")
+            return []
+        records = []
+        for line in raw.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 进程在写入途中被杀：可能残留半行，直接丢弃
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+        return records
+
+    def rewrite(self, records: list[Dict[str, Any]]) -> bool:
+        """用 records 替换整个文件（写临时文件、fsync 后替换）；返回是否已替换。"""
+        if self.path is None or self._sync_task is not None:
+            return False
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(self.path.suffix + f".{os.getpid()}.tmp")
+            with tmp_path.open("wb") as f:
+                for record in records:
+                    f.write(self._encode(record))
+                f.flush()
+                os.fsync(f.fileno())
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"{self.label} compaction failed: {e}")
+            return False
+        self.records = len(records)
+        self._synced = self._written
+        return True
+
+
+class UpdateJournal:
+    """updates.journal 追加日志（JSON lines）：accept / dispatched / placeholder / done 四种记录。
+
+    update 进入处理器时写 accept（含原始 update，组提交 fsync 完成后才开始处理），调用插件前写 dispatched，发出占位消息时写
+    placeholder，处理结束（包括 handler 出错）写 done；进程退出时被取消的 update 没有 done。
+    启动时 recover()：未调用插件的重新放入 update_queue 继续处理；已调用插件的不再重跑（插件可能已把
+    用户发言写入聊天记录），把占位消息改为中断提示。最近 dedup_window 个已完成的 update_id 会保留，
+    polling 重启后重复下发或 webhook 重发的 update 直接跳过。
+
+    排队时间超过 max_age_s 的消息不再调用 LLM：按会话合并，稍后只发一条提示。
+    """
+
+    def __init__(self, path: str, *, max_age_s: float, dedup_window: int = 2000, compact_every: int = 10000):
+        self.path = Path(path) if path else None
+        self.max_age_s = max_age_s
+        self.dedup_window = dedup_window
+        self.compact_every = compact_every
+        self._log = JournalFile(path, label="Update journal")
+        self._inflight: Dict[int, Dict[str, Any]] = {}
+        self._done: OrderedDict[int, None] = OrderedDict()
+        self._replay: set[int] = set()
+        self._stale_pending: Dict[int, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.duplicates = 0
+        self.resumed = 0
+        self.interrupted = 0
+        self.stale = 0
+
+    # ---- 处理流程 ----
+
+    async def begin(self, update: Update) -> bool:
+        """返回 False 表示重复的 update；返回 True 时 accept 记录已落盘。"""
+        update_id = update.update_id
+        if update_id in self._replay:
+            self._replay.discard(update_id)
+            return True
+        if update_id in self._done or update_id in self._inflight:
+            self.duplicates += 1
+            return False
+        payload = update.to_dict()
+        entry = {"at": _now_ms(), "update": payload, "dispatched": False, "placeholders": []}
+        self._inflight[update_id] = entry
+        self._log.write({"op": "accept", "id": update_id, "at": entry["at"], "update": payload})
+        await self._log.sync()
+        return True
+
+    def mark_dispatched(self) -> None:
+        entry = self._current()
+        if entry is not None and not entry["dispatched"]:
+            entry["dispatched"] = True
+            self._log.write({"op": "dispatched", "id": _current_update_id.get()})
+
+    def placeholder(self, message: Message) -> Message:
+        """记录本 update 发出的占位消息，原样返回 message。"""
+        entry = self._current()
+        if entry is not None:
+            entry["placeholders"].append([message.chat_id, message.message_id])
+            self._log.write({"op": "placeholder", "id": _current_update_id.get(),
+                          "chat": message.chat_id, "msg": message.message_id})
+        return message
+
+    async def finish(self, update_id: int) -> None:
+        """handler 结束后调用：done 与 accept 一样等待落盘。否则崩溃后 recover() 会把已经发出
+        最终回复的占位消息改成中断提示。"""
+        if self._finish(update_id):
+            await self._log.sync()
+
+    def _finish(self, update_id: int) -> bool:
+        entry = self._inflight.get(update_id)
+        if entry is None or entry.get("deferred"):
+            return False
+        del self._inflight[update_id]
+        self._remember_done(update_id)
+        self._log.write({"op": "done", "id": update_id})
+        if self._log.records >= self.compact_every:
+            self._compact()
+        return True
+
+    def defer(self, update_id: int) -> None:
+        """不处理、也不记 done：下次启动由 recover() 重新放入 update_queue。"""
+        entry = self._inflight.get(update_id)
+        if entry is not None:
+            entry["deferred"] = True
+
+    def _current(self) -> Optional[Dict[str, Any]]:
+        update_id = _current_update_id.get()
+        return self._inflight.get(update_id) if update_id is not None else None
+
+    def _remember_done(self, update_id: int) -> None:
+        self._done[update_id] = None
+        while len(self._done) > self.dedup_window:
+            self._done.popitem(last=False)
+
+    # ---- 过期消息 ----
+
+    def _age_s(self, update: Update) -> float:
+        message = update.message or update.channel_post
+        if message is not None and message.date is not None:
+            return time.time() - message.date.timestamp()
+        entry = self._inflight.get(update.update_id)
+        return (_now_ms() - entry["at"]) / 1000.0 if entry else 0.0
+
+    def skip_if_stale(self, update: Update) -> bool:
+        if self.max_age_s <= 0 or self._age_s(update) <= self.max_age_s:
+            return False
+        self.stale += 1
+        # 过期的 update 没有发出任何回复，done 不必等待落盘：崩溃后重放时会再次按过期跳过
+        self._finish(update.update_id)
+        chat, user = update.effective_chat, update.effective_user
+        if update.message and chat and chat.type == "private" and user and is_authorized(user.id):
+            self._stale_pending[chat.id] = self._stale_pending.get(chat.id, 0) + 1
+            if self._stale_pending[chat.id] == 1:
+                task = asyncio.create_task(self._send_stale_notice(update.get_bot(), chat.id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _send_stale_notice(self, bot: Bot, chat_id: int) -> None:
+        # 积压的 update 会连续到达，稍等片刻再按条数合并成一条提示
+        await asyncio.sleep(2.0)
+        count = self._stale_pending.pop(chat_id, 0)
+        minutes = max(1, round(self.max_age_s / 60))
+        with contextlib.suppress(TelegramError):
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"⚠️ Bot 离线期间收到的 {count} 条消息已超过 {minutes} 分钟，未作处理；如仍需回复请重新发送。",
+            )
+
+    # ---- 持久化 ----
+
+    def _load(self) -> None:
+        for record in self._log.read():
+            op, update_id = record.get("op"), record.get("id")
+            if op is None or update_id is None:
+                continue
+            if op == "accept" and isinstance(record.get("update"), dict):
+                self._inflight[update_id] = {
+                    "at": record.get("at") or _now_ms(), "update": record["update"],
+                    "dispatched": False, "placeholders": [],
+                }
+            elif op == "done":
+                self._inflight.pop(update_id, None)
+                self._remember_done(update_id)
+            elif update_id in self._inflight:
+                entry = self._inflight[update_id]
+                if op == "dispatched":
+                    entry["dispatched"] = True
+                elif op == "placeholder":
+                    entry["placeholders"].append([record.get("chat"), record.get("msg")])
+
+    def _compact(self) -> None:
+        """只保留去重窗口内的 done 与未完成 update 的记录。"""
+        lines: list[Dict[str, Any]] = [{"op": "done", "id": update_id} for update_id in self._done]
+        for update_id, entry in self._inflight.items():
+            lines.append({"op": "accept", "id": update_id, "at": entry["at"], "update": entry["update"]})
+            if entry["dispatched"]:
+                lines.append({"op": "dispatched", "id": update_id})
+            for chat_id, message_id in entry["placeholders"]:
+                lines.append({"op": "placeholder", "id": update_id, "chat": chat_id, "msg": message_id})
+        self._log.rewrite(lines)
+
+    async def recover(self, app: Application) -> None:
+        """启动时收尾上次未完成的 update（在 Application 开始处理 update_queue 之前调用）。"""
+        self._load()
+        if not self._inflight:
+            self._compact()
+            return
+        for update_id, entry in list(self._inflight.items()):
+            if not entry["dispatched"]:
+                # 还没调用插件：原样重新处理（过期的由处理器按 skip_if_stale 合并提示）；
+                # 重跑会发出新的占位消息，先删掉上次留下的，避免停在“输入中...”
+                for chat_id, message_id in entry["placeholders"]:
+                    with contextlib.suppress(TelegramError):
+                        await app.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                entry["placeholders"] = []
+                self._replay.add(update_id)
+                await app.update_queue.put(Update.de_json(entry["update"], app.bot))
+                self.resumed += 1
+                continue
+            await self._finalize_interrupted(app.bot, entry)
+            self._inflight.pop(update_id, None)
+            self._remember_done(update_id)
+            self.interrupted += 1
+        logger.info(f"Update journal: resumed {self.resumed}, finalized {self.interrupted} interrupted update(s)")
+        self._compact()
+
+    async def finalize_open(self, bot: Bot) -> int:
+        """排空结束时调用：被取消的回复把占位消息改为中断提示并记 done，返回收尾的条数；
+        还没调用插件的 update 保持未完成，重启后继续处理。"""
+        finalized = 0
+        for update_id, entry in list(self._inflight.items()):
+            if entry.get("deferred") or not (entry["dispatched"] or entry["placeholders"]):
+                continue
+            await self._finalize_interrupted(bot, entry)
+            del self._inflight[update_id]
+            self._remember_done(update_id)
+            self._log.write({"op": "done", "id": update_id})
+            finalized += 1
+        return finalized
+
+    async def _finalize_interrupted(self, bot: Bot, entry: Dict[str, Any]) -> None:
+        try:
+            if entry["placeholders"]:
+                for i, (chat_id, message_id) in enumerate(entry["placeholders"]):
+                    with contextlib.suppress(BadRequest, Forbidden):
+                        await bot.edit_message_text(
+                            chat_id=chat_id, message_id=message_id, text=_INTERRUPTED_TEXT if i == 0 else "（已中断）",
+                        )
+                return
+            update = Update.de_json(entry["update"], bot)
+            if update.effective_chat:
+                with contextlib.suppress(BadRequest, Forbidden):
+                    await bot.send_message(chat_id=update.effective_chat.id, text=_INTERRUPTED_TEXT)
+        except TelegramError as e:
+            logger.warning(f"Update journal: failed to finalize interrupted reply: {e}")
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await self._log.sync()
+        self._compact()
+
+    def stats(self) -> str:
+        return (
+            f"update_journal=inflight {len(self._inflight)} (duplicates {self.duplicates}, resumed {self.resumed}, "
+            f"interrupted {self.interrupted}, stale {self.stale})"
+        )
+
+
+update_journal = UpdateJournal(_per_worker_path(TG_UPDATE_JOURNAL_PATH), max_age_s=TG_UPDATE_MAX_AGE_S)
+
+
+# ============================================
+# Graceful shutdown（停止接收新 update 后排空进行中的回复）
+# ============================================
+
+class ShutdownDrain:
+    """SIGTERM 后、Application.stop() 之前的排空阶段。
+
+    调用方先停止接收新 update（停止轮询 / 关闭 webhook 端口）；进入排空后处理器不再开始新的 update
+    （记入 journal，重启后处理）。进行中的 handler 在 timeout_s 内正常结束，超时的被取消——取消会走
+    handler 的 finally（停止 typing、中止 TTS 流水线）；随后把被中断回复的占位消息改为中断提示，
+    等待已入队的语音发送完，并关闭授权库 journal。
+    """
+
+    def __init__(self, *, timeout_s: float):
+        self.timeout_s = max(0.0, timeout_s)
+        self.draining = False
+        self.completed = 0
+        self.cancelled = 0
+        self.finalized = 0
+
+    async def run(self, app: Application) -> None:
+        self.draining = True
+        deadline = time.monotonic() + self.timeout_s
+        processor = app.update_processor
+        tasks = set(processor.active) if isinstance(processor, TrackedUpdateProcessor) else set()
+        logger.info(f"Draining {len(tasks)} active update(s), deadline {self.timeout_s:.0f}s")
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+            self.completed = len(done)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=5.0)
+            self.cancelled = len(pending)
+        if not await voice_pool.join(max(0.0, deadline - time.monotonic())):
+            logger.warning(f"Shutdown drain: {voice_pool.depth()} voice clip(s) not delivered")
+        self.finalized = await update_journal.finalize_open(app.bot)
+        await auth_store.close()
+        logger.info(f"Shutdown drain finished: {self.stats()}")
+
+    def stats(self) -> str:
+        return f"drain=completed {self.completed}, cancelled {self.cancelled}, finalized {self.finalized}"
+
+
+shutdown_drain = ShutdownDrain(timeout_s=TG_SHUTDOWN_DRAIN_S)
+
+
+_background_tasks: list[asyncio.Task] = []
+_metrics_server: Optional[asyncio.base_events.Server] = None
+
+
+async def post_init(app: Application) -> None:
+    global _metrics_server
+    _background_tasks.append(asyncio.create_task(housekeeping_loop(TG_HOUSEKEEPING_INTERVAL_S)))
+    voice_pool.start()
+    tts_prewarmer.start()
+    loop_watchdog.start()
+    _metrics_server = await start_metrics_server()
+    await update_journal.recover(app)
+    if auth_store.shared:
+        _background_tasks.append(asyncio.create_task(auth_refresh_loop(TG_AUTH_REFRESH_INTERVAL_MS)))
+
+
+async def post_shutdown(app: Application) -> None:
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+    await voice_pool.stop()
+    await tts_prewarmer.stop()
+    await loop_watchdog.stop()
+    await voice_file_ids.flush()
+    await sse_recorder.flush()
+    await update_journal.close()
+    span_exporter.close()
+    for task in _background_tasks:
+        task.cancel()
+    for task in _background_tasks:
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+    _background_tasks.clear()
+
+
+# ============================================
+# Sharded webhook（前端按用户 ID 一致性哈希把 update 分发给多个 worker 进程）
+# ============================================
+
+class HashRing:
+    """一致性哈希环：每个节点 replicas 个虚拟节点；增加一个节点只会迁移约 1/N 的键。"""
+
+    def __init__(self, nodes: list[int], *, replicas: int = 160):
+        ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [n for _, n in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key: object) -> int:
+        index = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def update_routing_key(update: Dict[str, Any]) -> int:
+    """取 update 的发送者 ID（没有发送者时退回 chat ID，再退回 update_id），同一用户始终落到同一 worker。"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and isinstance(sender.get("id"), int):
+            return sender["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and isinstance(chat.get("id"), int):
+            return chat["id"]
+    return int(update.get("update_id") or 0)
+
+
+async def _read_http_head(reader: asyncio.StreamReader) -> tuple[str, str, Dict[str, str]]:
+    request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        raise ValueError("bad request line")
+    headers: Dict[str, str] = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout=10)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return parts[0], parts[1].split("?")[0], headers
+
+
+def _content_length(headers: Dict[str, str]) -> int:
+    length = int(headers.get("content-length") or 0)
+    if length < 0:
+        raise ValueError("negative content-length")
+    return length
+
+
+async def _read_http_body(reader: asyncio.StreamReader, headers: Dict[str, str], *, max_body: int) -> bytes:
+    length = _content_length(headers)
+    if length > max_body:
+        raise ValueError("body too large")
+    return await asyncio.wait_for(reader.readexactly(length), timeout=10) if length else b""
+
+
+async def _read_http_request(reader: asyncio.StreamReader, *, max_body: int) -> tuple[str, str, Dict[str, str], bytes]:
+    method, path, headers = await _read_http_head(reader)
+    return method, path, headers, await _read_http_body(reader, headers, max_body=max_body)
+
+
+async def _write_http_response(writer: asyncio.StreamWriter, status: str, body: bytes = b"") -> None:
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+        + body
+    )
+    await writer.drain()
+
+
+_WEBHOOK_MAX_BODY = 1024 * 1024
+_WEBHOOK_SECRET_RE = re.compile(r'^[A-Za-z0-9_-]{1,256}$')
+
+
+def webhook_secret_token() -> str:
+    """TG_WEBHOOK_SECRET 或由 bot token 派生的固定值（重启、多副本之间保持一致）。"""
+    if TG_WEBHOOK_SECRET:
+        return TG_WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode("utf-8")).hexdigest()
+
+
+def _app_pending_updates(app: Application) -> int:
+    """已接收但尚未开始处理的 update：update_queue 中的加上在并发上限前排队的。"""
+    processor = app.update_processor
+    queued = processor.queued if isinstance(processor, TrackedUpdateProcessor) else 0
+    return app.update_queue.qsize() + queued
+
+
+class WebhookReceiver:
+    """接收 Telegram webhook 请求：先只读请求头，路径或 secret token 不对时不读 body 直接拒绝；
+    合法的 update 交给 offer()，无论是否放得下都立即应答 200——放不下时丢弃并计数（shed），
+    Telegram 既不用等待处理，也不会因为 5xx 重发造成更大的积压。
+    """
+
+    def __init__(self, *, secret_token: str):
+        self._secret = secret_token.encode("utf-8")
+        self.accepted = 0
+        self.shed = 0
+        self.unauthorized = 0
+        self.invalid = 0
+
+    def offer(self, update: Dict[str, Any], body: bytes) -> bool:
+        raise NotImplementedError
+
+    async def persist(self) -> None:
+        """应答 200 之前调用：等待 offer() 接收的 update 落盘（默认不持久化）。"""
+
+    def depth(self) -> int:
+        raise NotImplementedError
+
+    def _count(self, result: str) -> None:
+        setattr(self, result, getattr(self, result) + 1)
+        M_WEBHOOK_UPDATES.inc(result=result)
 
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, headers = await _read_http_head(reader)
+            if method != "POST" or path != "/webhook":
+                await _write_http_response(writer, "404 Not Found")
+                return
+            token = headers.get("x-telegram-bot-api-secret-token", "").encode("utf-8")
+            if not hmac.compare_digest(token, self._secret):
+                self._count("unauthorized")
+                await _write_http_response(writer, "403 Forbidden")
+                return
+            # 以下被拒绝的请求都应答 4xx：update 被消费掉，Telegram 不会反复重发同一条坏请求
+            try:
+                length = _content_length(headers)
+            except ValueError:
+                length = -1
+            if length < 0 or length > _WEBHOOK_MAX_BODY:
+                self._count("invalid")
+                logger.warning(f"Webhook request rejected: Content-Length {headers.get('content-length')!r}")
+                await _write_http_response(writer, "400 Bad Request" if length < 0 else "413 Payload Too Large")
+                return
+            body = await _read_http_body(reader, headers, max_body=_WEBHOOK_MAX_BODY)
+            try:
+                update = json.loads(body)
+            except ValueError:
+                update = None
+            if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+                self._count("invalid")
+                logger.warning(f"Webhook request rejected: not an update ({len(body)} bytes)")
+                await _write_http_response(writer, "400 Bad Request")
+                return
+            try:
+                offered = self.offer(update, body)
+            except Exception as e:
+                self._count("invalid")
+                logger.error(f"Webhook update {update['update_id']} rejected: {type(e).__name__}: {e}")
+                await _write_http_response(writer, "400 Bad Request")
+                return
+            if offered:
+                await self.persist()
+                self._count("accepted")
+            else:
+                self._count("shed")
+                if self.shed == 1 or self.shed % 100 == 0:
+                    logger.warning(f"Webhook queue full ({self.depth()} pending), shed {self.shed} updates so far")
+            await _write_http_response(writer, "200 OK")
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            # 客户端超时或中途断开：没有可应答的对象
+            pass
+        except ValueError as e:
+            logger.warning(f"Webhook request rejected: {e}")
+            with contextlib.suppress(Exception):
+                await _write_http_response(writer, "400 Bad Request")
+        except Exception as e:
+            logger.error(f"Webhook request error: {type(e).__name__}: {e}")
+            with contextlib.suppress(Exception):
+                await _write_http_response(writer, "500 Internal Server Error")
+        finally:
+            writer.close()
+
+    def summary(self) -> str:
+        return f"排队 {self.depth()}，已接收 {self.accepted}，丢弃 {self.shed}，拒绝 {self.unauthorized + self.invalid}"
+
+    def stats(self) -> str:
+        return (
+            f"webhook=queued {self.depth()} (accepted {self.accepted}, shed {self.shed}, "
+            f"unauthorized {self.unauthorized}, invalid {self.invalid})"
+        )
+
+
+class LocalWebhookReceiver(WebhookReceiver):
+    """单进程 webhook：update 直接放入 Application.update_queue，待处理数达到上限时丢弃。"""
+
+    def __init__(self, app: Application, *, secret_token: str, max_pending: int):
+        super().__init__(secret_token=secret_token)
+        self.app = app
+        self.max_pending = max(1, max_pending)
+
+    def offer(self, update: Dict[str, Any], body: bytes) -> bool:
+        if self.depth() >= self.max_pending:
+            return False
+        self.app.update_queue.put_nowait(Update.de_json(update, self.app.bot))
+        return True
+
+    def depth(self) -> int:
+        return _app_pending_updates(self.app)
+
+
+# 当前进程对外接收 webhook 的 receiver（polling 与 worker 进程中为 None）
+webhook_receiver: Optional[WebhookReceiver] = None
+
+
+class WebhookFrontend(WebhookReceiver):
+    """Webhook 前端：校验后立即应答 Telegram，再按用户 ID 转发给固定的 worker。
+
+    每个 worker 一个有序队列和一个转发任务，同一用户的 update 按到达顺序送达；worker 忙（503）时
+    短暂等待后重发，连不上时指数退避一直重试，队列满时丢弃新 update。worker 进程退出后自动重启。
+    worker 对某条 update 返回其他错误状态（如解析失败的 500）时最多尝试 FORWARD_MAX_ATTEMPTS 次，
+    之后记日志并丢弃（dropped），避免一条坏 update 卡住整个分片。
+    应答 Telegram 之前 update 先写入前端 journal（组提交 fsync），worker 收下后记 fwd；前端重启时把
+    未转发的 update 重新放入队列。崩溃前已转发但未记 fwd 的会重发一次，由 worker 的 journal 按
+    update_id 去重。
+    """
+
+    FORWARD_MAX_ATTEMPTS = 3
+
+    def __init__(self, *, workers: int, port_base: int, queue_size: int, secret_token: str,
+                 journal_path: str = "", compact_every: int = 10000):
+        super().__init__(secret_token=secret_token)
+        self.workers = workers
+        self.ports = [port_base + i for i in range(workers)]
+        self.ring = HashRing(list(range(workers)))
+        self.queue_size = max(1, queue_size)
+        self._queues: list[asyncio.Queue] = []
+        self._procs: list[Optional[asyncio.subprocess.Process]] = [None] * workers
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+        self.forward_retries = 0
+        self.dropped = 0
+        self._journal = JournalFile(journal_path, label="Webhook front-end journal")
+        self.compact_every = compact_every
+        # 已应答 Telegram、尚未被 worker 收下的 update：update_id -> update
+        self._unforwarded: Dict[int, Dict[str, Any]] = {}
+        self.replayed = 0
+
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        env["TG_WORKER_INDEX"] = str(index)
+        env["TG_WORKER_PORT"] = str(self.ports[index])
+        env["TG_AUTH_SHARED"] = "1"
+        if TG_METRICS_PORT > 0:
+            env["TG_METRICS_PORT"] = str(TG_METRICS_PORT + index)
+        return env
+
+    async def start(self) -> None:
+        # 上限在 offer() 中检查：journal 重放的 update 已应答过 Telegram，不受上限约束
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=2.0))
+        self._recover()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._supervise(i)))
+            self._tasks.append(asyncio.create_task(self._forward(i)))
+        logger.info(f"Webhook front-end started with {self.workers} workers on ports {self.ports[0]}-{self.ports[-1]}")
+
+    async def _supervise(self, index: int) -> None:
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env=self._worker_env(index),
+            )
+            self._procs[index] = proc
+            code = await proc.wait()
+            if self._stopping:
+                return
+            logger.error(f"Webhook worker {index} exited with code {code}, restarting")
+            await asyncio.sleep(1.0)
+
+    def _recover(self) -> None:
+        for record in self._journal.read():
+            update_id = record.get("id")
+            if record.get("op") == "accept" and isinstance(record.get("update"), dict):
+                self._unforwarded[update_id] = record["update"]
+            elif record.get("op") == "fwd":
+                self._unforwarded.pop(update_id, None)
+        for update in self._unforwarded.values():
+            queue = self._queues[self.ring.node_for(update_routing_key(update))]
+            queue.put_nowait((update["update_id"], json.dumps(update, ensure_ascii=False).encode("utf-8")))
+        self.replayed = len(self._unforwarded)
+        if self.replayed:
+            logger.info(f"Webhook front-end: replaying {self.replayed} unforwarded update(s) from journal")
+        self._compact()
+
+    def _compact(self) -> None:
+        self._journal.rewrite([
+            {"op": "accept", "id": update_id, "update": update} for update_id, update in self._unforwarded.items()
+        ])
+
+    def _forwarded(self, update_id: int) -> None:
+        if self._unforwarded.pop(update_id, None) is None:
+            return
+        self._journal.write({"op": "fwd", "id": update_id})
+        if self._journal.records >= self.compact_every:
+            self._compact()
+
+    async def _forward(self, index: int) -> None:
+        url = f"http://127.0.0.1:{self.ports[index]}/update"
+        queue = self._queues[index]
+        while True:
+            update_id, body = await queue.get()
+            delay = 0.2
+            rejected = 0
+            while True:
+                try:
+                    resp = await self._client.post(url, content=body, headers={"Content-Type": "application/json"})
+                    if resp.status_code == 200:
+                        self._forwarded(update_id)
+                        break
+                    if resp.status_code == 503:
+                        # worker 的待处理数已到上限：积压留在前端队列里，由前端负责丢弃
+                        await asyncio.sleep(0.05)
+                        continue
+                    rejected += 1
+                    if rejected >= self.FORWARD_MAX_ATTEMPTS:
+                        self._count("dropped")
+                        logger.error(
+                            f"Webhook worker {index} rejected update {update_id} with HTTP {resp.status_code} "
+                            f"{rejected} times, dropping it"
+                        )
+                        # 同样记 fwd，前端重启后不再重放
+                        self._forwarded(update_id)
+                        break
+                except httpx.HTTPError:
+                    pass
+                self.forward_retries += 1
+                await asyncio.sleep(delay)
+                delay = min(5.0, delay * 2)
+            queue.task_done()
+
+    def offer(self, update: Dict[str, Any], body: bytes) -> bool:
+        queue = self._queues[self.ring.node_for(update_routing_key(update))]
+        if queue.qsize() >= self.queue_size:
+            return False
+        queue.put_nowait((update["update_id"], body))
+        if self._journal.enabled:
+            self._unforwarded[update["update_id"]] = update
+            self._journal.write({"op": "accept", "id": update["update_id"], "update": update})
+        return True
+
+    async def persist(self) -> None:
+        await self._journal.sync()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def stop(self) -> None:
+        """先让 worker 进入排空（SIGTERM），同时把队列中剩余的 update 转给它们（worker 排空期间只记入
+        journal，重启后处理），再等待 worker 退出。"""
+        self._stopping = True
+        for proc in self._procs:
+            if proc is not None and proc.returncode is None:
+                proc.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout=TG_SHUTDOWN_DRAIN_S)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Webhook front-end: {self.depth()} update(s) not forwarded before shutdown"
+                + (", kept in journal" if self._journal.enabled else "")
+            )
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
+        for proc in self._procs:
+            if proc is None:
+                continue
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=TG_SHUTDOWN_DRAIN_S + 15)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await self._client.aclose()
+        await self._journal.sync()
+        self._compact()
+
+    def stats(self) -> str:
+        return (
+            f"{super().stats()}, forward retries {self.forward_retries}, dropped {self.dropped}, "
+            f"replayed {self.replayed}"
+        )
+
+
+def _frontend_journal_path(path: str) -> str:
+    """前端 journal 与 worker 的 updates.w<i>.journal 放在一起：updates.frontend.journal。"""
+    if not path:
+        return path
+    p = Path(path)
+    return str(p.with_name(f"{p.stem}.frontend{p.suffix}"))
+
+
+def _install_stop_signals(stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+
+async def run_sharded_webhook(port: int) -> None:
+    global webhook_receiver
+    secret = webhook_secret_token()
+    frontend = WebhookFrontend(
+        workers=TG_WEBHOOK_WORKERS, port_base=TG_WORKER_PORT_BASE, queue_size=TG_WEBHOOK_QUEUE_SIZE, secret_token=secret,
+        journal_path=_frontend_journal_path(TG_UPDATE_JOURNAL_PATH),
+    )
+    webhook_receiver = frontend
+    server = None
+    await frontend.start()
+    try:
+        server = await asyncio.start_server(frontend.handle, "0.0.0.0", port)
+        async with Bot(TELEGRAM_BOT_TOKEN) as tg_bot:
+            await tg_bot.set_webhook(url=f"{WEBHOOK_URL}/webhook", secret_token=secret)
+        logger.info(f"Starting sharded webhook on port {port}")
+
+        stop = asyncio.Event()
+        _install_stop_signals(stop)
+        # 前端进程不跑 housekeeping，定期输出一次队列状态
+        while not stop.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), timeout=300)
+            if not stop.is_set():
+                logger.info(f"Webhook front-end: {frontend.stats()}")
+    finally:
+        # 启动失败或被取消时同样停掉 worker 进程，不留下孤儿进程
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        logger.info(f"Stopping webhook front-end: {frontend.stats()}")
+        await frontend.stop()
+
+
+async def run_application(*, mode: str, port: int = 0) -> None:
+    """在本进程运行 Application（不使用 PTB 的 run_polling/run_webhook，以便在 stop() 前插入排空阶段）。
+
+    mode="polling"：长轮询；"webhook"：单进程 webhook，对外监听并校验 secret token；
+    "worker"：监听 127.0.0.1，接收前端转发的 update，待处理数达到 TG_CONCURRENT_UPDATES 时返回 503，
+    让积压留在前端的有序队列中。收到 SIGTERM/SIGINT 后先停止接收新 update，再由 shutdown_drain 排空。
+    """
+    global webhook_receiver
+    app = build_application(TELEGRAM_BOT_TOKEN, updater=mode == "polling")
+
+    async def handle_forwarded(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, _, body = await _read_http_request(reader, max_body=_WEBHOOK_MAX_BODY)
+            if method != "POST" or path != "/update":
+                await _write_http_response(writer, "404 Not Found")
+                return
+            # 排空期间 update 只记入 journal 不处理，照常接收以便前端清空队列
+            if not shutdown_drain.draining and _app_pending_updates(app) >= TG_CONCURRENT_UPDATES:
+                await _write_http_response(writer, "503 Service Unavailable")
+                return
+            await app.update_queue.put(Update.de_json(json.loads(body), app.bot))
+            await _write_http_response(writer, "200 OK")
+        except Exception as e:
+            logger.error(f"Worker request error: {e}")
+            with contextlib.suppress(Exception):
+                await _write_http_response(writer, "500 Internal Server Error")
+        finally:
+            writer.close()
+
+    server = None
+    async with app:
+        try:
+            await post_init(app)
+            if mode == "polling":
+                await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await app.start()
+            if mode == "worker":
+                server = await asyncio.start_server(handle_forwarded, "127.0.0.1", port)
+                logger.info(f"Webhook worker {TG_WORKER_INDEX} listening on 127.0.0.1:{port}")
+            elif mode == "webhook":
+                webhook_receiver = LocalWebhookReceiver(
+                    app, secret_token=webhook_secret_token(), max_pending=TG_WEBHOOK_QUEUE_SIZE,
+                )
+                server = await asyncio.start_server(webhook_receiver.handle, "0.0.0.0", port)
+                await app.bot.set_webhook(url=f"{WEBHOOK_URL}/webhook", secret_token=webhook_secret_token())
+                logger.info(f"Starting webhook on port {port}")
+            else:
+                logger.info("Starting polling mode")
+
+            stop = asyncio.Event()
+            _install_stop_signals(stop)
+            await stop.wait()
+        finally:
+            # 收到信号、启动中途失败或被取消（如 Windows 上的 Ctrl+C，没有信号处理器）都走这里：
+            # 否则 Application 仍在运行，退出 async with 时 PTB 报错，post_shutdown 也不会执行
+            # 先停止接收新 update；worker 保持监听，排空期间前端转来的 update 记入 journal
+            if app.updater is not None and app.updater.running:
+                await app.updater.stop()
+            if server is not None and mode == "webhook":
+                server.close()
+                await server.wait_closed()
+            if app.running:
+                await shutdown_drain.run(app)
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            if webhook_receiver:
+                logger.info(f"Stopping webhook: {webhook_receiver.stats()}")
+            if app.running:
+                await app.stop()
+            await post_shutdown(app)
+
+
+def build_application(token: str, *, base_url: Optional[str] = None, updater: bool = True) -> Application:
+    """构建 Application 并注册全部 handler；base_url 供压测时指向假的 Bot API，
+    updater=False 用于 webhook worker（update 由前端转发后直接放入 update_queue）。"""
     builder = (
         Application.builder()
-        .token(TELEGRAM_BOT_TOKEN)
-        .concurrent_updates(TG_CONCURRENT_UPDATES)
-        .connection_pool_size(TG_CONNECTION_POOL_SIZE)
-        .pool_timeout(TG_POOL_TIMEOUT)
+        .token(token)
+        .concurrent_updates(TrackedUpdateProcessor(TG_CONCURRENT_UPDATES))
+        .request(CountingHTTPXRequest(connection_pool_size=TG_CONNECTION_POOL_SIZE, pool_timeout=TG_POOL_TIMEOUT))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if not updater:
+        builder = builder.updater(None)
     app = builder.build()
 
     # Commands
+    app.add_handler(TypeHandler(Update, begin_update_trace), group=-1)
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CommandHandler("register", cmd_register))
     app.add_handler(CommandHandler("invite", cmd_invite))
     app.add_handler(CommandHandler("registration", cmd_registration))
     app.add_handler(CommandHandler("users", cmd_users))
+    app.add_handler(CommandHandler("profile", cmd_profile))
+    app.add_handler(CommandHandler("perf", cmd_perf))
     app.add_handler(CommandHandler("pending", cmd_pending))
     app.add_handler(CommandHandler("approve", cmd_approve))
     app.add_handler(CommandHandler("revoke", cmd_revoke))
@@ -2721,20 +6700,30 @@ def main() -> None:
 
     # Errors
     app.add_error_handler(error_handler)
+    return app
+
+
+def main() -> None:
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN not set!")
+        return
+
+    if TG_WORKER_PORT:
+        asyncio.run(run_application(mode="worker", port=TG_WORKER_PORT))
+        return
 
     # Start
     if WEBHOOK_URL:
+        if not _WEBHOOK_SECRET_RE.match(webhook_secret_token()):
+            logger.error("TG_WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ or -")
+            return
         port = int(os.getenv('PORT', '8443'))
-        logger.info(f"Starting webhook on port {port}")
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path="webhook",
-            webhook_url=f"{WEBHOOK_URL}/webhook"
-        )
+        if TG_WEBHOOK_WORKERS > 1:
+            asyncio.run(run_sharded_webhook(port))
+        else:
+            asyncio.run(run_application(mode="webhook", port=port))
     else:
-        logger.info("Starting polling mode")
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        asyncio.run(run_application(mode="polling"))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# bot.py 在导入时读取环境变量并加载授权库：先指向临时目录，避免写到 /app/data
+_DATA_DIR = tempfile.mkdtemp(prefix="tg-bot-tests-")
+os.environ.setdefault("TG_AUTH_DB_PATH", os.path.join(_DATA_DIR, "auth.json"))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+import bot
+
+
+def make_store(tmp_path, **kwargs):
+    store = bot.AuthStore(
+        str(tmp_path / "auth.json"), admin_user_id=1, registration_enabled_default=True, **kwargs,
+    )
+    store.load_sync()
+    return store
+
+
+def journal_lines(store):
+    return store.journal_path.read_bytes().splitlines()
+
+
+def test_journal_replays_on_restart(tmp_path):
+    store = make_store(tmp_path)
+
+    async def run():
+        await store.approve(10, approved_by=1)
+        await store.set_user_llm_model(10, "m1")
+        await store.set_user_tts_voice(11, "v")
+        await store.close()
+
+    asyncio.run(run())
+    assert len(journal_lines(store)) == 3
+
+    reloaded = make_store(tmp_path)
+    assert reloaded.is_allowed(10)
+    assert reloaded.get_user_llm_model(10) == "m1"
+    assert reloaded.get_user_tts_voice(11) == "v"
+    assert reloaded._snapshot() == store._snapshot()
+    # 启动时合并进新快照并清空 journal
+    assert json.loads(reloaded.path.read_text(encoding="utf-8"))["journalSeq"] == 3
+    assert journal_lines(reloaded) == []
+
+
+def test_compaction_and_stale_records_are_skipped(tmp_path):
+    store = make_store(tmp_path, compact_every=3)
+
+    async def run():
+        for i in range(4):
+            await store.set_user_llm_model(20 + i, f"m{i}")
+        await store.close()
+
+    asyncio.run(run())
+    assert json.loads(store.path.read_text(encoding="utf-8"))["journalSeq"] == 3
+    assert [json.loads(line)["seq"] for line in journal_lines(store)] == [4]
+
+    # 已合并进快照的 seq 再次出现在 journal 中时不得重复应用
+    with store.journal_path.open("ab") as f:
+        stale = {"seq": 2, "op": "user_setting", "userId": 21, "field": "llmModel", "value": "stale"}
+        f.write((json.dumps(stale) + "\n").encode("utf-8"))
+
+    reloaded = make_store(tmp_path)
+    assert reloaded._seq == 4
+    assert [reloaded.get_user_llm_model(20 + i) for i in range(4)] == ["m0", "m1", "m2", "m3"]
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    store = make_store(tmp_path)
+
+    async def run():
+        await store.set_user_llm_model(30, "kept")
+        await store.close()
+
+    asyncio.run(run())
+    with store.journal_path.open("ab") as f:
+        f.write(b'{"seq":2,"op":"user_setting","userId":30,"fie')
+
+    reloaded = make_store(tmp_path)
+    assert reloaded._seq == 1
+    assert reloaded.get_user_llm_model(30) == "kept"
+
+    asyncio.run(reloaded.set_user_llm_model(31, "after"))
+    again = make_store(tmp_path)
+    assert again.get_user_llm_model(31) == "after"
+
+
+def test_cancelled_commit_still_applies_written_record(tmp_path):
+    store = make_store(tmp_path)
+
+    async def run():
+        task = asyncio.create_task(store.set_user_llm_model(40, "m"))
+        await asyncio.sleep(0)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert task.cancelled()
+        await store.set_user_llm_model(41, "n")
+        await store.close()
+
+    asyncio.run(run())
+    assert store.get_user_llm_model(40) == "m"
+    assert [json.loads(line)["seq"] for line in journal_lines(store)] == [1, 2]
+
+
+def test_shared_stores_see_each_other_and_skip_torn_tail(tmp_path):
+    a = make_store(tmp_path, shared=True)
+    b = make_store(tmp_path, shared=True)
+
+    async def run():
+        await a.set_user_llm_model(50, "from-a")
+        await b.refresh()
+        assert b.get_user_llm_model(50) == "from-a"
+        # 另一个进程写到一半崩溃
+        with a.journal_path.open("ab") as f:
+            f.write(b'{"seq":2,"op":"user_se')
+        await b.set_user_llm_model(51, "from-b")
+        await a.refresh()
+        assert a.get_user_llm_model(51) == "from-b"
+        await a.close()
+        await b.close()
+
+    asyncio.run(run())
+    reloaded = make_store(tmp_path)
+    assert reloaded.get_user_llm_model(50) == "from-a"
+    assert reloaded.get_user_llm_model(51) == "from-b"
@@ -0,0 +1,79 @@
+import struct
+
+import bot
+
+SERIAL_A = 0x1111
+SERIAL_B = 0x2222
+# TOC：config 1（SILK 20ms，960 采样）、code 0（单帧）
+PACKET = bytes([0x08]) + b"\x55" * 40
+
+
+def _page(out: bytearray, header_type: int, granule: int, serial: int, seq: int, packets: list[bytes]) -> None:
+    segments = bytearray()
+    for packet in packets:
+        segments += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+    bot._ogg_write_page(out, header_type, granule, serial, seq, bytes(segments), b"".join(packets))
+
+
+def make_opus(serial: int, pages: list[int], *, trim: int = 0) -> bytes:
+    """OpusHead + OpusTags + 每页 pages[i] 个音频包；最后一页 granule 减去 trim。"""
+    out = bytearray()
+    _page(out, 0x02, 0, serial, 0, [b"OpusHead" + b"\x01" * 11])
+    _page(out, 0x00, 0, serial, 1, [b"OpusTags" + b"\x00" * 8])
+    granule = 0
+    for i, count in enumerate(pages):
+        granule += 960 * count
+        last = i == len(pages) - 1
+        _page(out, 0x04 if last else 0x00, granule - (trim if last else 0), serial, 2 + i, [PACKET] * count)
+    return bytes(out)
+
+
+def _crc_ok(data: bytes) -> bool:
+    pos = 0
+    while pos < len(data):
+        nsegs = data[pos + 26]
+        end = pos + 27 + nsegs + sum(data[pos + 27:pos + 27 + nsegs])
+        page = bytearray(data[pos:end])
+        stored = struct.unpack_from("<I", page, 22)[0]
+        struct.pack_into("<I", page, 22, 0)
+        if bot._ogg_crc(bytes(page)) != stored:
+            return False
+        pos = end
+    return True
+
+
+def test_ogg_crc_matches_reference_vector():
+    # CRC-32/CKSUM 的校验值 0x765E7680 去掉末尾取反（Ogg 不做取反）
+    assert bot._ogg_crc(b"123456789") == 0x89A1897F
+
+
+def test_join_renumbers_pages_into_one_stream():
+    joined = bot.join_ogg_opus([make_opus(SERIAL_A, [2, 3]), make_opus(SERIAL_B, [1, 2])])
+    pages = bot._ogg_pages(joined)
+    # 第二段的两个头部页被丢弃
+    assert len(pages) == 2 + 2 + 2
+    assert {page[2] for page in pages} == {SERIAL_A}
+    assert [page[3] for page in pages] == list(range(len(pages)))
+    assert pages[0][0] & 0x02
+    assert not any(page[0] & 0x02 for page in pages[1:])
+    assert [bool(page[0] & 0x04) for page in pages] == [False] * 5 + [True]
+
+
+def test_join_keeps_granule_continuous():
+    joined = bot.join_ogg_opus([make_opus(SERIAL_A, [2, 3]), make_opus(SERIAL_B, [1, 2], trim=100)])
+    granules = [page[1] for page in bot._ogg_pages(joined)[2:]]
+    assert granules == [960 * 2, 960 * 5, 960 * 6, 960 * 8 - 100]
+
+
+def test_join_writes_valid_crcs():
+    joined = bot.join_ogg_opus([make_opus(SERIAL_A, [2]), make_opus(SERIAL_B, [3]), make_opus(SERIAL_A, [1])])
+    assert _crc_ok(joined)
+
+
+def test_join_audio_chunks_falls_back_to_concatenation():
+    mp3 = [b"ID3" + b"a" * 10, b"ID3" + b"b" * 10]
+    assert bot.join_audio_chunks(mp3) == b"".join(mp3)
+    broken = [make_opus(SERIAL_A, [1]), b"OggS" + b"\x00" * 10]
+    assert bot.join_audio_chunks(broken) == b"".join(broken)
+    single = make_opus(SERIAL_A, [1])
+    assert bot.join_audio_chunks([b"", single]) == single
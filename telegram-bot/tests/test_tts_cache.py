@@ -0,0 +1,41 @@
+import asyncio
+import os
+import time
+
+import bot
+
+
+def test_shared_housekeep_enforces_budget_across_workers(tmp_path):
+    a = bot.TTSAudioCache(str(tmp_path), max_bytes=1000, shared=True)
+    b = bot.TTSAudioCache(str(tmp_path), max_bytes=1000, shared=True)
+    a.load_sync()
+    b.load_sync()
+
+    async def run():
+        # 两个 worker 各自都没超预算，合计 1600 字节
+        for i in range(4):
+            await a.put(f"a{i:063d}", b"x" * 200)
+            await b.put(f"b{i:063d}", b"y" * 200)
+        assert a.total_bytes == b.total_bytes == 800
+        await a.housekeep()
+
+    asyncio.run(run())
+    on_disk = sum(f.stat().st_size for f in tmp_path.glob("*/*.audio"))
+    assert on_disk <= 1000
+    assert a.total_bytes == on_disk
+
+
+def test_housekeep_removes_stale_tmp_files(tmp_path):
+    cache = bot.TTSAudioCache(str(tmp_path), max_bytes=1000)
+    cache.load_sync()
+    stale = tmp_path / "ab" / "ab00.1234.tmp"
+    fresh = tmp_path / "ab" / "ab00.5678.tmp"
+    stale.parent.mkdir()
+    stale.write_bytes(b"x")
+    fresh.write_bytes(b"x")
+    old = time.time() - cache.STALE_TMP_S - 60
+    os.utime(stale, (old, old))
+
+    asyncio.run(cache.housekeep())
+    assert not stale.exists()
+    assert fresh.exists()
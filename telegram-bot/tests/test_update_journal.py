@@ -0,0 +1,132 @@
+import asyncio
+
+from telegram import Update
+
+import bot
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+
+    async def delete_message(self, **kwargs):
+        self.calls.append(("deleteMessage", kwargs))
+        return True
+
+    async def edit_message_text(self, **kwargs):
+        self.calls.append(("editMessageText", kwargs))
+        return True
+
+    async def send_message(self, **kwargs):
+        self.calls.append(("sendMessage", kwargs))
+        return True
+
+
+class FakeApp:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.update_queue = asyncio.Queue()
+
+
+class Placeholder:
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+
+def make_update(update_id, chat_id=1000):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "hi",
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+        },
+    }, None)
+
+
+def make_journal(tmp_path):
+    return bot.UpdateJournal(str(tmp_path / "updates.journal"), max_age_s=0)
+
+
+async def start(journal, update, *, dispatched=False, placeholder=None):
+    assert await journal.begin(update)
+    token = bot._current_update_id.set(update.update_id)
+    try:
+        if placeholder is not None:
+            journal.placeholder(Placeholder(*placeholder))
+        if dispatched:
+            journal.mark_dispatched()
+    finally:
+        bot._current_update_id.reset(token)
+
+
+def test_dedup_survives_restart(tmp_path):
+    async def before_crash():
+        journal = make_journal(tmp_path)
+        await start(journal, make_update(1), dispatched=True)
+        await journal.finish(1)
+        # 不调用 close()：模拟进程崩溃
+
+    async def after_restart():
+        journal = make_journal(tmp_path)
+        app = FakeApp()
+        await journal.recover(app)
+        assert app.update_queue.empty()
+        assert not await journal.begin(make_update(1))
+        assert journal.duplicates == 1
+        assert await journal.begin(make_update(2))
+
+    asyncio.run(before_crash())
+    asyncio.run(after_restart())
+
+
+def test_recover_replays_undispatched_and_finalizes_interrupted(tmp_path):
+    async def before_crash():
+        journal = make_journal(tmp_path)
+        await start(journal, make_update(10), placeholder=(1000, 501))
+        await start(journal, make_update(11), dispatched=True, placeholder=(1000, 502))
+        await start(journal, make_update(12), dispatched=True, placeholder=(1000, 503))
+        await journal.finish(12)
+
+    async def after_restart():
+        journal = make_journal(tmp_path)
+        app = FakeApp()
+        await journal.recover(app)
+        assert (journal.resumed, journal.interrupted) == (1, 1)
+        replayed = app.update_queue.get_nowait()
+        assert replayed.update_id == 10 and app.update_queue.empty()
+        assert app.bot.calls == [
+            ("deleteMessage", {"chat_id": 1000, "message_id": 501}),
+            ("editMessageText", {"chat_id": 1000, "message_id": 502, "text": bot._INTERRUPTED_TEXT}),
+        ]
+        # 重放的 update 正常进入处理器；已收尾与已完成的不再处理
+        assert await journal.begin(replayed)
+        assert not await journal.begin(make_update(11))
+        assert not await journal.begin(make_update(12))
+
+    asyncio.run(before_crash())
+    asyncio.run(after_restart())
+
+
+def test_finalize_open_keeps_undispatched_for_restart(tmp_path):
+    async def run():
+        journal = make_journal(tmp_path)
+        fake = FakeBot()
+        await start(journal, make_update(20), dispatched=True, placeholder=(1000, 601))
+        await start(journal, make_update(21))
+        await start(journal, make_update(22))
+        journal.defer(22)
+        assert await journal.finalize_open(fake) == 1
+        assert fake.calls == [
+            ("editMessageText", {"chat_id": 1000, "message_id": 601, "text": bot._INTERRUPTED_TEXT}),
+        ]
+        await journal.close()
+
+        restarted = make_journal(tmp_path)
+        app = FakeApp()
+        await restarted.recover(app)
+        assert sorted(app.update_queue.get_nowait().update_id for _ in range(app.update_queue.qsize())) == [21, 22]
+        assert not await restarted.begin(make_update(20))
+
+    asyncio.run(run())